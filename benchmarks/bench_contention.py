@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Lookup latency under ingestion: N reader threads plus a writer applying event batches and GC slices.
+
+'locked' takes the shared lock for every lookup like the HTTP handlers used to,
+'lockfree' uses the lock free ConnTable reads."""
+import argparse
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from natconnd import conn_record  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import conn_table  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def make_record(port, now):
+	return conn_record.ConnRecord(
+		socket.AF_INET, socket.IPPROTO_TCP, conn_record.SIG_NEW,
+		random.randint(0x0a000000, 0x0affffff), random.randint(1024, 65535), 0xc6336401, 443, 0x64400201, port, now)
+
+
+def writer(table, lock, args, stop):
+	# Event batches at the configured rate, every gc_interval a GC run expiring a slice of the oldest entries
+	batch_interval = float(args.batch_size) / args.rate
+	next_gc = time.monotonic() + args.gc_interval
+	while not stop.is_set():
+		start = time.monotonic()
+		now = int(time.time())
+		batch = [make_record(random.randint(1024, 65535), now) for _ in range(args.batch_size)]
+		with lock:
+			for record in batch:
+				table.insert(record)
+		if start >= next_gc:
+			with lock:
+				table.expire(0, args.gc_slice)
+			next_gc = start + args.gc_interval
+		time.sleep(max(0.0, batch_interval - (time.monotonic() - start)))
+
+
+def reader(table, lock, locked, latencies, stop):
+	lookup = table.lookup
+	clock = time.perf_counter
+	while not stop.is_set():
+		port = random.randint(1024, 65535)
+		start = clock()
+		if locked:
+			with lock:
+				lookup('nat_port', port)
+		else:
+			lookup('nat_port', port)
+		latencies.append(clock() - start)
+
+
+def run(mode, args):
+	table = conn_table.ConnTable(['nat_port'])
+	lock = threading.Lock()
+	now = int(time.time())
+	for port in range(1024, 65536):
+		table.insert(make_record(port, now))
+	stop = threading.Event()
+	latencies = [[] for _ in range(args.readers)]
+	threads = [threading.Thread(target=writer, args=(table, lock, args, stop))]
+	threads += [threading.Thread(target=reader, args=(table, lock, mode == 'locked', latencies[i], stop)) for i in range(args.readers)]
+	for thread in threads:
+		thread.start()
+	time.sleep(args.duration)
+	stop.set()
+	for thread in threads:
+		thread.join()
+
+	merged = sorted(x for lat in latencies for x in lat)
+	pct = lambda p: merged[min(len(merged) - 1, int(len(merged) * p))] * 1e6
+	print("%-9s lookups/s %9.0f  p50 %7.1f us  p99 %8.1f us  p99.9 %8.1f us  max %9.1f us" % (
+		mode, len(merged) / args.duration, pct(0.5), pct(0.99), pct(0.999), merged[-1] * 1e6))
+
+
+def main():
+	argp = argparse.ArgumentParser()
+	argp.add_argument("-r", "--readers", help="number of reader threads", type=int, default=8)
+	argp.add_argument("-e", "--rate", help="events per second applied by the writer", type=int, default=5000)
+	argp.add_argument("-b", "--batch-size", help="events per writer batch", type=int, default=256)
+	argp.add_argument("--gc-interval", help="seconds between GC slices", type=float, default=0.5)
+	argp.add_argument("--gc-slice", help="entries expired per GC slice", type=int, default=1000)
+	argp.add_argument("-d", "--duration", help="seconds per mode", type=float, default=5.0)
+	args = argp.parse_args()
+	for mode in ('locked', 'lockfree'):
+		run(mode, args)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Filter throughput of the compiled [filter] predicate.
+
+Events are generated with a given share matching the filter, the non-matching ones fail on one
+randomly chosen field of the filter. The previous filter (walking a dict of exact conditions
+with getattr) is measured on the exact-match filter for comparison."""
+import argparse
+import os
+import random
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from natconnd import conn_filter  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import conn_record  # noqa: E402 pylint: disable=wrong-import-position
+
+FILTERS = {
+	'exact': {'dst_ip': ['198.51.100.1'], 'dst_port': ['443'], 'nat_ip': ['100.64.2.1']},
+	'ranges': {
+		'src_ip': ['10.0.0.0/8', '!10.99.0.0/16'], 'dst_port': ['80', '443', '8000-8999'], 'nat_ip': ['100.64.2.0/24'],
+		'protocol': ['tcp']},
+}
+
+
+def make_events(count, matching, fields):
+	"""Events passing both filters, except for the share not matching which fails on one of fields"""
+	events = []
+	for _ in range(count):
+		values = dict(
+			src_ip=0x0a000000 + random.randint(0, 0x62ffff), dst_ip=0xc6336401, dst_port=443, nat_ip=0x64400201,
+			protocol=socket.IPPROTO_TCP)
+		if random.random() >= matching:
+			field = random.choice(fields)
+			values[field] = {
+				'src_ip': 0xc0a80001, 'dst_ip': 0xc6336402, 'dst_port': 22, 'nat_ip': 0x64400301,
+				'protocol': socket.IPPROTO_UDP}[field]
+		events.append(conn_record.ConnRecord(
+			socket.AF_INET, values['protocol'], conn_record.SIG_NEW, values['src_ip'], random.randint(1024, 65535),
+			values['dst_ip'], values['dst_port'], values['nat_ip'], random.randint(1024, 65535), 0))
+	return events
+
+
+def legacy_filter(filter_conf):
+	conditions = dict((k, conn_record.parse_field(k, v[0])) for k, v in filter_conf.items())
+
+	def matches(x):
+		for (key, val) in conditions.items():
+			if getattr(x, key) != val:
+				return False
+		return True
+	return matches
+
+
+def measure(name, match, events, rounds):
+	start = time.perf_counter()
+	for _ in range(rounds):
+		passed = sum(1 for x in events if match(x))
+	elapsed = (time.perf_counter() - start) / rounds
+	print("%-30s %12.0f events/s %6.1f%% passed" % (name, len(events) / elapsed, 100.0 * passed / len(events)))
+
+
+def main():
+	argp = argparse.ArgumentParser()
+	argp.add_argument("-n", "--events", help="number of events", type=int, default=200000)
+	argp.add_argument("-r", "--rounds", help="measurements per case", type=int, default=5)
+	args = argp.parse_args()
+
+	for matching in (0.05, 0.5, 0.95):
+		print("%i%% matching events" % (matching * 100))
+		for name, filter_conf in sorted(FILTERS.items()):
+			events = make_events(args.events, matching, sorted(filter_conf))
+			if name == 'exact':
+				measure("  legacy exact", legacy_filter(filter_conf), events, args.rounds)
+			compiled = conn_filter.ConnFilter(filter_conf)
+			measure("  compiled %s (unprofiled)" % name, compiled.match, events, args.rounds)
+			compiled.observe(events)
+			measure("  compiled %s" % name, compiled.match, events, args.rounds)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Write throughput and point in time query latency of the history log.
+
+Random NEW/DESTROY events on nat_ips x ports are logged at a simulated rate, spread over
+segments of --segment-size bytes. Queries ask for random mappings at random times and are
+checked against the events kept in memory."""
+import argparse
+import bisect
+import collections
+import random
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from natconnd import conn_record  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import history  # noqa: E402 pylint: disable=wrong-import-position
+
+FLUSH_EVENTS = 100000
+
+
+def main():  # pylint: disable=too-many-locals
+	argp = argparse.ArgumentParser()
+	argp.add_argument("-n", "--events", help="number of logged events", type=int, default=2000000)
+	argp.add_argument("--nat-ips", help="number of NAT IPs", type=int, default=4)
+	argp.add_argument("--rate", help="simulated events per second", type=float, default=2000)
+	argp.add_argument("--segment-size", help="segment size in bytes", type=int, default=16 * 1024 * 1024)
+	argp.add_argument("-q", "--queries", help="number of queries", type=int, default=10000)
+	argp.add_argument("-d", "--dir", help="directory of the log, a temporary one is removed afterwards", default=None)
+	args = argp.parse_args()
+
+	path = args.dir or tempfile.mkdtemp(prefix='natconnd-history-')
+	try:
+		log = history.HistoryLog(path, segment_size=args.segment_size, segment_age=float('inf'))
+		nat_ips = [0x64400201 + i for i in range(args.nat_ips)]
+		open_connections = {}
+		events = collections.defaultdict(list)
+		start_time = time.time() - args.events / args.rate
+		start = time.perf_counter()
+		for i in range(args.events):
+			logged = start_time + i / args.rate
+			key = (random.choice(nat_ips), random.randint(1024, 65535), socket.IPPROTO_TCP if random.random() < 0.8 else socket.IPPROTO_UDP)
+			record = open_connections.pop(key, None)
+			if record is None:
+				record = conn_record.ConnRecord(
+					socket.AF_INET, key[2], conn_record.SIG_NEW, 0x0a000000 + random.randint(0, 0xffffff), random.randint(1024, 65535),
+					0xc6336401, 443, key[0], key[1], int(logged))
+				open_connections[key] = record
+			else:
+				record = conn_record.ConnRecord(
+					record.family, record.protocol, conn_record.SIG_DESTROY, record.src_ip, record.src_port, record.dst_ip,
+					record.dst_port, record.nat_ip, record.nat_port, int(logged))
+			events[key].append((logged, record.sig_type, record.src_ip))
+			log.append(record, logged)
+			if len(log.pending) >= FLUSH_EVENTS:
+				log.flush()
+		log.close()
+		elapsed = time.perf_counter() - start
+		print("logged %i events in %i segments (%.1f MB) at %.0f events/s" % (len(log), len(log.segments), log.size() / 1e6, args.events / elapsed))
+
+		keys = list(events)
+		latencies = []
+		errors = 0
+		found = 0
+		for _ in range(args.queries):
+			key = random.choice(keys)
+			when = start_time + random.random() * args.events / args.rate
+			t = time.perf_counter()
+			result = log.lookup(key[0], key[1], key[2], when)
+			latencies.append(time.perf_counter() - t)
+			times = [e[0] for e in events[key]]
+			pos = bisect.bisect_right(times, when) - 1
+			expected = events[key][pos][2] if pos >= 0 and events[key][pos][1] == conn_record.SIG_NEW else None
+			if result is not None:
+				found += 1
+			if (result[0].src_ip if result is not None else None) != expected:
+				errors += 1
+		latencies.sort()
+		print("%i queries, %i found, %i wrong: p50 %.3fms p99 %.3fms max %.3fms" % (
+			len(latencies), found, errors, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000))
+	finally:
+		if args.dir is None:
+			shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+	main()
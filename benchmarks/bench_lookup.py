@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Lookup latency through the falcon routes: old deepcopy + indented json.dumps handler
+vs. GetConnDetails serving the payload pre-encoded on insert. Needs falcon."""
+import argparse
+import copy
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+import falcon
+from falcon import testing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from natconnd import conn_record  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import conn_table  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import http_server  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import ip_acl  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import metrics  # noqa: E402 pylint: disable=wrong-import-position
+
+
+class OldGetConnDetails(object):  # pylint:disable=too-few-public-methods
+	"""Handler as it was before: lock, deepcopy of the dict entry, indented JSON"""
+	def __init__(self, table, lock):
+		self.table = table
+		self.lock = lock
+
+	def on_get(self, req, resp, key_value, key_name):  # pylint:disable=unused-argument
+		with self.lock:
+			x = copy.deepcopy(self.table[int(key_value)]) if int(key_value) in self.table else None
+		if not x:
+			resp.status = falcon.HTTP_404
+		else:
+			resp.body = json.dumps(x, sort_keys=True, indent=4)
+			resp.content_type = "application/json"
+			resp.status = falcon.HTTP_200
+
+
+def make_resources(entries, preserialize):
+	table = conn_table.ConnTable(['nat_port'], preserialize=preserialize)
+	now = int(time.time())
+	for port in range(1024, 1024 + entries):
+		table.insert(conn_record.ConnRecord(socket.AF_INET, socket.IPPROTO_TCP, conn_record.SIG_NEW, 0x0a000001 + port, 40000, 0xc6336401, 443, 0x64400201, port, now))
+	stats = metrics.Registry()
+	conf = {'data': {'key_name': 'nat_port'}, 'http_server': {'ip_acl': ['127.0.0.1']}}
+	return {'data': table, 'statistics': stats, 'conf': conf, 'lock': threading.Lock(), 'acl': ip_acl.IPACL(['127.0.0.1'])}
+
+
+def measure(name, resource, ports):
+	app = falcon.API()
+	app.add_route('/{key_name}/{key_value}', resource)
+	client = testing.TestClient(app)
+	latencies = []
+	for port in ports:
+		start = time.perf_counter()
+		result = client.simulate_get('/nat_port/%i' % port, remote_addr='127.0.0.1')
+		latencies.append(time.perf_counter() - start)
+		assert result.status_code == 200
+	latencies.sort()
+	pct = lambda p: latencies[int(len(latencies) * p)] * 1e6
+	print("%-34s p50 %7.1f us  p99 %7.1f us  mean %7.1f us" % (name, pct(0.5), pct(0.99), sum(latencies) / len(latencies) * 1e6))
+
+
+def main():
+	argp = argparse.ArgumentParser()
+	argp.add_argument("-n", "--lookups", help="number of lookups per variant", type=int, default=20000)
+	argp.add_argument("-e", "--entries", help="table entries", type=int, default=50000)
+	args = argp.parse_args()
+	ports = [random.randint(1024, 1023 + args.entries) for _ in range(args.lookups)]
+
+	old_table = dict((port, record.to_dict()) for (_, _, port), record in make_resources(args.entries, False)['data'].items())
+	measure("old: deepcopy + indented dumps", OldGetConnDetails(old_table, threading.Lock()), ports)
+	measure("GetConnDetails, encode per lookup", http_server.GetConnDetails(make_resources(args.entries, False)), ports)
+	measure("GetConnDetails, pre-encoded", http_server.GetConnDetails(make_resources(args.entries, True)), ports)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Memory used by the connection table: old dict-per-entry layout vs. ConnRecord.
+
+Entries are built the way the decoders create them (fresh strings per event for the dict layout),
+memory is measured with tracemalloc."""
+import argparse
+import gc
+import os
+import random
+import socket
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from natconnd import conn_record  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def random_ips(count):
+	return [random.randint(0x0a000000, 0x0affffff) for _ in range(count)]
+
+
+def make_dicts(count, src_ips, now):
+	table = dict()
+	for i in range(count):
+		table[i] = {'src_ip': socket.inet_ntoa(src_ips[i].to_bytes(4, 'big')), 'src_port': 1024 + i % 60000,
+					'dst_ip': socket.inet_ntoa((0xc6336401).to_bytes(4, 'big')), 'dst_port': 443,
+					'nat_ip': socket.inet_ntoa((0x64400201).to_bytes(4, 'big')), 'nat_port': i,
+					'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)),
+					'sig_type': 'new', 'protocol': ('ipv4', 'tcp')}
+	return table
+
+
+def make_records(count, src_ips, now):
+	table = dict()
+	for i in range(count):
+		table[i] = conn_record.ConnRecord(
+			socket.AF_INET, socket.IPPROTO_TCP, conn_record.SIG_NEW,
+			src_ips[i], 1024 + i % 60000, 0xc6336401, 443, 0x64400201, i, now)
+	return table
+
+
+def measure(name, func, *args):
+	gc.collect()
+	tracemalloc.start()
+	start = time.time()
+	table = func(*args)
+	elapsed = time.time() - start
+	current, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	print("%-12s %10.1f MB  %6.1f bytes/entry  built in %.2fs" % (name, current / 1048576.0, float(current) / len(table), elapsed))
+	del table
+	return current
+
+
+def main():
+	argp = argparse.ArgumentParser()
+	argp.add_argument("-n", "--entries", help="number of table entries", type=int, default=1000000)
+	args = argp.parse_args()
+
+	src_ips = random_ips(args.entries)
+	now = int(time.time())
+	old = measure("dict", make_dicts, args.entries, src_ips, now)
+	new = measure("ConnRecord", make_records, args.entries, src_ips, now)
+	print("ConnRecord uses %.1f%% of the dict layout" % (100.0 * new / old))
+
+
+if __name__ == '__main__':
+	main()
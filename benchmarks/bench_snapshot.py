@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Time to write and load a connection table snapshot.
+
+Loading is measured twice: decoding the records only, and filling a ConnTable
+with the same indexes the daemon uses."""
+import argparse
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from natconnd import conn_record  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import conn_table  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import snapshot  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def make_table(count, indexes, preserialize):
+	table = conn_table.ConnTable(indexes, preserialize=preserialize)
+	now = int(time.time())
+	for i in range(count):
+		table.insert(conn_record.ConnRecord(
+			socket.AF_INET, random.choice((socket.IPPROTO_TCP, socket.IPPROTO_UDP)), conn_record.SIG_NEW,
+			random.randint(0x0a000000, 0x0affffff), 1024 + i % 60000, 0xc6336401, 443, 0x64400201 + i // 60000, 1024 + i % 60000, now))
+	return table
+
+
+def timed(name, func, *args):
+	start = time.monotonic()
+	result = func(*args)
+	print("%-34s %8.3f s" % (name, time.monotonic() - start))
+	return result
+
+
+def main():
+	argp = argparse.ArgumentParser()
+	argp.add_argument("-n", "--entries", help="number of table entries", type=int, default=1000000)
+	argp.add_argument("-i", "--indexes", help="indexes of the table, comma separated", default='nat_port')
+	args = argp.parse_args()
+	indexes = args.indexes.split(',')
+
+	table = make_table(args.entries, indexes, False)
+	path = os.path.join(tempfile.mkdtemp(prefix='natconnd-snapshot-'), 'table.snap')
+	count = timed("write %i entries" % len(table), snapshot.save, path, table, threading.Lock())
+	print("%-34s %8.1f MB" % ("snapshot size", os.path.getsize(path) / 1048576.0))
+	del table
+
+	decoded = timed("decode only", lambda: sum(1 for _ in snapshot.read(path, 3600)))
+	assert decoded == count, (decoded, count)
+	table = conn_table.ConnTable(indexes, preserialize=True)
+	loaded = timed("load into table", snapshot.load, path, table, 3600)
+	assert loaded == count, (loaded, count)
+	assert list(table.expiry.values()) == sorted(table.expiry.values())
+	os.unlink(path)
+	os.rmdir(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+	main()
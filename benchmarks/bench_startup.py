@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Compare NFCT binding startup cost: ffi.verify() at runtime vs. the prebuilt natconnd._nfct module.
+
+Run from the source tree after 'python setup.py build_ext --inplace'.
+Each variant is measured in a fresh interpreter, so import and compile/cache costs are included."""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+
+VERIFY_SNIPPET = '''
+import time
+t = time.time()
+from cffi import FFI
+from natconnd import nfct_build
+ffi = FFI()
+ffi.cdef(nfct_build.CDEF)
+ffi.verify(nfct_build.INCLUDES, libraries=nfct_build.LIBRARIES, tmpdir=%r)
+print(time.time() - t)
+'''
+
+PREBUILT_SNIPPET = '''
+import time
+t = time.time()
+from natconnd import nfct_cffi
+nfct_cffi.NFCT()
+print(time.time() - t)
+'''
+
+
+def run(snippet, rounds):
+	results = []
+	for _ in range(rounds):
+		out = subprocess.check_output([sys.executable, '-c', snippet], cwd=os.path.join(os.path.dirname(__file__), '..'))
+		results.append(float(out.decode().strip().splitlines()[-1]))
+	return results
+
+
+def report(name, results):
+	results = sorted(results)
+	print("%-28s min %8.2f ms  median %8.2f ms  max %8.2f ms" % (name, results[0] * 1000, results[len(results) // 2] * 1000, results[-1] * 1000))
+
+
+def main():
+	argp = argparse.ArgumentParser()
+	argp.add_argument("-r", "--rounds", help="number of interpreter starts per variant", type=int, default=5)
+	args = argp.parse_args()
+
+	tmpdir = tempfile.mkdtemp(prefix='natconnd-verify-')
+	# First verify() run compiles, subsequent runs hit the verifier cache in tmpdir
+	report("verify (cold, compiling)", run(VERIFY_SNIPPET % tmpdir, 1))
+	report("verify (warm cache)", run(VERIFY_SNIPPET % tmpdir, args.rounds))
+	report("prebuilt natconnd._nfct", run(PREBUILT_SNIPPET, args.rounds))
+	start = timeit.default_timer()
+	subprocess.check_call([sys.executable, '-c', 'pass'])
+	print("%-28s %8.2f ms" % ("bare interpreter start", (timeit.default_timer() - start) * 1000))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""End-to-end benchmarks on the fake event source, no root or conntrack table needed.
+
+events   - synthetic events/s through QueueWorker, the event queue and NetFilter into the table
+lookups  - p50/p99 lookup latency through the HTTP server, idle and during an event storm
+gc       - garbage collector pause and duration expiring the whole table
+memory   - memory per table entry (tracemalloc)
+
+The HTTP clients run in the benchmark process, so lookup latency includes their share of the GIL."""
+import argparse
+import http.client
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from natconnd import batch_queue  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import conn_record  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import conn_table  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import event_source  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import garbage_collection  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import http_server  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import ip_acl  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import metrics  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import net_filter  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import nfct_logger  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import pynatconnd_config  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import queue_worker  # noqa: E402 pylint: disable=wrong-import-position
+
+CONFIG = """
+[filter]
+dst_port = 443
+nat_port = 1024-65535
+
+[data]
+key_name = nat_port
+%(indexes)s
+
+[nfct]
+source = fake
+
+[fake]
+events = %(events)i
+connections = %(connections)i
+update_ratio = %(update_ratio)s
+udp_ratio = 0.1
+nat_ip = 100.64.2.1, 100.64.2.2
+seed = 1
+
+[http_server]
+host = 127.0.0.1
+port = %(port)i
+engine = %(engine)s
+ip_acl = 127.0.0.1,
+"""
+
+# nat_ip of the storm source, so its connections do not replace the looked up ones
+STORM_NAT_IP = '100.64.3.1'
+
+
+def free_port():
+	sock = socket.socket()
+	sock.bind(('127.0.0.1', 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return port
+
+
+def load_config(args):
+	with tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False) as f:
+		f.write(CONFIG % dict(
+			events=args.events, connections=args.connections, update_ratio=args.update_ratio, port=free_port(),
+			engine=args.engine, indexes='indexes = %s' % args.indexes if args.indexes else ''))
+	try:
+		return pynatconnd_config.PynatconndConfig(f.name).get_configobj()
+	finally:
+		os.unlink(f.name)
+
+
+def make_resources(config):
+	statistics = metrics.Registry()
+	return {
+		'data': conn_table.ConnTable(set([config['data']['key_name']] + list(config['data']['indexes'])), preserialize=config['data']['preserialize']),
+		'statistics': statistics, 'lock': threading.Lock(), 'conf': config, 'acl': ip_acl.IPACL(config['http_server']['ip_acl']),
+		'threads': [], 'warm_start': threading.Event(),
+		'queue': batch_queue.BatchQueue(statistics, maxsize=config['nfct']['queue_size'], policy=config['nfct']['queue_policy'])}
+
+
+def percentile(values, p):
+	return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def bench_source(config):
+	"""Events/s of the fake source and parsing alone"""
+	source = event_source.FakeSource(config['fake'])
+	src = source.generator(batch_size=config['nfct']['batch_size'])
+	next(src)
+	start = time.perf_counter()
+	count = 0
+	for batch in src:
+		count += len([r for r in (nfct_logger.parse_record(x) for x in batch) if r])
+	return count / (time.perf_counter() - start)
+
+
+def bench_events(resources):
+	"""Events/s from the fake source into the table, until NetFilter added every NEW event"""
+	source = event_source.FakeSource(resources['conf']['fake'])
+	worker = queue_worker.QueueWorker(resources['queue'], resources, source=source)
+	filter_thread = net_filter.NetFilter(resources['queue'], resources)
+	resources['threads'].extend([filter_thread, filter_thread.delete_scheduler])
+	for thread in resources['threads']:
+		thread.start()
+	start = time.perf_counter()
+	worker.start()
+	worker.join()
+	while resources['statistics'].value('natconnd_connections_created_total') < source.generated[conn_record.SIG_NEW]:
+		time.sleep(0.001)
+	elapsed = time.perf_counter() - start
+	return dict(
+		events=sum(source.generated.values()), seconds=elapsed, events_per_second=sum(source.generated.values()) / elapsed,
+		table_entries=len(resources['data']), queue_high_water=resources['statistics'].value('natconnd_queue_high_water_events'))
+
+
+def lookup_client(port, keys, keepalive, latencies):
+	conn = None
+	for key in keys:
+		start = time.perf_counter()
+		if conn is None:
+			conn = http.client.HTTPConnection('127.0.0.1', port)
+		conn.request('GET', '/nat_port/%i' % key)
+		resp = conn.getresponse()
+		resp.read()
+		if resp.status not in (200, 404):
+			raise RuntimeError("Lookup of %i failed with status %i" % (key, resp.status))
+		if not keepalive:
+			conn.close()
+			conn = None
+		latencies.append(time.perf_counter() - start)
+	if conn is not None:
+		conn.close()
+
+
+def bench_lookups(resources, args):
+	"""Lookup latency percentiles with args.clients concurrent clients"""
+	keys = [key[2] for key in list(resources['data'].snapshot().keys())[:args.lookups]]
+	if not keys:
+		raise RuntimeError("The table is empty, nothing to look up")
+	keys = (keys * (args.lookups // len(keys) + 1))[:args.lookups]
+	keepalive = resources['conf']['http_server']['engine'] == 'asyncio'
+	latencies = []
+	clients = [threading.Thread(target=lookup_client, args=(resources['conf']['http_server']['port'], keys[i::args.clients], keepalive, latencies)) for i in range(args.clients)]
+	start = time.perf_counter()
+	for client in clients:
+		client.start()
+	for client in clients:
+		client.join()
+	elapsed = time.perf_counter() - start
+	latencies.sort()
+	return dict(lookups=len(latencies), lookups_per_second=len(latencies) / elapsed, p50_ms=percentile(latencies, 0.5) * 1000, p99_ms=percentile(latencies, 0.99) * 1000)
+
+
+def start_storm(resources, rate):
+	"""Second source of unlimited events at rate (0 as fast as possible), stopped with stop()"""
+	fake_conf = dict(resources['conf']['fake'])
+	fake_conf.update(rate=rate, events=0, nat_ip=[STORM_NAT_IP], seed=2)
+	worker = queue_worker.QueueWorker(resources['queue'], resources, source=event_source.FakeSource(fake_conf))
+	worker.start()
+	return worker
+
+
+def bench_gc(resources):
+	"""Expire the whole table in one garbage collector run"""
+	resources['conf']['data']['life_span'] = 0.0
+	collector = garbage_collection.GarbageCollectorThread(resources)
+	collector.running = True
+	entries = len(resources['data'])
+	collector.collect()
+	stats = resources['statistics']
+	return dict(
+		entries=entries, expired=stats.value('natconnd_gc_last_expired'), duration_s=stats.value('natconnd_gc_last_duration_seconds'),
+		max_pause_ms=stats.value('natconnd_gc_max_pause_seconds') * 1000)
+
+
+def bench_memory(config, entries):
+	"""Bytes allocated per entry inserting entries NEW events into an empty table"""
+	fake_conf = dict(config['fake'])
+	fake_conf.update(events=entries, connections=entries, update_ratio=0.0)
+	src = event_source.FakeSource(fake_conf).generator(batch_size=1024)
+	next(src)
+	events = [x for batch in src for x in batch]
+	table = conn_table.ConnTable(set([config['data']['key_name']] + list(config['data']['indexes'])), preserialize=config['data']['preserialize'])
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	for x in events:
+		table.insert(nfct_logger.parse_record(x))
+	used = tracemalloc.get_traced_memory()[0] - before
+	tracemalloc.stop()
+	return dict(entries=len(table), bytes_per_entry=used / len(table))
+
+
+def main():
+	argp = argparse.ArgumentParser()
+	argp.add_argument("-n", "--events", help="events generated for the throughput run", type=int, default=500000)
+	argp.add_argument("--connections", help="connections kept open by the fake source", type=int, default=50000)
+	argp.add_argument("--update-ratio", help="share of UPDATE events", type=float, default=0.2)
+	argp.add_argument("--indexes", help="additional indexes, e.g. src_ip,dst", default='')
+	argp.add_argument("--engine", help="HTTP server engine", choices=('wsgiref', 'asyncio'), default='asyncio')
+	argp.add_argument("--clients", help="concurrent HTTP clients", type=int, default=4)
+	argp.add_argument("--lookups", help="lookups per latency run", type=int, default=5000)
+	argp.add_argument("--rate", help="events/s of the storm during lookups, 0 for unlimited", type=float, default=0)
+	argp.add_argument("--json", help="print the results as JSON", action='store_true')
+	args = argp.parse_args()
+
+	config = load_config(args)
+	results = dict(source_events_per_second=bench_source(config))
+	resources = make_resources(config)
+	results['events'] = bench_events(resources)
+
+	http_thread = http_server.HTTPServer(resources, host=dict(ip=config['http_server']['host'], port=config['http_server']['port']))
+	http_thread.start()
+	# Wait for the listening socket
+	for _ in range(100):
+		try:
+			socket.create_connection(('127.0.0.1', config['http_server']['port']), timeout=1).close()
+			break
+		except OSError:
+			time.sleep(0.05)
+	results['lookups_idle'] = bench_lookups(resources, args)
+	storm = start_storm(resources, args.rate)
+	received = resources['statistics'].value('natconnd_events_received_total')
+	start = time.perf_counter()
+	results['lookups_storm'] = bench_lookups(resources, args)
+	results['lookups_storm']['storm_events_per_second'] = (resources['statistics'].value('natconnd_events_received_total') - received) / (time.perf_counter() - start)
+	storm.stop()
+	storm.join()
+	http_thread.stop()
+	for thread in reversed(resources['threads']):
+		thread.stop()
+	for thread in resources['threads']:
+		thread.join()
+
+	results['gc'] = bench_gc(resources)
+	results['memory'] = bench_memory(config, args.connections)
+
+	if args.json:
+		print(json.dumps(results, indent=4, sort_keys=True))
+		return
+	print("fake source + parsing     %12.0f events/s" % results['source_events_per_second'])
+	print("QueueWorker -> NetFilter  %12.0f events/s (%i events, %i entries, queue high water %i)" % (
+		results['events']['events_per_second'], results['events']['events'], results['events']['table_entries'], results['events']['queue_high_water']))
+	for name in ('idle', 'storm'):
+		r = results['lookups_' + name]
+		print("lookups %-17s %12.0f lookups/s p50 %.3fms p99 %.3fms" % ('(%s, %s)' % (args.engine, name), r['lookups_per_second'], r['p50_ms'], r['p99_ms']))
+	print("storm during lookups      %12.0f events/s" % results['lookups_storm']['storm_events_per_second'])
+	print("gc expiring %-13i %12.3fs max pause %.3fms" % (results['gc']['expired'], results['gc']['duration_s'], results['gc']['max_pause_ms']))
+	print("memory                    %12.0f bytes/entry" % results['memory']['bytes_per_entry'])
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Lookup throughput of the shared memory table with 1..N reader processes.
+
+Every reader attaches to the segment by name and looks up random keys for a fixed
+time, the writer keeps replacing entries meanwhile unless --no-writes is given."""
+import argparse
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from natconnd import conn_record  # noqa: E402 pylint: disable=wrong-import-position
+from natconnd import shm_table  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def make_record(port, now):
+	return conn_record.ConnRecord(
+		socket.AF_INET, socket.IPPROTO_TCP, conn_record.SIG_NEW, random.randint(0x0a000000, 0x0affffff), port,
+		0xc6336401, 443, 0x64400201, port, now)
+
+
+def reader(name, entries, duration, results):
+	table = shm_table.SharedTable('nat_port', name=name)
+	keys = [random.randint(1024, 1024 + entries - 1) for _ in range(10000)]
+	lookups = 0
+	found = 0
+	end = time.monotonic() + duration
+	while time.monotonic() < end:
+		for key in keys:
+			found += len(table.lookup('nat_port', key))
+		lookups += len(keys)
+	results.put((lookups, found))
+
+
+def run(name, processes, entries, duration, table, writes):
+	context = multiprocessing.get_context('spawn')
+	results = context.Queue()
+	readers = [context.Process(target=reader, args=(name, entries, duration, results)) for _ in range(processes)]
+	for process in readers:
+		process.start()
+	replaced = 0
+	now = int(time.time())
+	while any(process.is_alive() for process in readers) and results.qsize() < processes:
+		if writes:
+			port = random.randint(1024, 1024 + entries - 1)
+			table.insert((socket.IPPROTO_TCP, 0x64400201, port), make_record(port, now))
+			replaced += 1
+		else:
+			time.sleep(0.01)
+	totals = [results.get() for _ in readers]
+	for process in readers:
+		process.join()
+	lookups = sum(t[0] for t in totals)
+	print("%2i readers %12.0f lookups/s %10i writes" % (processes, lookups / duration, replaced))
+
+
+def main():
+	argp = argparse.ArgumentParser()
+	argp.add_argument("-n", "--entries", help="number of table entries (at most 64000, one per port)", type=int, default=60000)
+	argp.add_argument("-p", "--processes", help="maximum number of reader processes", type=int, default=os.cpu_count())
+	argp.add_argument("-d", "--duration", help="seconds per run", type=float, default=3.0)
+	argp.add_argument("--no-writes", help="do not modify the table while reading", action="store_true")
+	args = argp.parse_args()
+
+	table = shm_table.SharedTable('nat_port', slots=args.entries * 2)
+	now = int(time.time())
+	for port in range(1024, 1024 + args.entries):
+		table.insert((socket.IPPROTO_TCP, 0x64400201, port), make_record(port, now))
+	try:
+		processes = 1
+		while processes <= args.processes:
+			run(table.name, processes, args.entries, args.duration, table, not args.no_writes)
+			processes *= 2
+	finally:
+		table.close(unlink=True)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Minimal asyncio HTTP/1.1 server running a WSGI application.
+Connections are kept alive and pipelined requests are answered in order on the same connection.
+Request bodies are read with Content-Length or chunked transfer encoding.
+
+The application is called directly in the event loop, so short requests (lookups) do not pay
+for a thread switch. Requests for paths starting with one of offload (e.g. a dump of the whole
+table) are run and their response iterated in a thread pool, so they do not stall the other
+connections."""
+import asyncio
+import concurrent.futures
+import io
+import sys
+import logging
+from urllib.parse import unquote
+
+try:
+	import cygnuslog  # pylint: disable=unused-import
+except ImportError:
+	pass
+
+log = logging.getLogger("cygnus.pynatconnd")
+
+MAX_REQUEST_LINE = 8192
+MAX_HEADERS = 100
+MAX_BODY = 10 * 1024 * 1024
+# Threads running the requests of offloaded paths
+OFFLOAD_THREADS = 4
+
+
+class BadRequest(Exception):
+	"""Answered with status and the connection closed"""
+	def __init__(self, message, status='400 Bad Request'):
+		Exception.__init__(self, message)
+		self.status = status
+
+
+class AsyncWSGIServer(object):  # pylint:disable=too-many-instance-attributes
+	"""Serves app on host:port, binding the socket on creation like wsgiref.simple_server.make_server"""
+	def __init__(self, host, port, app, keepalive_timeout=60.0, reuse_port=False, sock=None, offload=()):  # pylint:disable=too-many-arguments
+		self.app = app
+		self.host = host
+		self.port = port
+		self.keepalive_timeout = keepalive_timeout
+		self.offload = tuple(offload)
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=OFFLOAD_THREADS, thread_name_prefix='HTTPOffload') if self.offload else None
+		self.loop = asyncio.new_event_loop()
+		# Tasks of the open connections, cancelled on shutdown
+		self.connections = set()
+		if sock is not None:
+			coro = asyncio.start_server(self.handle_connection, sock=sock, limit=MAX_REQUEST_LINE)
+		else:
+			coro = asyncio.start_server(self.handle_connection, host, port, reuse_port=reuse_port or None, limit=MAX_REQUEST_LINE)
+		self.server = self.loop.run_until_complete(coro)
+
+	def serve_forever(self):
+		asyncio.set_event_loop(self.loop)
+		try:
+			self.loop.run_forever()
+		finally:
+			self.server.close()
+			# Keep-alive connections wait for their next request, they have to end before the loop is closed
+			for task in self.connections:
+				task.cancel()
+			if self.connections:
+				self.loop.run_until_complete(asyncio.gather(*self.connections, return_exceptions=True))
+			self.loop.run_until_complete(self.server.wait_closed())
+			self.loop.close()
+			if self.executor is not None:
+				self.executor.shutdown(wait=False)
+
+	def shutdown(self):
+		self.loop.call_soon_threadsafe(self.loop.stop)
+
+	async def read_request(self, reader):
+		"""Returns (method, target, version, headers, body) or None if the client closed the connection.
+		The request line has to arrive within keepalive_timeout, the rest of the request within
+		keepalive_timeout after it, otherwise asyncio.TimeoutError is raised."""
+		request_line = b'\r\n'
+		while request_line in (b'\r\n', b'\n'):  # tolerate empty lines between requests
+			request_line = await asyncio.wait_for(reader.readline(), self.keepalive_timeout)
+			if not request_line:
+				return None
+		deadline = self.loop.time() + self.keepalive_timeout
+
+		def remaining():
+			return max(deadline - self.loop.time(), 0)
+		try:
+			method, target, version = request_line.decode('latin-1').split()
+		except ValueError:
+			raise BadRequest("Invalid request line %r" % request_line)
+
+		headers = []
+		while True:
+			line = await asyncio.wait_for(reader.readline(), remaining())
+			if line in (b'\r\n', b'\n', b''):
+				break
+			if len(headers) >= MAX_HEADERS:
+				raise BadRequest("Too many headers")
+			name, sep, value = line.decode('latin-1').partition(':')
+			if not sep:
+				raise BadRequest("Invalid header line %r" % line)
+			headers.append((name.strip().lower(), value.strip()))
+
+		body = b''
+		fields = dict(headers)
+		encoding = fields.get('transfer-encoding')
+		length = fields.get('content-length')
+		if encoding is not None:
+			if encoding.lower() != 'chunked':
+				raise BadRequest("Unsupported transfer encoding %s" % encoding, '501 Not Implemented')
+			body = await asyncio.wait_for(self.read_chunked(reader), remaining())
+			# The application reads the decoded body with its length
+			headers = [(name, value) for name, value in headers if name not in ('transfer-encoding', 'content-length')]
+			headers.append(('content-length', str(len(body))))
+		elif length:
+			if not length.isdigit() or int(length) > MAX_BODY:
+				raise BadRequest("Invalid content length %s" % length)
+			body = await asyncio.wait_for(reader.readexactly(int(length)), remaining())
+		return method, target, version, headers, body
+
+	@staticmethod
+	async def read_chunked(reader):
+		"""Body sent with chunked transfer encoding, trailers are read and dropped"""
+		chunks = []
+		size = 0
+		while True:
+			line = await reader.readline()
+			try:
+				length = int(line.split(b';', 1)[0].strip(), 16)
+			except ValueError:
+				raise BadRequest("Invalid chunk size line %r" % line)
+			if length == 0:
+				break
+			size += length
+			if length < 0 or size > MAX_BODY:
+				raise BadRequest("Chunked body larger than %i bytes" % MAX_BODY)
+			chunk = await reader.readexactly(length + 2)
+			if chunk[-2:] != b'\r\n':
+				raise BadRequest("Chunk of %i bytes not followed by CRLF" % length)
+			chunks.append(chunk[:-2])
+		for _ in range(MAX_HEADERS + 1):
+			line = await reader.readline()
+			if line in (b'\r\n', b'\n', b''):
+				return b''.join(chunks)
+		raise BadRequest("Too many trailers")
+
+	def make_environ(self, request, peer):
+		method, target, version, headers, body = request
+		path, _, query = target.partition('?')
+		environ = {
+			'REQUEST_METHOD': method,
+			'SCRIPT_NAME': '',
+			'PATH_INFO': unquote(path, encoding='latin-1'),
+			'QUERY_STRING': query,
+			'SERVER_NAME': self.host,
+			'SERVER_PORT': str(self.port),
+			'SERVER_PROTOCOL': version,
+			'REMOTE_ADDR': peer[0] if peer else '',
+			'wsgi.version': (1, 0),
+			'wsgi.url_scheme': 'http',
+			'wsgi.input': io.BytesIO(body),
+			'wsgi.errors': sys.stderr,
+			'wsgi.multithread': False,
+			'wsgi.multiprocess': False,
+			'wsgi.run_once': False,
+		}
+		for name, value in headers:
+			if name == 'content-length':
+				environ['CONTENT_LENGTH'] = value
+			elif name == 'content-type':
+				environ['CONTENT_TYPE'] = value
+			else:
+				key = 'HTTP_' + name.upper().replace('-', '_')
+				environ[key] = environ[key] + ',' + value if key in environ else value
+		return environ
+
+	def call_app(self, environ):
+		"""Returns status, headers and the response body iterable of the WSGI application"""
+		response = []
+
+		def start_response(status, headers, exc_info=None):  # pylint:disable=unused-argument
+			response[:] = [status, headers]
+
+		try:
+			result = self.app(environ, start_response)
+		except Exception as e:  # pylint:disable=broad-except
+			log.error("Exception in WSGI application for %s with message %s", environ['PATH_INFO'], e, exc_info=True)
+			return '500 Internal Server Error', [('Content-Type', 'text/plain')], [b'Internal server error']
+		return response[0], response[1], result
+
+	async def handle_connection(self, reader, writer):  # pylint:disable=too-many-branches,too-many-statements
+		peer = writer.get_extra_info('peername')
+		task = asyncio.current_task()
+		self.connections.add(task)
+		try:
+			while True:
+				try:
+					request = await self.read_request(reader)
+				except BadRequest as e:
+					log.debug("Bad request from %s: %s", peer, e, level=4)
+					writer.write(('HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % e.status).encode('latin-1'))
+					break
+				if request is None:
+					break
+				method, target, version = request[:3]
+				connection = dict(request[3]).get('connection', '').lower()
+				keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+				# HEAD responses have the headers of GET but no body
+				send_body = method != 'HEAD'
+				offload = self.executor is not None and target.startswith(self.offload)
+
+				environ = self.make_environ(request, peer)
+				if offload:
+					status, headers, result = await self.loop.run_in_executor(self.executor, self.call_app, environ)
+				else:
+					status, headers, result = self.call_app(environ)
+				has_length = any(name.lower() == 'content-length' for name, _ in headers)
+				chunked = send_body and not has_length and version != 'HTTP/1.0'
+				if send_body and not has_length and not chunked:
+					keep_alive = False
+				head = ['%s %s' % ('HTTP/1.1', status)]
+				head.extend('%s: %s' % header for header in headers)
+				if chunked:
+					head.append('Transfer-Encoding: chunked')
+				head.append('Connection: %s' % ('keep-alive' if keep_alive else 'close'))
+				writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+				try:
+					if send_body:
+						iterator = iter(result)
+						while True:
+							if offload:
+								chunk = await self.loop.run_in_executor(self.executor, next, iterator, None)
+							else:
+								chunk = next(iterator, None)
+							if chunk is None:
+								break
+							if not chunk:
+								continue
+							if chunked:
+								writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+							else:
+								writer.write(chunk)
+							await writer.drain()
+						if chunked:
+							writer.write(b'0\r\n\r\n')
+				finally:
+					if hasattr(result, 'close'):
+						result.close()
+				log.debug("HTTP server request %s %s - status %s", method, target, status, level=4)
+				await writer.drain()
+				if not keep_alive:
+					break
+		except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, asyncio.LimitOverrunError, ValueError):
+			pass
+		except asyncio.CancelledError:
+			# Shutdown, ending normally keeps asyncio from logging the cancelled task
+			pass
+		finally:
+			self.connections.discard(task)
+			writer.close()
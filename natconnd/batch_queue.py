@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Bounded hand-off of event batches from QueueWorker to NetFilter.
+
+The bound counts events, not batches. What happens when a batch does not fit is decided by
+the policy: wait for NetFilter (block), drop the oldest queued events (drop_oldest) or drop
+queued UPDATE events first and the oldest events after that (drop_update, only with the fake
+source, the netlink socket is not subscribed to UPDATE events). Items that are not lists
+(Resync) are never dropped and never wait."""
+import collections
+import logging
+import threading
+import time
+
+try:
+	import cygnuslog  # pylint: disable=unused-import
+except ImportError:
+	pass
+
+from . import conn_record
+
+log = logging.getLogger('cygnus.pynatconnd')
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_UPDATE = 'drop_update'
+POLICIES = (BLOCK, DROP_OLDEST, DROP_UPDATE)
+
+# Seconds between warnings about dropped events
+WARNING_INTERVAL = 10.0
+
+
+class BatchQueue(object):
+	"""Queue of event batches holding at most maxsize events (0 for no limit)"""
+	def __init__(self, statistics, maxsize=0, policy=BLOCK):
+		assert policy in POLICIES, policy
+		self.maxsize = maxsize
+		self.policy = policy
+		self.batches = collections.deque()
+		self.events = 0
+		self.high_water = 0
+		self.closed = False
+		self.next_warning = 0.0
+		self.mutex = threading.Lock()
+		self.not_empty = threading.Condition(self.mutex)
+		self.not_full = threading.Condition(self.mutex)
+		statistics.gauge('natconnd_queue_depth', 'Event batches waiting for the NetFilter thread', func=self.qsize)
+		statistics.gauge('natconnd_queue_events', 'Events waiting for the NetFilter thread', func=lambda: self.events)
+		statistics.gauge('natconnd_queue_high_water_events', 'Most events waiting for the NetFilter thread since the start', func=lambda: self.high_water)
+		statistics.gauge('natconnd_queue_max_events', 'Events the queue holds before the overflow policy applies, 0 for no limit').set(maxsize)
+		self.blocked = statistics.counter('natconnd_queue_blocked_seconds_total', 'Time the QueueWorker waited for room in the full queue')
+		self.dropped = dict(
+			(sig_type, statistics.counter('natconnd_queue_dropped_events_total', 'Events dropped because the queue was full', {'sig_type': name}))
+			for sig_type, name in conn_record.SIG_TYPE_NAMES.items())
+		# sig_type 0 of events the XML decoder could not map
+		self.dropped_unknown = statistics.counter('natconnd_queue_dropped_events_total', 'Events dropped because the queue was full', {'sig_type': 'unknown'})
+
+	def qsize(self):
+		return len(self.batches)
+
+	def put(self, batch):
+		"""Queue batch, returns the number of events dropped to make room for it"""
+		with self.mutex:
+			if self.closed:
+				return 0
+			dropped = 0
+			if isinstance(batch, list) and self.maxsize and self.events + len(batch) > self.maxsize:
+				if self.policy == BLOCK:
+					self._wait_for_room(len(batch))
+					if self.closed:
+						return 0
+				else:
+					dropped = self._make_room(batch)
+			if isinstance(batch, list):
+				self.events += len(batch)
+				if self.events > self.high_water:
+					self.high_water = self.events
+			self.batches.append(batch)
+			self.not_empty.notify()
+		return dropped
+
+	def get(self):
+		"""Oldest queued item, waits if there is none. Returns None once the queue is closed and empty."""
+		with self.mutex:
+			while not self.batches and not self.closed:
+				self.not_empty.wait()
+			if not self.batches:
+				return None
+			batch = self.batches.popleft()
+			if isinstance(batch, list):
+				self.events -= len(batch)
+				self.not_full.notify()
+			return batch
+
+	def close(self):
+		"""Wake up both sides, get() returns the remaining items and None after that, put() discards"""
+		with self.mutex:
+			self.closed = True
+			self.not_empty.notify_all()
+			self.not_full.notify_all()
+
+	def _wait_for_room(self, count):
+		# A batch larger than maxsize is queued once the queue is empty
+		start = time.monotonic()
+		while not self.closed and self.events and self.events + count > self.maxsize:
+			self.not_full.wait()
+		self.blocked.inc(time.monotonic() - start)
+
+	def _make_room(self, batch):
+		excess = self.events + len(batch) - self.maxsize
+		queued = [b for b in self.batches if isinstance(b, list)]
+		dropped = 0
+		if self.policy == DROP_UPDATE:
+			for b in queued + [batch]:
+				if dropped >= excess:
+					break
+				kept = [x for x in b if x.sig_type != conn_record.SIG_UPDATE]
+				if len(kept) != len(b):
+					self.dropped[conn_record.SIG_UPDATE].inc(len(b) - len(kept))
+					dropped += len(b) - len(kept)
+					if b is not batch:
+						self.events -= len(b) - len(kept)
+					b[:] = kept
+		for b in queued + [batch]:
+			if dropped >= excess:
+				break
+			count = min(excess - dropped, len(b))
+			for x in b[:count]:
+				self.dropped.get(x.sig_type, self.dropped_unknown).inc()
+			del b[:count]
+			dropped += count
+			if b is not batch:
+				self.events -= count
+		# Batches emptied completely are left in place, NetFilter skips them
+		now = time.monotonic()
+		if now >= self.next_warning:
+			log.warning("Event queue is full with %i events, dropped %i events (%s policy)", self.maxsize, dropped, self.policy)
+			self.next_warning = now + WARNING_INTERVAL
+		return dropped
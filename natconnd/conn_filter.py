@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""[filter] conditions compiled into a single predicate over ConnRecord.
+
+Every filter key takes a comma separated list of terms, a term prefixed with ! excludes:
+
+	src_ip, nat_ip, dst_ip - address or network (10.0.0.0/8, 2001:db8::/32)
+	src_port, nat_port, dst_port - port or port range (1024-2047)
+	protocol - tcp or udp
+
+A field matches if one of its included terms matches (or it has none) and none of its excluded
+terms does, a record matches if all fields match. The conditions are turned into the source of
+one lambda comparing record attributes against integer constants. Fields are ordered by their
+estimated share of passing events and ordered again by the measured share after the first
+PROFILE_EVENTS events, so the field rejecting most events is checked first."""
+import bisect
+import ipaddress
+import logging
+import socket
+
+try:
+	import cygnuslog  # pylint: disable=unused-import
+except ImportError:
+	pass
+
+from . import conn_record
+
+log = logging.getLogger('cygnus.pynatconnd')
+
+FIELDS = ('protocol', ) + conn_record.PORT_FIELDS + conn_record.IP_FIELDS
+
+# Events checked field by field to measure how many pass each field
+PROFILE_EVENTS = 10000
+
+# Above this number of ranges a field is matched by bisection instead of comparisons
+MAX_INLINE_RANGES = 4
+
+_FAMILIES = {4: socket.AF_INET, 6: socket.AF_INET6}
+_ADDR_SPACE = {socket.AF_INET: float(1 << 32), socket.AF_INET6: float(1 << 128)}
+
+
+def parse_term(name, term):
+	"""Parsed value of a single term without negation: network for IP fields,
+	(low, high) for ports and IPPROTO_* number for protocol. Raises ValueError."""
+	if name in conn_record.IP_FIELDS:
+		return ipaddress.ip_network(term, strict=False)
+	if name in conn_record.PORT_FIELDS:
+		low, _, high = term.partition('-')
+		low, high = int(low), int(high or low)
+		if not 0 <= low <= high <= 65535:
+			raise ValueError("Invalid port range %s" % term)
+		return (low, high)
+	if name == 'protocol':
+		if term not in conn_record.L4PROTOS:
+			raise ValueError("Unknown protocol %s" % term)
+		return conn_record.L4PROTOS[term]
+	raise ValueError("Unknown filter %s" % name)
+
+
+def merge(ranges):
+	"""Sorted, non-overlapping list of the (low, high) ranges"""
+	merged = []
+	for low, high in sorted(ranges):
+		if merged and low <= merged[-1][1] + 1:
+			merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+		else:
+			merged.append((low, high))
+	return merged
+
+
+def in_ranges(starts, ends, value):
+	i = bisect.bisect_right(starts, value) - 1
+	return i >= 0 and value <= ends[i]
+
+
+class FieldFilter(object):
+	"""Included and excluded terms of one field"""
+	def __init__(self, name, terms):
+		self.name = name
+		self.include = []
+		self.exclude = []
+		for term in terms:
+			term = term.strip()
+			if term.startswith('!'):
+				self.exclude.append(parse_term(name, term[1:].strip()))
+			else:
+				self.include.append(parse_term(name, term))
+		self.passed = 0
+		self.test = None
+
+	def __repr__(self):
+		return "%s=%s" % (self.name, ','.join([str(t) for t in self.include] + ['!%s' % (t, ) for t in self.exclude]))
+
+	def ranges(self, terms):
+		"""{family: merged ranges} of terms, family is None for ports and protocol"""
+		by_family = dict()
+		for term in terms:
+			if self.name in conn_record.IP_FIELDS:
+				key = _FAMILIES[term.version]
+				value = (int(term.network_address), int(term.broadcast_address))
+			elif self.name in conn_record.PORT_FIELDS:
+				key, value = None, term
+			else:
+				key, value = None, (term, term)
+			by_family.setdefault(key, []).append(value)
+		return dict((family, merge(ranges)) for family, ranges in by_family.items())
+
+	def share(self, terms):
+		"""Estimated share of events matching any of terms, assuming evenly spread values"""
+		total = 0.0
+		for family, ranges in self.ranges(terms).items():
+			covered = sum(high - low + 1 for low, high in ranges)
+			if family is not None:
+				total += covered / _ADDR_SPACE[family]
+			elif self.name == 'protocol':
+				total += covered / float(len(conn_record.L4PROTO_NAMES))
+			else:
+				total += covered / 65536.0
+		return min(total, 1.0)
+
+	def estimate(self):
+		included = self.share(self.include) if self.include else 1.0
+		return included * (1.0 - self.share(self.exclude))
+
+	def expression(self, constants):
+		"""Python expression on record x, constants receives the names it uses"""
+		parts = []
+		if self.include:
+			parts.append('(%s)' % self._match_expression(self.include, constants))
+		if self.exclude:
+			parts.append('not (%s)' % self._match_expression(self.exclude, constants))
+		return ' and '.join(parts)
+
+	def _match_expression(self, terms, constants):
+		attr = 'x.%s' % self.name
+		alternatives = []
+		for family, ranges in sorted(self.ranges(terms).items(), key=lambda item: item[0] or 0):
+			expr = _ranges_expression(attr, ranges, constants)
+			if family is not None:
+				expr = 'x.family == %i and %s' % (family, expr)
+			alternatives.append(expr)
+		if len(alternatives) == 1:
+			return alternatives[0]
+		return ' or '.join('(%s)' % expr for expr in alternatives)
+
+
+def _ranges_expression(attr, ranges, constants):
+	if all(low == high for low, high in ranges):
+		if len(ranges) == 1:
+			return '%s == %i' % (attr, ranges[0][0])
+		name = '_c%i' % len(constants)
+		constants[name] = frozenset(low for low, _ in ranges)
+		return '%s in %s' % (attr, name)
+	if len(ranges) <= MAX_INLINE_RANGES:
+		checks = [('%s == %i' % (attr, low)) if low == high else ('%i <= %s <= %i' % (low, attr, high)) for low, high in ranges]
+		return checks[0] if len(checks) == 1 else '(%s)' % ' or '.join(checks)
+	starts = '_c%i' % len(constants)
+	constants[starts] = [low for low, _ in ranges]
+	ends = '_c%i' % len(constants)
+	constants[ends] = [high for _, high in ranges]
+	return '_in_ranges(%s, %s, %s)' % (starts, ends, attr)
+
+
+def parse(filter_conf):
+	"""FieldFilters of the [filter] section (values are lists of terms or None). Raises ValueError."""
+	fields = []
+	for name in FIELDS:
+		terms = filter_conf.get(name)
+		if terms:
+			if isinstance(terms, str):
+				terms = [terms]
+			fields.append(FieldFilter(name, terms))
+	return fields
+
+
+def compile_fields(fields):
+	"""Returns (predicate, source) checking fields in the given order"""
+	constants = {'_in_ranges': in_ranges}
+	checks = ['(%s)' % field.expression(constants) for field in fields]
+	source = 'lambda x: %s' % (' and '.join(checks) or 'True')
+	return eval(compile(source, '<conn_filter>', 'eval'), constants), source  # pylint: disable=eval-used
+
+
+class ConnFilter(object):
+	"""Compiled [filter] section, match(record) returns whether the record passes"""
+	def __init__(self, filter_conf, profile_events=PROFILE_EVENTS):
+		self.fields = sorted(parse(filter_conf), key=lambda f: f.estimate())
+		self.match, self.source = compile_fields(self.fields)
+		self.profile_events = profile_events if len(self.fields) > 1 else 0
+		self.profiled = 0
+		for field in self.fields:
+			field.test = compile_fields([field])[0]
+		log.debug("Compiled filter %s", self.source, level=2)
+
+	@property
+	def profiling(self):
+		return self.profiled < self.profile_events
+
+	def observe(self, records):
+		"""Count records passing every field until profile_events records were seen, then reorder the fields"""
+		records = records[:self.profile_events - self.profiled]
+		for field in self.fields:
+			test = field.test
+			field.passed += sum(1 for x in records if test(x))
+		self.profiled += len(records)
+		if not self.profiling:
+			self.fields.sort(key=lambda f: (f.passed, f.estimate()))
+			self.match, self.source = compile_fields(self.fields)
+			log.debug(
+				"Reordered filter after %i events (%s passed): %s", self.profiled,
+				', '.join('%s %i' % (f.name, f.passed) for f in self.fields), self.source, level=2)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import ipaddress
+import json
+import socket
+import time
+
+# Signal types, same values as enum nf_conntrack_msg_type
+SIG_NEW = 1
+SIG_UPDATE = 2
+SIG_DESTROY = 4
+SIG_TYPE_NAMES = {SIG_NEW: 'new', SIG_UPDATE: 'update', SIG_DESTROY: 'destroy'}
+SIG_TYPES = dict((v, k) for k, v in SIG_TYPE_NAMES.items())
+
+# Protocol names as rendered by nfct_snprintf(NFCT_O_XML)
+L3PROTO_NAMES = {socket.AF_INET: 'ipv4', socket.AF_INET6: 'ipv6'}
+L3PROTOS = dict((v, k) for k, v in L3PROTO_NAMES.items())
+L4PROTO_NAMES = {socket.IPPROTO_TCP: 'tcp', socket.IPPROTO_UDP: 'udp'}
+L4PROTOS = dict((v, k) for k, v in L4PROTO_NAMES.items())
+
+IP_FIELDS = ('src_ip', 'dst_ip', 'nat_ip')
+PORT_FIELDS = ('src_port', 'dst_port', 'nat_port')
+
+_ADDR_SIZE = {socket.AF_INET: 4, socket.AF_INET6: 16}
+
+
+def ip_to_str(family, ip):
+	return socket.inet_ntop(family, ip.to_bytes(_ADDR_SIZE[family], 'big'))
+
+
+def parse_field(name, value):
+	"""Convert the textual value of a field (config, url) into the representation stored in ConnRecord"""
+	if name in IP_FIELDS:
+		return int(ipaddress.ip_address(str(value)))
+	if name in PORT_FIELDS:
+		return int(value)
+	if name == 'protocol':
+		return L4PROTOS[value]
+	if name == 'sig_type':
+		return SIG_TYPES[value]
+	raise KeyError("Unknown field %s" % name)
+
+
+class ConnRecord(object):  # pylint: disable=too-many-instance-attributes,too-few-public-methods
+	"""Compact NAT connection entry.
+	IPs are stored as integers, protocol as IPPROTO_* number, sig_type as SIG_* and time as epoch seconds.
+	Use to_dict() to get the JSON representation used by the HTTP interface, payload optionally
+	holds the compact encoded JSON and seq the insert sequence number, both set once when the record
+	is inserted into the table."""
+	__slots__ = ('family', 'protocol', 'sig_type', 'src_ip', 'src_port', 'dst_ip', 'dst_port', 'nat_ip', 'nat_port', 'time', 'payload', 'seq')
+
+	def __init__(self, family, protocol, sig_type, src_ip, src_port, dst_ip, dst_port, nat_ip, nat_port, time_):  # pylint: disable=too-many-arguments
+		self.family = family
+		self.protocol = protocol
+		self.sig_type = sig_type
+		self.src_ip = src_ip
+		self.src_port = src_port
+		self.dst_ip = dst_ip
+		self.dst_port = dst_port
+		self.nat_ip = nat_ip
+		self.nat_port = nat_port
+		self.time = time_
+		self.payload = None
+		self.seq = 0
+
+	def to_dict(self):
+		family = self.family
+		return {'src_ip': ip_to_str(family, self.src_ip), 'src_port': self.src_port,
+				'dst_ip': ip_to_str(family, self.dst_ip), 'dst_port': self.dst_port,
+				'nat_ip': ip_to_str(family, self.nat_ip), 'nat_port': self.nat_port,
+				'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.time)),
+				'sig_type': SIG_TYPE_NAMES.get(self.sig_type, 'unknown'),
+				'protocol': (L3PROTO_NAMES[family], L4PROTO_NAMES[self.protocol])}
+
+	def to_json(self, pretty=False):
+		"""JSON encoded record as bytes, the pre-encoded payload is used if available"""
+		if pretty:
+			return json.dumps(self.to_dict(), sort_keys=True, indent=4).encode('utf-8')
+		if self.payload is not None:
+			return self.payload
+		return json.dumps(self.to_dict(), sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+	def __str__(self):
+		return "%s %s:%s -> %s:%s -> %s:%s" % (
+			L4PROTO_NAMES[self.protocol], ip_to_str(self.family, self.src_ip), self.src_port,
+			ip_to_str(self.family, self.nat_ip), self.nat_port, ip_to_str(self.family, self.dst_ip), self.dst_port)
+
+	def __repr__(self):
+		return "ConnRecord(%s)" % self.to_dict()
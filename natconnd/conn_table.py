@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import collections
+import itertools
+import operator
+import time
+import logging
+
+try:
+	import cygnuslog  # pylint: disable=unused-import
+except ImportError:
+	pass
+
+from . import conn_record
+
+log = logging.getLogger('cygnus.pynatconnd')
+
+# Fields a secondary index can be built on. 'dst' indexes the dst_ip:dst_port pair.
+INDEX_FIELDS = {
+	'src_ip': operator.attrgetter('src_ip'),
+	'src_port': operator.attrgetter('src_port'),
+	'nat_ip': operator.attrgetter('nat_ip'),
+	'nat_port': operator.attrgetter('nat_port'),
+	'dst_ip': operator.attrgetter('dst_ip'),
+	'dst_port': operator.attrgetter('dst_port'),
+	'dst': operator.attrgetter('dst_ip', 'dst_port'),
+}
+
+
+def parse_index_value(name, value):
+	"""Convert the textual value of an index (e.g. from the url) into the value stored in the index"""
+	if name == 'dst':
+		ip, port = value.rsplit(':', 1)
+		return conn_record.parse_field('dst_ip', ip.strip('[]')), int(port)
+	return conn_record.parse_field(name, value)
+
+
+def primary_key(record):
+	return record.protocol, record.nat_ip, record.nat_port
+
+
+class ConnTable(object):
+	"""Connection table keyed by (protocol, nat_ip, nat_port) with optional secondary indexes.
+	Entries are kept in insert/refresh order together with their monotonic refresh time,
+	so expiring entries only has to look at the oldest ones.
+
+	Writers (insert, remove, expire) have to hold the shared data lock. Readers (get, lookup, snapshot)
+	do not take any lock: records are never modified once inserted and readers only use single dict
+	operations, which are atomic in CPython, so a lookup never waits for ingestion or a GC slice.
+
+	All changes are passed on to mirror (a shm_table.SharedTable) if given."""
+	def __init__(self, indexes=(), preserialize=False, mirror=None):
+		self.preserialize = preserialize
+		self.mirror = mirror
+		self.seq = itertools.count(1)
+		self.data = dict()
+		self.expiry = collections.OrderedDict()
+		self.protocol_counts = dict((protocol, 0) for protocol in conn_record.L4PROTO_NAMES)
+		self.indexes = dict()
+		for name in indexes:
+			if name not in INDEX_FIELDS:
+				raise KeyError("Unknown index %s" % name)
+			# index value -> ordered set (dict) of primary keys, most recent last
+			self.indexes[name] = dict()
+
+	def __len__(self):
+		return len(self.data)
+
+	def __contains__(self, key):
+		return key in self.data
+
+	def __getitem__(self, key):
+		return self.data[key]
+
+	def get(self, key, default=None):
+		return self.data.get(key, default)
+
+	def items(self):
+		return self.data.items()
+
+	def snapshot(self):
+		"""Consistent shallow copy of the table as plain dict"""
+		return self.data.copy()
+
+	def counts_by_protocol(self):
+		"""Number of connections per protocol as list of (labels, value) for metrics"""
+		return [((('protocol', conn_record.L4PROTO_NAMES[protocol]),), count) for protocol, count in self.protocol_counts.items()]
+
+	def records(self):
+		"""Consistent snapshot of all records as list"""
+		return list(self.data.values())
+
+	def lookup(self, index, value):
+		"""Records whose index field equals value, oldest first"""
+		keys = self.indexes[index].get(value)
+		if not keys:
+			return []
+		# tuple() copies the key set in one step, entries removed or replaced
+		# by a writer in the meantime are skipped
+		get_value = INDEX_FIELDS[index]
+		data_get = self.data.get
+		records = []
+		for key in tuple(keys):
+			record = data_get(key)
+			if record is not None and get_value(record) == value:
+				records.append(record)
+		return records
+
+	def _index_add(self, key, record):
+		for name, index in self.indexes.items():
+			index.setdefault(INDEX_FIELDS[name](record), dict())[key] = None
+
+	def _index_remove(self, key, record):
+		for name, index in self.indexes.items():
+			value = INDEX_FIELDS[name](record)
+			keys = index[value]
+			del keys[key]
+			if not keys:
+				del index[value]
+
+	def insert(self, record, refresh_time=None):
+		"""Add or replace the entry for the record's primary key and move it to the end of the expiry index.
+		Returns the primary key."""
+		key = primary_key(record)
+		record.seq = next(self.seq)
+		if self.preserialize and record.payload is None:
+			record.payload = record.to_json()
+		old = self.data.get(key)
+		if old is not None:
+			self._index_remove(key, old)
+		else:
+			self.protocol_counts[record.protocol] += 1
+		self.data[key] = record
+		self._index_add(key, record)
+		self.expiry[key] = time.monotonic() if refresh_time is None else refresh_time
+		self.expiry.move_to_end(key)
+		if self.mirror is not None:
+			self.mirror.insert(key, record)
+		return key
+
+	def load(self, entries):
+		"""Bulk insert of (record, refresh_time) pairs given in expiry order, used to restore a snapshot.
+		Unlike insert() records are not pre-encoded, they are encoded on lookup instead.
+		Returns the number of entries loaded."""
+		data = self.data
+		expiry = self.expiry
+		protocol_counts = self.protocol_counts
+		seq = self.seq
+		indexes = [(INDEX_FIELDS[name], index) for name, index in self.indexes.items()]
+		count = 0
+		for record, refresh_time in entries:
+			key = record.protocol, record.nat_ip, record.nat_port
+			if key in data:
+				self.remove(key)
+			record.seq = next(seq)
+			data[key] = record
+			protocol_counts[record.protocol] += 1
+			for get_value, index in indexes:
+				keys = index.get(get_value(record))
+				if keys is None:
+					keys = index[get_value(record)] = dict()
+				keys[key] = None
+			expiry[key] = refresh_time
+			if self.mirror is not None:
+				self.mirror.insert(key, record)
+			count += 1
+		return count
+
+	def remove(self, key):
+		record = self.data.pop(key)
+		self.protocol_counts[record.protocol] -= 1
+		self._index_remove(key, record)
+		del self.expiry[key]
+		if self.mirror is not None:
+			self.mirror.remove(key)
+
+	def expire(self, life_span, limit, now=None):
+		"""Remove at most limit entries not refreshed for life_span seconds.
+		Returns the list of removed (key, value) pairs and if more entries are due."""
+		deadline = (time.monotonic() if now is None else now) - life_span
+		removed = []
+		for key, refresh_time in self.expiry.items():
+			if refresh_time > deadline or len(removed) >= limit:
+				break
+			removed.append((key, self.data[key]))
+		for key, _ in removed:
+			self.remove(key)
+		more = bool(self.expiry) and next(iter(self.expiry.values())) <= deadline
+		return removed, more
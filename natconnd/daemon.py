@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import queue
+import signal
 import threading
 import sys
 import argparse
@@ -16,12 +16,32 @@ except ImportError:
 from . import pynatconnd_config
 from . import http_server
 from . import queue_worker
+from . import ingest_process
+from . import batch_queue
 from . import net_filter
 from . import garbage_collection
+from . import history
+from . import conn_table
+from . import ip_acl
+from . import metrics
+from . import snapshot
+from . import http_workers
+from . import shm_table
 
 log = logging.getLogger('cygnus.pynatconnd')
 
 
+class StopDaemon(Exception):
+	"""Raised in the main thread by the SIGTERM handler"""
+	pass
+
+
+def on_sigterm(signum, frame):  # pylint: disable=unused-argument
+	# A second SIGTERM must not interrupt stop_all_threads
+	signal.signal(signal.SIGTERM, signal.SIG_IGN)
+	raise StopDaemon()
+
+
 def main():  # pylint:disable=too-many-locals,too-many-statements
 	log.info("Starting Pynatconnd")
 	try:
@@ -46,11 +66,37 @@ def main():  # pylint:disable=too-many-locals,too-many-statements
 				log.set_debug_level(int(config["syslog"]["debug_level"]))
 
 		log.debug("Creating an instance of shared data, threading.lock() and a queue", level=6)
-		shared_data = dict()
-		shared_statistics = dict(queue_size=0, shared_data_size=0, number_of_deleted_items=0, number_of_created_items=0, expired_data=0, http_stat={'no_of_requests': 0, 'unauthorized_requests': 0, 'successful_replies': 0, 'unsuccessful_replies': 0, 'bad_requests': 0})
+		mirror = None
+		if config['http_server']['workers']:
+			mirror = shm_table.SharedTable(config['data']['key_name'], slots=config['http_server']['shm_slots'])
+		shared_data = conn_table.ConnTable(set([config['data']['key_name']] + list(config['data']['indexes'])), preserialize=config['data']['preserialize'], mirror=mirror)
+		shared_statistics = metrics.Registry()
+		shared_statistics.gauge('natconnd_table_entries', 'Connections in the table per protocol', func=shared_data.counts_by_protocol)
+		if mirror is not None:
+			shared_statistics.gauge('natconnd_shm_table_entries', 'Connections in the shared memory table of the HTTP workers', func=lambda: len(mirror.positions))
+			shared_statistics.gauge('natconnd_shm_table_rejected', 'Connections not added to the full shared memory table', func=lambda: mirror.rejected)
 		data_lock = threading.Lock()
-		event_queue = queue.Queue()
-		shared_resource = {'data': shared_data, 'statistics': shared_statistics, 'lock': data_lock, 'conf': config}
+		event_queue = batch_queue.BatchQueue(shared_statistics, maxsize=config['nfct']['queue_size'], policy=config['nfct']['queue_policy'])
+		acl = ip_acl.IPACL(config['http_server']['ip_acl'], cache_size=config['http_server']['acl_cache_size'])
+		if config['snapshot']['file']:
+			load_snapshot(config['snapshot']['file'], shared_data, config['data']['life_span'])
+
+		history_log = None
+		if config['history']['dir']:
+			history_log = history.HistoryLog(
+				config['history']['dir'], segment_size=config['history']['segment_size'], segment_age=config['history']['segment_age'],
+				retention=config['history']['retention'], max_size=config['history']['max_size'])
+
+		threads = []
+		warm_start = threading.Event()
+		shared_resource = {'data': shared_data, 'statistics': shared_statistics, 'lock': data_lock, 'conf': config, 'acl': acl, 'threads': threads, 'warm_start': warm_start, 'history': history_log}
+		http_workers_thread = None
+
+		def on_sighup(signum, frame):  # pylint: disable=unused-argument
+			reload_config(args.config, acl)
+			if http_workers_thread is not None:
+				http_workers_thread.reload()
+		signal.signal(signal.SIGHUP, on_sighup)
 		join_timeout = config['threading']['join_timeout']
 
 		http_host = dict(ip=None, port=None)
@@ -65,21 +111,48 @@ def main():  # pylint:disable=too-many-locals,too-many-statements
 			http_host['port'] = int(config["http_server"]["port"])
 
 		log.debug("Creating an instance of three threads Receiver, queue_worker and deliver_worker", level=6)
-		threads = []
-		threads.append(queue_worker.QueueWorker(event_queue, shared_statistics))
-		threads.append(net_filter.NetFilter(event_queue, shared_resource))
-		threads.append(http_server.HTTPServer(shared_resource, host=http_host))
+		ingest_reader = None
+		if config['nfct']['ingest_process']:
+			# Netlink socket, parsing and filtering in a child process restarted by the loop below
+			ingest_reader = ingest_process.IngestReader(event_queue, shared_resource, args.config)
+			threads.append(ingest_reader)
+		else:
+			threads.append(queue_worker.QueueWorker(event_queue, shared_resource))
+		if history_log is not None:
+			# Stopped after NetFilter (threads are stopped in reverse order)
+			threads.append(history.HistoryThread(shared_resource))
+		net_filter_thread = net_filter.NetFilter(event_queue, shared_resource)
+		threads.append(net_filter_thread)
+		threads.append(net_filter_thread.delete_scheduler)
+		if mirror is not None:
+			# Workers answer lookups on the port, everything else is served on admin_port
+			http_workers_thread = http_workers.HTTPWorkers(shared_resource, http_host, args.config, mirror)
+			threads.append(http_workers_thread)
+			http_server_thread = http_server.HTTPServer(shared_resource, host=dict(ip=http_host['ip'], port=config['http_server']['admin_port']))
+		else:
+			http_server_thread = http_server.HTTPServer(shared_resource, host=http_host)
+		threads.append(http_server_thread)
+		serving_threads = (http_server_thread, http_workers_thread)
 		threads.append(garbage_collection.GarbageCollectorThread(shared_resource))
+		snapshot_thread = None
+		if config['snapshot']['file']:
+			snapshot_thread = snapshot.SnapshotThread(shared_resource)
+			threads.append(snapshot_thread)
 
-		for thread in threads:
-			thread.start()
+		shared_statistics.gauge('natconnd_thread_alive', 'Daemon thread is running', func=lambda: [((('thread', t.getName()),), int(t.is_alive())) for t in threads])
 
-		start_time = time.time()
-		shared_statistics['prgm_start_time'] = start_time
-		thread_stat = {}
 		for thread in threads:
-			thread_stat.update({thread.getName(): {'alive_time': thread.alive_time - time.time(), 'is_alive': True if thread.is_alive else False}})
-		shared_statistics['threads_stat'] = thread_stat
+			if thread not in serving_threads:
+				thread.start()
+
+		# Answer lookups only once the connections existing before the start are known
+		if not warm_start.wait(config['nfct']['warm_start_timeout']):
+			log.warning("Warm start did not finish within %s seconds, starting the HTTP server anyway", config['nfct']['warm_start_timeout'])
+		for thread in serving_threads:
+			if thread is not None:
+				thread.start()
+
+		shared_statistics.gauge('natconnd_start_time_seconds', 'Start time of the daemon since epoch').set(time.time())
 	except pynatconnd_config.PynatconndConfigException as e:
 		print("Error in config file with msg %s" % e)
 		sys.exit(0)
@@ -90,22 +163,50 @@ def main():  # pylint:disable=too-many-locals,too-many-statements
 		log.error("Error init pynatconnd with msg %s", e, exc_info=True)
 		sys.exit(0)
 
+	# systemctl stop/restart send SIGTERM, SIGINT raises KeyboardInterrupt
+	signal.signal(signal.SIGTERM, on_sigterm)
 	while True:
 		try:
 			time.sleep(1)
+			if ingest_reader is not None:
+				ingest_reader.supervise()
 			for thread in threads:
 				if thread.running:
 					continue
 				else:
-					stop_all_threads(threads, join_timeout)
+					stop_all_threads(threads, join_timeout, snapshot_thread)
 					sys.exit(1)
-		except KeyboardInterrupt:
-			log.debug("KeyboardInterrupt caught, stopping all threads", level=1)
-			stop_all_threads(threads, join_timeout)
+		except (KeyboardInterrupt, StopDaemon) as e:
+			log.info("%s caught, stopping all threads", 'SIGTERM' if isinstance(e, StopDaemon) else 'KeyboardInterrupt')
+			signal.signal(signal.SIGINT, signal.SIG_IGN)
+			signal.signal(signal.SIGTERM, signal.SIG_IGN)
+			stop_all_threads(threads, join_timeout, snapshot_thread)
 			sys.exit(0)
 
 
-def stop_all_threads(threads, join_timeout):
+def reload_config(config_file, acl):
+	"""SIGHUP handler - reloads the parts of the configuration that can be changed at runtime (ip_acl)"""
+	log.info("Reloading configuration file %s", config_file)
+	try:
+		config = pynatconnd_config.PynatconndConfig(config_file).get_configobj()
+		acl.load(config['http_server']['ip_acl'])
+	except (pynatconnd_config.PynatconndConfigException, IOError, ValueError) as e:
+		log.error("Failed to reload configuration file %s with msg %s - keeping the current configuration", config_file, e)
+
+
+def load_snapshot(path, shared_data, life_span):
+	start = time.monotonic()
+	try:
+		count = snapshot.load(path, shared_data, life_span)
+	except FileNotFoundError:
+		log.info("No snapshot %s found, starting with an empty table", path)
+	except (snapshot.SnapshotError, IOError) as e:
+		log.error("Failed to load snapshot %s with msg %s - starting with an empty table", path, e)
+	else:
+		log.info("Loaded %i entries from snapshot %s in %.3fs", count, path, time.monotonic() - start)
+
+
+def stop_all_threads(threads, join_timeout, snapshot_thread=None):
 	threads.reverse()
 	for thread in threads:
 		thread.stop()
@@ -118,6 +219,10 @@ def stop_all_threads(threads, join_timeout):
 
 	log.debug("all threads stopped", level=1)
 
+	# Written after NetFilter stopped, so the snapshot contains the final state
+	if snapshot_thread is not None:
+		snapshot_thread.write()
+
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import threading
+import time
+import logging
+
+try:
+	import cygnuslog  # pylint: disable=unused-import
+except ImportError:
+	pass
+
+from . import base_thread
+
+log = logging.getLogger('cygnus.pynatconnd')
+
+
+class DeleteScheduler(base_thread.BaseThread):  # pylint: disable=too-many-instance-attributes
+	"""Single thread executing delayed deletes of the shared dictionary.
+	Pending deletes are kept in a heap ordered by monotonic deadline, all due keys are handed
+	to delete_callback as one list, so it can remove them under one lock acquisition."""
+	def __init__(self, shared_resource, delete_callback):
+		base_thread.BaseThread.__init__(self, shared_resource['statistics'])
+		log.debug("Initializing delete scheduler thread", level=2)
+		self.setName('DeleteScheduler')
+		self.delay = shared_resource['conf']['data']['del_delay']
+		self.delete_callback = delete_callback
+		self.cond = threading.Condition()
+		self.heap = []
+		self.pending = dict()
+		self.seq = itertools.count()
+		self.shared_statistics.gauge('natconnd_timer_backlog', 'Deletes waiting for del_delay to pass', func=lambda: len(self.pending))
+
+	def schedule(self, key, value):
+		"""Delete key after del_delay seconds, if it still maps to value by then"""
+		deadline = time.monotonic() + self.delay
+		with self.cond:
+			token = next(self.seq)
+			self.pending[key] = token
+			heapq.heappush(self.heap, (deadline, token, key, value))
+			if len(self.heap) == 1:
+				self.cond.notify()
+
+	def cancel(self, key):
+		"""Cancel a pending delete of key, returns True if there was one"""
+		with self.cond:
+			return self.pending.pop(key, None) is not None
+
+	def run(self):
+		log.debug("Starting delete scheduler thread", level=1)
+		self.running = True
+		while self.running:
+			due = []
+			with self.cond:
+				timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+				if timeout is None or timeout > 0:
+					self.cond.wait(timeout)
+				now = time.monotonic()
+				while self.heap and self.heap[0][0] <= now:
+					_, token, key, value = heapq.heappop(self.heap)
+					# Entries cancelled or rescheduled in the meantime are skipped
+					if self.pending.get(key) == token:
+						del self.pending[key]
+						due.append((key, value))
+			if due:
+				self.delete_callback(due)
+
+		log.debug("Stopped delete scheduler thread", level=1)
+
+	def stop(self):
+		log.debug("Stopping delete scheduler thread with %i pending deletes", len(self.pending), level=1)
+		self.running = False
+		with self.cond:
+			self.cond.notify()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Sources of conntrack events for QueueWorker.
+
+A source provides what QueueWorker uses of nfct_cffi.NFCT:
+
+	generator(decoder, batch_size, kernel_filter, rcvbuf_size, ...) - yields something on the
+		first iteration (the netlink fd for NFCT) once events are subscribed, then CTRecords
+		(lists of them with batch_size) and nfct_cffi.NFOverflow after events were lost
+	dump() - list of CTRecords (msg_type NEW) of all currently open connections
+
+[nfct] source selects the backend: nfct reads the kernel conntrack table, fake generates
+synthetic NEW/UPDATE/DESTROY streams or replays recorded events as configured in [fake],
+without root or a conntrack table. Events are recorded with
+
+	python -m natconnd.event_source -o events.bin -n 100000"""
+import argparse
+import collections
+import ipaddress
+import random
+import socket
+import struct
+import time
+import logging
+
+try:
+	import cygnuslog  # pylint: disable=unused-import
+except ImportError:
+	pass
+
+from . import conn_record
+from . import nfct_cffi  # pylint: disable=no-name-in-module
+
+log = logging.getLogger('cygnus.pynatconnd')
+
+# Recorded events file: magic, then fixed size records
+EVENTS_MAGIC = b'NATCEVT1'
+# msg_type, l3proto, l4proto, orig_sport, orig_dport, repl_sport, repl_dport, id, ts_start, ts_stop,
+# orig_src, orig_dst, repl_src, repl_dst (timestamps -1 if not set, addresses padded to 16 bytes)
+EVENT_RECORD = struct.Struct('<BBBxHHHHIqq16s16s16s16s')
+
+# Exponent of the zipf-like port distribution, lower is more skewed
+ZIPF_ALPHA = 1.2
+# Ports picked with port_distribution before falling back to uniform when they are in use
+MAX_PORT_ATTEMPTS = 16
+
+_ADDR_SIZE = {socket.AF_INET: 4, socket.AF_INET6: 16}
+
+
+def create(conf):
+	"""Event source configured in [nfct] source"""
+	if conf['nfct']['source'] == 'fake':
+		if conf['nfct']['decoder'] != 'binary':
+			raise ValueError("The fake event source only supports the binary decoder")
+		return FakeSource(conf['fake'])
+	return nfct_cffi.NFCT()
+
+
+def save_events(path, records):
+	"""Write CTRecords to a recorded events file, returns the number of records"""
+	count = 0
+	with open(path, 'wb') as f:
+		f.write(EVENTS_MAGIC)
+		for r in records:
+			f.write(EVENT_RECORD.pack(
+				r.msg_type, r.l3proto, r.l4proto, r.orig_sport, r.orig_dport, r.repl_sport, r.repl_dport, r.id,
+				-1 if r.ts_start is None else r.ts_start, -1 if r.ts_stop is None else r.ts_stop,
+				r.orig_src, r.orig_dst, r.repl_src, r.repl_dst))
+			count += 1
+	return count
+
+
+def load_events(path):
+	"""CTRecords of a recorded events file"""
+	with open(path, 'rb') as f:
+		data = f.read()
+	if data[:len(EVENTS_MAGIC)] != EVENTS_MAGIC or (len(data) - len(EVENTS_MAGIC)) % EVENT_RECORD.size:
+		raise ValueError("%s is not a recorded events file" % path)
+	records = []
+	for msg_type, l3proto, l4proto, sport, dport, repl_sport, repl_dport, id_, ts_start, ts_stop, src, dst, repl_src, repl_dst in EVENT_RECORD.iter_unpack(data[len(EVENTS_MAGIC):]):
+		size = _ADDR_SIZE.get(l3proto, 16)
+		records.append(nfct_cffi.CTRecord(
+			msg_type, l3proto, l4proto, src[:size], dst[:size], sport, dport, repl_src[:size], repl_dst[:size], repl_sport, repl_dport,
+			id_, None if ts_start < 0 else ts_start, None if ts_stop < 0 else ts_stop))
+	return records
+
+
+def parse_range(value):
+	low, _, high = value.partition('-')
+	low, high = int(low), int(high or low)
+	if not 0 < low <= high <= 65535:
+		raise ValueError("Invalid port range %s" % value)
+	return low, high
+
+
+class FakeSource(object):  # pylint: disable=too-many-instance-attributes
+	"""Synthetic or replayed events at a given rate.
+
+	Synthetic streams open connections until connections are open, then every NEW event is
+	preceded by the DESTROY of the oldest connection. update_ratio of the events are UPDATEs
+	of the most recently opened connection. NAT ports are picked from nat_ports with
+	port_distribution, never reusing the port of an open connection."""
+	def __init__(self, fake_conf):
+		self.rate = fake_conf['rate']
+		self.events = fake_conf['events']
+		self.connections = fake_conf['connections']
+		self.update_ratio = fake_conf['update_ratio']
+		self.udp_ratio = fake_conf['udp_ratio']
+		self.src_net = ipaddress.ip_network(fake_conf['src_net'], strict=False)
+		self.dst_ip = ipaddress.ip_address(fake_conf['dst_ip'])
+		self.dst_port = fake_conf['dst_port']
+		self.nat_ips = [ipaddress.ip_address(x) for x in fake_conf['nat_ip']]
+		if len(set(x.version for x in self.nat_ips + [self.dst_ip, self.src_net.network_address])) != 1:
+			raise ValueError("src_net, dst_ip and nat_ip of [fake] have to be of the same IP version")
+		self.family = socket.AF_INET if self.dst_ip.version == 4 else socket.AF_INET6
+		self.port_low, self.port_high = parse_range(fake_conf['nat_ports'])
+		self.port_distribution = fake_conf['port_distribution']
+		if self.connections > (self.port_high - self.port_low + 1) * len(self.nat_ips):
+			raise ValueError("[fake] connections is larger than the number of NAT ports")
+		self.replay = load_events(fake_conf['replay']) if fake_conf['replay'] else None
+		self.random = random.Random(fake_conf['seed'])
+		self.open = collections.OrderedDict()
+		self.used = set()
+		self.next_id = 1
+		self.next_port = self.port_low
+		self.generated = dict((sig_type, 0) for sig_type in conn_record.SIG_TYPE_NAMES)
+
+	def nat_port(self):
+		if self.port_distribution == 'sequential':
+			port = self.next_port
+			self.next_port = port + 1 if port < self.port_high else self.port_low
+			return port
+		if self.port_distribution == 'zipf':
+			rank = int(self.random.paretovariate(ZIPF_ALPHA)) - 1
+			return self.port_low + rank % (self.port_high - self.port_low + 1)
+		return self.random.randint(self.port_low, self.port_high)
+
+	def new_connection(self, ts):
+		protocol = socket.IPPROTO_UDP if self.random.random() < self.udp_ratio else socket.IPPROTO_TCP
+		attempts = 0
+		while True:
+			nat_ip = self.nat_ips[self.random.randrange(len(self.nat_ips))] if len(self.nat_ips) > 1 else self.nat_ips[0]
+			# Skewed distributions hardly ever hit a free port once the popular ones are open
+			port = self.nat_port() if attempts < MAX_PORT_ATTEMPTS else self.random.randint(self.port_low, self.port_high)
+			key = (protocol, nat_ip, port)
+			if key not in self.used:
+				break
+			attempts += 1
+		self.used.add(key)
+		size = _ADDR_SIZE[self.family]
+		src = int(self.src_net.network_address) + self.random.randrange(self.src_net.num_addresses)
+		dst = self.dst_ip.packed
+		record = nfct_cffi.CTRecord(
+			conn_record.SIG_NEW, self.family, protocol, src.to_bytes(size, 'big'), dst, self.random.randint(1024, 65535), self.dst_port,
+			dst, key[1].packed, self.dst_port, key[2], self.next_id, ts, None)
+		self.open[self.next_id] = (key, record)
+		self.next_id += 1
+		return record
+
+	def synthetic_event(self):
+		ts = time.time_ns()
+		if self.open and self.random.random() < self.update_ratio:
+			_, record = self.open[next(reversed(self.open))]
+			return record._replace(msg_type=conn_record.SIG_UPDATE, ts_start=ts)
+		if len(self.open) >= self.connections:
+			_, (key, record) = self.open.popitem(last=False)
+			self.used.discard(key)
+			return record._replace(msg_type=conn_record.SIG_DESTROY, ts_stop=ts)
+		return self.new_connection(ts)
+
+	def replayed_events(self):
+		for record in self.replay:
+			if record.msg_type == conn_record.SIG_NEW:
+				self.open[record.id] = (None, record)
+			elif record.msg_type == conn_record.SIG_DESTROY:
+				self.open.pop(record.id, None)
+			yield record
+
+	def dump(self, family=socket.AF_UNSPEC):  # pylint: disable=unused-argument
+		return [record._replace(msg_type=conn_record.SIG_NEW) for _, record in list(self.open.values())]
+
+	def generator(self, events=None, output_flags=None, decoder='binary', batch_size=None, poll_timeout=1.0, kernel_filter=None, rcvbuf_size=None):  # pylint: disable=too-many-arguments,unused-argument
+		# Same protocol as NFCT.generator with decoder='binary', ends after [fake] events events
+		# (or the end of the replayed file). kernel_filter is not applied, NetFilter filters anyway.
+		if decoder != 'binary':
+			raise ValueError("The fake event source only supports the binary decoder")
+		if self.replay is not None:
+			source = self.replayed_events()
+		else:
+			source = iter(self.synthetic_event, None)
+		total = self.events or float('inf')
+		produced = 0
+		start = time.monotonic()
+		yield None
+		while produced < total:
+			count = min(batch_size or 1, total - produced)
+			if self.rate:
+				# Events due by now, waiting at most poll_timeout for the next one
+				due = int((time.monotonic() - start) * self.rate) - produced
+				if due <= 0:
+					wait = min((produced + 1) / self.rate - (time.monotonic() - start), poll_timeout)
+					time.sleep(max(wait, 0))
+					due = int((time.monotonic() - start) * self.rate) - produced
+					if due <= 0:
+						if batch_size:
+							yield []
+						continue
+				count = min(count, due)
+			batch = []
+			for record in source:
+				self.generated[record.msg_type] += 1
+				batch.append(record)
+				if len(batch) >= count:
+					break
+			if not batch:
+				break
+			produced += len(batch)
+			if batch_size:
+				yield batch
+			else:
+				yield batch[0]
+		log.info("Fake event source finished after %i events", produced)
+
+
+def main():
+	argp = argparse.ArgumentParser(description="Record conntrack events for the fake event source")
+	argp.add_argument("-o", "--output", help="recorded events file", required=True)
+	argp.add_argument("-n", "--events", help="number of events to record", type=int, default=100000)
+	args = argp.parse_args()
+
+	def events():
+		src = nfct_cffi.NFCT().generator(batch_size=256)
+		next(src)
+		count = 0
+		for batch in src:
+			if batch is nfct_cffi.NFOverflow:
+				log.warning("Netlink socket overflowed, the recording misses events")
+				continue
+			for record in batch:
+				yield record
+				count += 1
+				if count >= args.events:
+					return
+	print("Recorded %i events to %s" % (save_events(args.output, events()), args.output))
+
+
+if __name__ == '__main__':
+	main()
@@ -2,8 +2,7 @@
 # -*- coding: utf-8 -*-
 import threading
 import logging
-import datetime
-import copy
+import time
 
 try:
 	import cygnuslog  # pylint: disable=unused-import
@@ -11,6 +10,7 @@ except ImportError:
 	pass
 
 from . import base_thread
+from . import metrics
 
 log = logging.getLogger('cygnus.netfilter')
 
@@ -26,38 +26,57 @@ class GarbageCollectorThread(base_thread.BaseThread):  # pylint: disable=too-man
 		assert shared_resources['lock'] is not None
 		self.shared_data_lock = shared_resources['lock']
 		self.ev = threading.Event()
+		stats = self.shared_statistics
+		self.runs = stats.counter('natconnd_gc_runs_total', 'Garbage collector runs')
+		self.expired = stats.counter('natconnd_connections_expired_total', 'Connections removed by the garbage collector after life_span')
+		self.pause = stats.histogram('natconnd_gc_pause_seconds', 'Time the table lock was held per garbage collector slice', buckets=metrics.PAUSE_BUCKETS)
+		self.lock_wait = stats.histogram('natconnd_lock_wait_seconds', 'Time waited for the table write lock', {'operation': 'gc'})
+		self.last_pause = stats.gauge('natconnd_gc_last_pause_seconds', 'Longest slice pause of the last garbage collector run')
+		self.max_pause = stats.gauge('natconnd_gc_max_pause_seconds', 'Longest slice pause since start')
+		self.last_duration = stats.gauge('natconnd_gc_last_duration_seconds', 'Duration of the last garbage collector run')
+		self.last_expired = stats.gauge('natconnd_gc_last_expired', 'Connections expired by the last garbage collector run')
 
 	def run(self):
 		log.debug("Garbage cleaner thread running", level=4)
 		self.running = True
 		while self.running:
 			self.ev.wait(self.configuration['data']['garbage_cleaner_interval'])
-
-			log.debug("Starting garbage collector")
-			before_cleaning = len(self.shared_data)
-			share_data_copy = copy.deepcopy(self.shared_data)
-			with self.shared_data_lock:
-				for key, value in share_data_copy.items():
-					data_time = datetime.datetime.strptime(value['time'], '%Y-%m-%d %H:%M:%S')
-					time_now = datetime.datetime.now()
-					time_diff = time_now - data_time
-					if time_diff.seconds > self.configuration['data']['life_span']:
-						if key in self.shared_data:
-							del self.shared_data[key]
-							self.shared_statistics['expired_data'] += 1
-							log.debug("Removed the entry %s from the shared dictionary ", key, level=4)
-						else:
-							log.debug("Couldn't find the entry %s in the shared dictionary ", key)
-					else:
-						log.debug("timestamp of %s not exceeded the life span", key, level=10)
-
-			self.timer_set = False
-			log.debug("garbage collector finished - dict size is %s - deleted %s items", len(self.shared_data), before_cleaning - len(self.shared_data))
-
+			if not self.running:
+				break
+			self.collect()
 			self.ev.clear()
 
 		log.debug("Stopped Garbage Collector thread", level=1)
 
+	def collect(self):
+		"""Expire entries in slices of gc_slice_size, releasing the lock in between"""
+		log.debug("Starting garbage collector")
+		life_span = self.configuration['data']['life_span']
+		slice_size = self.configuration['data']['gc_slice_size']
+		start = time.monotonic()
+		expired = 0
+		max_pause = 0.0
+		more = True
+		while more and self.running:
+			with metrics.timed_lock(self.shared_data_lock, self.lock_wait):
+				slice_start = time.monotonic()
+				removed, more = self.shared_data.expire(life_span, slice_size)
+				pause = time.monotonic() - slice_start
+			self.pause.observe(pause)
+			max_pause = max(max_pause, pause)
+			expired += len(removed)
+			for key, _ in removed:
+				log.debug("Removed the entry %s from the shared dictionary ", key, level=4)
+
+		self.runs.inc()
+		self.expired.inc(expired)
+		self.last_pause.set(max_pause)
+		self.max_pause.set(max(self.max_pause.value(), max_pause))
+		self.last_duration.set(time.monotonic() - start)
+		self.last_expired.set(expired)
+		self.timer_set = False
+		log.debug("garbage collector finished - dict size is %s - deleted %s items - max pause %.6fs", len(self.shared_data), expired, max_pause)
+
 	def stop(self):
 		log.debug("Stopping Garbage Collector thread", level=4)
 		self.running = False
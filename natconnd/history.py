@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Append-only log of the NEW and DESTROY events of the connection table for point in time queries.
+
+The log is a directory of segments. A segment (history-<created at>.log) is a header followed
+by fixed size records in the order the events were logged, so logging times only grow. When a
+segment is closed (segment_size or segment_age reached, or the daemon stops) an index is
+written next to it (.idx): the logging time range of the segment and the record numbers sorted
+by (nat_port, protocol). A query only looks at segments covering the time asked for and only
+reads the records of one port from them. Segments older than retention seconds are removed,
+as are the oldest ones while the log is larger than max_size.
+
+Events are buffered by append() and written by HistoryThread every flush_interval seconds."""
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+import logging
+
+try:
+	import cygnuslog  # pylint: disable=unused-import
+except ImportError:
+	pass
+
+from . import base_thread
+from . import conn_record
+
+log = logging.getLogger('cygnus.pynatconnd')
+
+SEGMENT_MAGIC = b'NATCHLOG'
+INDEX_MAGIC = b'NATCHIDX'
+VERSION = 1
+# magic, version, record size, created at (epoch)
+SEGMENT_HEADER = struct.Struct('<8sIId')
+# sig_type, family, protocol, src_port, dst_port, nat_port, time, logged at (epoch), src_ip, dst_ip, nat_ip
+RECORD = struct.Struct('<BBBxHHHxxqd16s16s16s')
+# magic, version, number of records, first and last logged at (epoch)
+INDEX_HEADER = struct.Struct('<8sIQdd')
+# nat_port, protocol, record number
+INDEX_ENTRY = struct.Struct('<HBxI')
+
+
+class HistoryError(Exception):
+	pass
+
+
+def pack(record, logged):
+	return RECORD.pack(
+		record.sig_type, record.family, record.protocol, record.src_port, record.dst_port, record.nat_port, record.time, logged,
+		record.src_ip.to_bytes(16, 'big'), record.dst_ip.to_bytes(16, 'big'), record.nat_ip.to_bytes(16, 'big'))
+
+
+def unpack(data, offset=0):
+	"""(ConnRecord, logged at) of the record at offset"""
+	sig_type, family, protocol, src_port, dst_port, nat_port, time_, logged, src_ip, dst_ip, nat_ip = RECORD.unpack_from(data, offset)
+	from_bytes = int.from_bytes
+	return conn_record.ConnRecord(
+		family, protocol, sig_type, from_bytes(src_ip, 'big'), src_port, from_bytes(dst_ip, 'big'), dst_port,
+		from_bytes(nat_ip, 'big'), nat_port, time_), logged
+
+
+def index_path(path):
+	return path[:-len('.log')] + '.idx'
+
+
+def write_index(path, port_index, count, first, last):
+	"""Write the index of the segment at path, port_index maps (nat_port, protocol) to record numbers in ascending order"""
+	tmp_path = '%s.tmp' % index_path(path)
+	pack_entry = INDEX_ENTRY.pack
+	with open(tmp_path, 'wb') as f:
+		f.write(INDEX_HEADER.pack(INDEX_MAGIC, VERSION, count, first, last))
+		for (nat_port, protocol), numbers in sorted(port_index.items()):
+			f.write(b''.join(pack_entry(nat_port, protocol, n) for n in numbers))
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tmp_path, index_path(path))
+
+
+def read_index_header(path):
+	with open(index_path(path), 'rb') as f:
+		magic, version, count, first, last = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+	if magic != INDEX_MAGIC or version != VERSION:
+		raise HistoryError("%s is not a version %i history index" % (index_path(path), VERSION))
+	return count, first, last
+
+
+def index_lookup(path, nat_port, protocol):
+	"""Record numbers of (nat_port, protocol) in the index of the segment at path, by binary search"""
+	with open(index_path(path), 'rb') as f:
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			unpack_from = INDEX_ENTRY.unpack_from
+			key = (nat_port, protocol)
+			low, high = 0, (len(mm) - INDEX_HEADER.size) // INDEX_ENTRY.size
+			while low < high:
+				mid = (low + high) // 2
+				if unpack_from(mm, INDEX_HEADER.size + mid * INDEX_ENTRY.size)[:2] < key:
+					low = mid + 1
+				else:
+					high = mid
+			numbers = []
+			for port, proto, number in INDEX_ENTRY.iter_unpack(mm[INDEX_HEADER.size + low * INDEX_ENTRY.size:]):
+				if (port, proto) != key:
+					break
+				numbers.append(number)
+			return numbers
+
+
+def scan(path):
+	"""Rebuild the index data of a segment left without index by a crash.
+	Returns (port_index, count, first, last), a partially written last record is cut off."""
+	with open(path, 'r+b') as f:
+		size = os.fstat(f.fileno()).st_size
+		header = f.read(SEGMENT_HEADER.size)
+		if len(header) < SEGMENT_HEADER.size:
+			raise HistoryError("%s is too short for a history segment" % path)
+		magic, version, record_size, created = SEGMENT_HEADER.unpack(header)
+		if magic != SEGMENT_MAGIC or version != VERSION or record_size != RECORD.size:
+			raise HistoryError("%s is not a version %i history segment" % (path, VERSION))
+		count = (size - SEGMENT_HEADER.size) // RECORD.size
+		f.truncate(SEGMENT_HEADER.size + count * RECORD.size)
+		data = f.read(count * RECORD.size)
+	port_index = collections.defaultdict(list)
+	first = last = created
+	for number, (_, _, protocol, _, _, nat_port, _, logged, _, _, _) in enumerate(RECORD.iter_unpack(data)):
+		port_index[(nat_port, protocol)].append(number)
+		if number == 0:
+			first = logged
+		last = logged
+	return port_index, count, first, last
+
+
+class Segment(object):  # pylint: disable=too-few-public-methods
+	"""A segment file, port_index is only kept for the segment being written"""
+	def __init__(self, path, count, first, last, port_index=None):
+		self.path = path
+		self.count = count
+		self.first = first
+		self.last = last
+		self.port_index = port_index
+		self.created = time.time()
+
+	@property
+	def size(self):
+		return SEGMENT_HEADER.size + self.count * RECORD.size + (INDEX_HEADER.size + self.count * INDEX_ENTRY.size if self.port_index is None else 0)
+
+
+class HistoryLog(object):  # pylint: disable=too-many-instance-attributes
+	"""Segmented history log in the directory path"""
+	def __init__(self, path, segment_size=64 * 1024 * 1024, segment_age=3600.0, retention=0.0, max_size=0):
+		self.path = path
+		self.segment_size = segment_size
+		self.segment_age = segment_age
+		self.retention = retention
+		self.max_size = max_size
+		# Filled by NetFilter, emptied by flush(), deque operations do not need a lock
+		self.pending = collections.deque()
+		self.lock = threading.Lock()
+		self.segments = []
+		self.active = None
+		self.file = None
+		os.makedirs(path, exist_ok=True)
+		self.recover()
+
+	def recover(self):
+		"""Load the closed segments, segments without index (crash) are indexed and closed"""
+		for name in sorted(os.listdir(self.path)):
+			if not (name.startswith('history-') and name.endswith('.log')):
+				continue
+			path = os.path.join(self.path, name)
+			try:
+				if os.path.exists(index_path(path)):
+					count, first, last = read_index_header(path)
+				else:
+					port_index, count, first, last = scan(path)
+					write_index(path, port_index, count, first, last)
+					log.warning("Indexed history segment %s with %i records left open by a crash", path, count)
+			except (HistoryError, IOError, OSError, struct.error) as e:
+				log.error("Skipping history segment %s: %s", path, e)
+				continue
+			self.segments.append(Segment(path, count, first, last))
+		log.info("History log %s has %i segments with %i records", self.path, len(self.segments), sum(s.count for s in self.segments))
+
+	def __len__(self):
+		return sum(s.count for s in self.segments) + (self.active.count if self.active is not None else 0)
+
+	def size(self):
+		return sum(s.size for s in self.segments) + (self.active.size if self.active is not None else 0)
+
+	def append(self, record, logged=None):
+		"""Log a NEW or DESTROY event, written by the next flush()"""
+		self.pending.append((record, time.time() if logged is None else logged))
+
+	def open_segment(self, logged):
+		path = os.path.join(self.path, 'history-%016i.log' % int(logged * 1000000))
+		while os.path.exists(path):
+			path = path[:-len('.log')] + '_.log'
+		self.file = open(path, 'wb')
+		self.file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, VERSION, RECORD.size, logged))
+		self.active = Segment(path, 0, logged, logged, collections.defaultdict(list))
+		log.debug("Opened history segment %s", path, level=2)
+
+	def flush(self):
+		"""Write the pending events, rotating segments as they fill up. Returns the number written."""
+		written = 0
+		with self.lock:
+			while self.pending:
+				if self.active is None:
+					self.open_segment(self.pending[0][1])
+				active = self.active
+				room = max((self.segment_size - active.size) // RECORD.size, 1)
+				chunk = []
+				port_index = active.port_index
+				number = active.count
+				while self.pending and len(chunk) < room:
+					record, logged = self.pending.popleft()
+					chunk.append(pack(record, logged))
+					port_index[(record.nat_port, record.protocol)].append(number)
+					number += 1
+					active.last = logged
+				self.file.write(b''.join(chunk))
+				active.count = number
+				written += len(chunk)
+				if active.size >= self.segment_size:
+					self.close_active()
+			if self.file is not None:
+				self.file.flush()
+				if time.time() - self.active.created >= self.segment_age:
+					self.close_active()
+		self.expire()
+		return written
+
+	def close_active(self):
+		# Called with lock held
+		if self.active is None:
+			return
+		active = self.active
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self.file.close()
+		self.file = None
+		write_index(active.path, active.port_index, active.count, active.first, active.last)
+		self.segments.append(Segment(active.path, active.count, active.first, active.last))
+		self.active = None
+		log.debug("Closed history segment %s with %i records", active.path, active.count, level=2)
+
+	def close(self):
+		"""Write the pending events and close the segment being written"""
+		self.flush()
+		with self.lock:
+			self.close_active()
+
+	def expire(self):
+		"""Remove closed segments older than retention and the oldest while the log is larger than max_size"""
+		now = time.time()
+		with self.lock:
+			size = self.size()
+			while self.segments:
+				segment = self.segments[0]
+				if not ((self.retention and segment.last < now - self.retention) or (self.max_size and size > self.max_size)):
+					break
+				del self.segments[0]
+				size -= segment.size
+				for path in (segment.path, index_path(segment.path)):
+					try:
+						os.unlink(path)
+					except OSError as e:
+						log.error("Failed to remove history file %s: %s", path, e)
+				log.debug("Removed history segment %s", segment.path, level=2)
+
+	def events(self, nat_port, protocol):
+		"""[(segment, record numbers)] of (nat_port, protocol) of all segments, oldest first.
+		Record numbers of closed segments are read from the index lazily, by the returned callable."""
+		with self.lock:
+			segments = [(s, (lambda s=s: index_lookup(s.path, nat_port, protocol))) for s in self.segments]
+			if self.active is not None:
+				numbers = list(self.active.port_index.get((nat_port, protocol), ()))
+				segments.append((self.active, lambda: numbers))
+		return segments
+
+	def lookup(self, nat_ip, nat_port, protocol, when):
+		"""Connection holding nat_ip:nat_port/protocol at epoch when, as (ConnRecord, logged at, ended at).
+		ended at is the logging time of the next event on the port (DESTROY or a new connection) or None.
+		Returns None if the port was not in use at that time."""
+		segments = self.events(nat_port, protocol)
+		found = None
+		for i in range(len(segments) - 1, -1, -1):
+			segment, numbers = segments[i]
+			if segment.first > when:
+				continue
+			try:
+				numbers = numbers()
+				if not numbers:
+					continue
+				with open(segment.path, 'rb') as f:
+					for j in range(len(numbers) - 1, -1, -1):
+						record, logged = unpack(os.pread(f.fileno(), RECORD.size, SEGMENT_HEADER.size + numbers[j] * RECORD.size))
+						if logged <= when and record.nat_ip == nat_ip:
+							found = (i, j, record, logged)
+							break
+			except (IOError, OSError) as e:
+				# Removed by expire() in the meantime
+				log.debug("Skipping history segment %s: %s", segment.path, e, level=4)
+				continue
+			if found is not None:
+				break
+		if found is None or found[2].sig_type != conn_record.SIG_NEW:
+			return None
+		i, j, record, logged = found
+		return record, logged, self.next_event(segments, i, j + 1, nat_ip)
+
+	@staticmethod
+	def next_event(segments, i, j, nat_ip):
+		"""Logging time of the first event of nat_ip from record j of segment i on"""
+		for segment, numbers in segments[i:]:
+			try:
+				numbers = numbers()[j:]
+				if not numbers:
+					continue
+				with open(segment.path, 'rb') as f:
+					for number in numbers:
+						record, logged = unpack(os.pread(f.fileno(), RECORD.size, SEGMENT_HEADER.size + number * RECORD.size))
+						if record.nat_ip == nat_ip:
+							return logged
+			except (IOError, OSError):
+				pass
+			finally:
+				j = 0
+		return None
+
+
+class HistoryThread(base_thread.BaseThread):
+	"""Writes the events logged by NetFilter every flush_interval seconds"""
+	def __init__(self, shared_resource):
+		base_thread.BaseThread.__init__(self, shared_resource['statistics'])
+		log.debug("Initializing history thread", level=2)
+		self.setName('History')
+		self.history = shared_resource['history']
+		self.interval = shared_resource['conf']['history']['flush_interval']
+		self.ev = threading.Event()
+		self.records = self.shared_statistics.counter('natconnd_history_records_total', 'Events written to the history log')
+		self.errors = self.shared_statistics.counter('natconnd_history_write_errors_total', 'Failed writes of the history log')
+		self.shared_statistics.gauge('natconnd_history_segments', 'Segments of the history log', func=lambda: len(self.history.segments) + (self.history.active is not None))
+		self.shared_statistics.gauge('natconnd_history_bytes', 'Size of the history log', func=self.history.size)
+
+	def flush(self):
+		try:
+			self.records.inc(self.history.flush())
+		except (IOError, OSError) as e:
+			self.errors.inc()
+			log.error("Failed to write the history log %s: %s - dropping %i events", self.history.path, e, len(self.history.pending))
+			self.history.pending.clear()
+
+	def run(self):
+		log.debug("Starting history thread", level=1)
+		self.running = True
+		while self.running:
+			self.ev.wait(self.interval)
+			self.flush()
+		# Stopped after NetFilter, so its last events are written as well
+		try:
+			self.history.close()
+		except (IOError, OSError) as e:
+			log.error("Failed to close the history log %s: %s", self.history.path, e)
+		log.debug("Stopped history thread", level=1)
+
+	def stop(self):
+		log.debug("Stopping history thread", level=1)
+		self.running = False
+		self.ev.set()
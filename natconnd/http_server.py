@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import datetime
+import heapq
 import logging
+import operator
+import socket
 import socketserver
+import time
 import wsgiref
 import wsgiref.simple_server
-import ipaddress
 import json
-import copy
 import falcon
 
 try:
@@ -14,10 +17,19 @@ try:
 except ImportError:
 	pass
 
+from . import async_http_server
 from . import base_thread
+from . import conn_record
+from . import conn_table
+from . import profiler
 
 log = logging.getLogger("cygnus.pynatconnd")
 
+# Results of natconnd_http_requests_total
+REQUEST_RESULTS = ('success', 'not_found', 'unauthorized', 'bad_request', 'error')
+# Paths the asyncio engine runs in a thread pool, they may take long enough to stall other connections
+OFFLOAD_PATHS = ('/batch/', '/debug', '/history')
+
 app = falcon.API()
 
 
@@ -25,6 +37,13 @@ class ThreadingWSGIServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSG
 	pass
 
 
+class ReusePortWSGIServer(ThreadingWSGIServer):
+	"""ThreadingWSGIServer sharing its port with other processes (SO_REUSEPORT)"""
+	def server_bind(self):
+		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		ThreadingWSGIServer.server_bind(self)
+
+
 class NoLoggingWSGIRequestHandler(wsgiref.simple_server.WSGIRequestHandler, object):  # pylint:disable=too-few-public-methods
 	"""WSGIRequestHandler that logs to debug instead of stderr"""
 	def log_message(self, _, *args):
@@ -39,55 +58,82 @@ class BaseHandler(object):  # pylint:disable=too-few-public-methods
 	def __init__(self, shared_resources):
 		log.debug("Initializing BaseHandler class", level=2)
 		self.shared_data = shared_resources['data']
-		self.shared_data_lock = shared_resources['lock']
 		self.shared_statistics = shared_resources['statistics']
 		self.configuration = shared_resources['conf']
+		self.acl = shared_resources['acl']
+		self.requests = dict(
+			(result, self.shared_statistics.counter('natconnd_http_requests_total', 'Lookup requests by result', {'result': result}))
+			for result in REQUEST_RESULTS)
 
 	def check_acl(self, addr):
-		ip = ipaddress.IPv4Address(addr)
-		for x in self.configuration['http_server']['ip_acl']:
-			net = ipaddress.IPv4Network(x)
-			if ip in net:
-				return True
-		return False
+		return self.acl.check(addr)
+
+	def count_request(self, result):
+		self.requests[result].inc()
 
 
 class GetConnDetails(BaseHandler):  # pylint:disable=too-few-public-methods
+	"""Lookup of connections by any indexed field.
+	For the configured key_name the most recent matching connection is returned as object (optionally narrowed
+	down by protocol and nat_ip query parameters), for other indexes a list of all matching connections.
+	Responses are the compact JSON pre-encoded on insert, indented JSON is returned with pretty=true."""
+	def __init__(self, shared_resources):
+		BaseHandler.__init__(self, shared_resources)
+		self.lookup_latency = self.shared_statistics.histogram('natconnd_lookup_latency_seconds', 'Time to resolve a lookup key')
+
+	@staticmethod
+	def parse_narrow(req):
+		"""Optional protocol and nat_ip query parameters narrowing down the result"""
+		return dict((k, conn_record.parse_field(k, req.get_param(k))) for k in ('protocol', 'nat_ip') if req.get_param(k))
+
+	def resolve(self, key_name, key_value, narrow, pretty=False):
+		"""Returns the encoded JSON representation of the connections matching key_value or None.
+		Raises ValueError or KeyError for invalid values."""
+		with self.lookup_latency.time():
+			records = self.shared_data.lookup(key_name, conn_table.parse_index_value(key_name, key_value))
+		if narrow:
+			records = [r for r in records if all(getattr(r, k) == v for k, v in narrow.items())]
+		if not records:
+			return None
+		if key_name == self.configuration['data']['key_name']:
+			return records[-1].to_json(pretty)
+		if pretty:
+			return json.dumps([record.to_dict() for record in records], sort_keys=True, indent=4).encode('utf-8')
+		return b'[' + b','.join(record.to_json() for record in records) + b']'
+
 	def on_get(self, req, resp, key_value, key_name):
 		log.debug("Got GET request for %s from %s", req.path, req.remote_addr, level=2)
-		self.shared_statistics['http_stat']['no_of_requests'] += 1
 		try:
 			if not self.check_acl(req.remote_addr):
-				self.shared_statistics['http_stat']['unauthorized_requests'] += 1
+				self.count_request('unauthorized')
 				log.error("GET request from an ip %s outside the permitted ip", req.remote_addr)
 				resp.content_type = "text/html"
 				resp.body = "Forbidden"
 				resp.status = falcon.HTTP_403
 
-			elif not key_name == self.configuration['data']['key_name']:
-				self.shared_statistics['http_stat']['bad_requests'] += 1
-				log.error("Mismatch in key_name betweeen requesting key_name:'%s' and available key_name: '%s'", key_name, self.configuration['data']['key_name'])
+			elif key_name not in self.shared_data.indexes:
+				self.count_request('bad_request')
+				log.error("Mismatch in key_name betweeen requesting key_name:'%s' and available indexes: '%s'", key_name, ", ".join(self.shared_data.indexes))
 				resp.content_type = "text/html"
 				resp.body = "Mismatch"
 				resp.status = falcon.HTTP_400
 
 			else:
-				with self.shared_data_lock:
-					if int(key_value) in self.shared_data:
-						x = copy.deepcopy(self.shared_data[int(key_value)])
-						log.debug("Found a connection matching the requirement %s -> %s:%s -> %s:%s at %s", x['src_ip'], x['nat_ip'], x['nat_port'], x['dst_ip'], x['dst_port'], x['time'], level=2)
-					else:
-						log.info("No connection details found for given key value %s", key_value)
-						x = None
+				try:
+					x = self.resolve(key_name, key_value, self.parse_narrow(req), req.get_param_as_bool('pretty'))
+				except (ValueError, KeyError):
+					x = None
 
 				if not x:
-					self.shared_statistics['http_stat']['unsuccessful_replies'] += 1
+					log.info("No connection details found for given key value %s", key_value)
+					self.count_request('not_found')
 					resp.content_type = "text/html"
 					resp.body = "Not found"
 					resp.status = falcon.HTTP_404
 				else:
-					self.shared_statistics['http_stat']['successful_replies'] += 1
-					resp.body = json.dumps(x, sort_keys=True, indent=4)
+					log.debug("Found connections matching %s=%s", key_name, key_value, level=2)
+					self.count_request('success')
+					resp.data = x
 					resp.content_type = "application/json"
 					resp.status = falcon.HTTP_200
 
@@ -97,11 +143,117 @@ class GetConnDetails(BaseHandler):  # pylint:disable=too-few-public-methods
 			log.error("HTTPError occured in DeliverThread with status %s title %s", e.status, e.title, exc_info=True)
 			raise
 		except Exception as e:
+			self.count_request('error')
 			log.error("Exception occured in DeliverThread with message %s", e, exc_info=True)
 			raise falcon.HTTPInternalServerError(title="Internal server error", description="Generic exception for status path %s" % req.path)
 
 
+class BatchConnDetails(GetConnDetails):  # pylint:disable=too-few-public-methods
+	"""Lookup of many keys of one index in a single request.
+	Keys are passed as JSON list in the POST body or comma separated in the keys query parameter,
+	the response maps every found key to its result like GetConnDetails and lists the missing keys
+	and the keys that are no valid value of the index."""
+	def on_get(self, req, resp, key_name):  # pylint:disable=arguments-differ
+		self.handle_batch(req, resp, key_name, [k for k in (req.get_param('keys') or '').split(',') if k])
+
+	def on_post(self, req, resp, key_name):
+		try:
+			keys = json.loads(req.bounded_stream.read().decode('utf-8'))
+			if not isinstance(keys, list):
+				raise ValueError("Expected a JSON list")
+		except ValueError as e:
+			self.count_request('bad_request')
+			raise falcon.HTTPBadRequest(title="Invalid request body", description=str(e))
+		self.handle_batch(req, resp, key_name, keys)
+
+	def handle_batch(self, req, resp, key_name, keys):
+		log.debug("Got batch request for %s with %i keys from %s", req.path, len(keys), req.remote_addr, level=2)
+		if not self.check_acl(req.remote_addr):
+			self.count_request('unauthorized')
+			log.error("Batch request from an ip %s outside the permitted ip", req.remote_addr)
+			resp.content_type = "text/html"
+			resp.body = "Forbidden"
+			resp.status = falcon.HTTP_403
+			return
+
+		if key_name not in self.shared_data.indexes or len(keys) > self.configuration['http_server']['batch_max_keys']:
+			self.count_request('bad_request')
+			log.error("Invalid batch request for key_name '%s' with %i keys", key_name, len(keys))
+			resp.content_type = "text/html"
+			resp.body = "Mismatch"
+			resp.status = falcon.HTTP_400
+			return
+
+		try:
+			narrow = self.parse_narrow(req)
+		except (ValueError, KeyError) as e:
+			self.count_request('bad_request')
+			log.error("Invalid protocol or nat_ip in batch request for key_name '%s': %s", key_name, e)
+			raise falcon.HTTPBadRequest(title="Invalid query parameter", description=str(e))
+		# Keys repeated in the request are resolved and reported once, in the order they first appear
+		unique = dict()
+		for key_value in keys:
+			unique.setdefault(str(key_value), key_value)
+		found = []
+		missing = []
+		invalid = []
+		for key_value in unique.values():
+			try:
+				x = self.resolve(key_name, str(key_value), narrow)
+			except (ValueError, KeyError):
+				invalid.append(key_value)
+				continue
+			if x:
+				found.append(json.dumps(str(key_value)).encode('utf-8') + b':' + x)
+			else:
+				missing.append(key_value)
+
+		log.debug("Batch request resolved %i keys, %i missing, %i invalid", len(found), len(missing), len(invalid), level=2)
+		self.count_request('success')
+		# Assembled from the pre-encoded results, same as json.dumps({'found': ..., 'missing': ..., 'invalid': ...})
+		resp.data = b'{"found":{' + b','.join(found) + b'},"missing":' + json.dumps(missing, separators=(',', ':')).encode('utf-8') + \
+			b',"invalid":' + json.dumps(invalid, separators=(',', ':')).encode('utf-8') + b'}'
+		resp.content_type = "application/json"
+		resp.status = falcon.HTTP_200
+
+
 class DebugNatconnd(BaseHandler):  # pylint:disable=too-few-public-methods
+	"""Dump of the connection table as NDJSON, one connection per line, streamed from a snapshot.
+	Query parameters:
+		src_ip, nat_ip, dst_ip, protocol - exact match
+		src_port, nat_port, dst_port - port or port range (e.g. 1024-2047)
+		min_age, max_age - age of the connection in seconds
+		limit - maximum number of connections, returns connections ordered by insertion with the
+			cursor for the next page in the X-Next-Cursor header
+		cursor - continue after the connection with that cursor"""
+	CHUNK_SIZE = 1000
+
+	@staticmethod
+	def parse_filters(req):
+		"""Returns a list of predicates on records built from the query parameters"""
+		filters = []
+		for name in ('src_ip', 'nat_ip', 'dst_ip', 'protocol'):
+			if req.get_param(name):
+				value = conn_record.parse_field(name, req.get_param(name))
+				filters.append(lambda r, n=name, v=value: getattr(r, n) == v)
+		for name in conn_record.PORT_FIELDS:
+			if req.get_param(name):
+				low, _, high = req.get_param(name).partition('-')
+				low, high = int(low), int(high or low)
+				filters.append(lambda r, n=name, lo=low, hi=high: lo <= getattr(r, n) <= hi)
+		now = time.time()
+		if req.get_param('min_age'):
+			newest = now - float(req.get_param('min_age'))
+			filters.append(lambda r: r.time <= newest)
+		if req.get_param('max_age'):
+			oldest = now - float(req.get_param('max_age'))
+			filters.append(lambda r: r.time >= oldest)
+		return filters
+
+	def stream(self, records):
+		for i in range(0, len(records), self.CHUNK_SIZE):
+			yield b''.join(record.to_json() + b'\n' for record in records[i:i + self.CHUNK_SIZE])
+
 	def on_get(self, req, resp):
 		log.debug("Got GET request for %s from %s", req.path, req.remote_addr, level=2)
 		if not self.check_acl(req.remote_addr):
@@ -109,17 +261,67 @@ class DebugNatconnd(BaseHandler):  # pylint:disable=too-few-public-methods
 			resp.content_type = "text/html"
 			resp.body = "Forbidden"
 			resp.status = falcon.HTTP_403
+			return
 
-		else:
-			with self.shared_data_lock:
-				log_dict = copy.deepcopy(self.shared_data)
+		try:
+			filters = self.parse_filters(req)
+			cursor = int(req.get_param('cursor') or 0)
+			limit = int(req.get_param('limit') or 0)
+		except (ValueError, KeyError) as e:
+			raise falcon.HTTPBadRequest(title="Invalid filter", description=str(e))
 
-			resp.body = json.dumps(log_dict, sort_keys=True, indent=4)
-			resp.content_type = "application/json"
-			resp.status = falcon.HTTP_200
+		records = self.shared_data.records()
+		if filters or cursor:
+			records = [r for r in records if r.seq > cursor and all(f(r) for f in filters)]
+		if limit:
+			records = heapq.nsmallest(limit, records, key=operator.attrgetter('seq'))
+			if len(records) == limit:
+				resp.set_header('X-Next-Cursor', str(records[-1].seq))
+		log.debug("Streaming %i connections to %s", len(records), req.remote_addr, level=4)
+
+		resp.stream = self.stream(records)
+		resp.content_type = "application/x-ndjson"
+		resp.status = falcon.HTTP_200
 
 
 class NagiosViewer(BaseHandler):  # pylint:disable=too-few-public-methods
+	"""Legacy JSON statistics, derived from the metrics registry"""
+	def __init__(self, shared_resources):
+		BaseHandler.__init__(self, shared_resources)
+		self.threads = shared_resources.get('threads', ())
+
+	def statistics(self):
+		stats = self.shared_statistics
+		results = dict((result, stats.value('natconnd_http_requests_total', result=result)) for result in REQUEST_RESULTS)
+		now = time.time()
+		return {
+			'queue_size': stats.value('natconnd_queue_events'),
+			'queue_events': stats.value('natconnd_queue_events'),
+			'queue_high_water': stats.value('natconnd_queue_high_water_events'),
+			'queue_dropped': sum(stats.value('natconnd_queue_dropped_events_total', sig_type=name) for name in list(conn_record.SIG_TYPE_NAMES.values()) + ['unknown']),
+			'shared_data_size': len(self.shared_data),
+			'number_of_created_items': stats.value('natconnd_connections_created_total'),
+			'number_of_deleted_items': stats.value('natconnd_connections_deleted_total'),
+			'expired_data': stats.value('natconnd_connections_expired_total'),
+			'timer_backlog': stats.value('natconnd_timer_backlog'),
+			'prgm_start_time': stats.value('natconnd_start_time_seconds'),
+			'http_stat': {
+				'no_of_requests': sum(results.values()),
+				'successful_replies': results['success'],
+				'unsuccessful_replies': results['not_found'],
+				'unauthorized_requests': results['unauthorized'],
+				'bad_requests': results['bad_request'],
+			},
+			'gc_stat': {
+				'runs': stats.value('natconnd_gc_runs_total'),
+				'last_pause': stats.value('natconnd_gc_last_pause_seconds'),
+				'max_pause': stats.value('natconnd_gc_max_pause_seconds'),
+				'last_duration': stats.value('natconnd_gc_last_duration_seconds'),
+				'last_expired': stats.value('natconnd_gc_last_expired'),
+			},
+			'threads_stat': dict((thread.getName(), {'alive_time': thread.alive_time - now, 'is_alive': thread.is_alive()}) for thread in self.threads),
+		}
+
 	def on_get(self, req, resp):
 		log.debug("Got GET request for %s from %s", req.path, req.remote_addr, level=2)
 		if not self.check_acl(req.remote_addr):
@@ -128,11 +330,162 @@ class NagiosViewer(BaseHandler):  # pylint:disable=too-few-public-methods
 			resp.body = "Forbidden"
 			resp.status = falcon.HTTP_403
 		else:
-			resp.body = json.dumps(self.shared_statistics, sort_keys=True, indent=4)
+			if req.get_param_as_bool('pretty'):
+				resp.body = json.dumps(self.statistics(), sort_keys=True, indent=4)
+			else:
+				resp.body = json.dumps(self.statistics(), sort_keys=True, separators=(',', ':'))
+			resp.content_type = "application/json"
+			resp.status = falcon.HTTP_200
+
+
+class HistoryViewer(BaseHandler):  # pylint:disable=too-few-public-methods
+	"""Point in time lookup in the history log: the connection holding a NAT mapping at a given time.
+	Query parameters:
+		nat_ip, nat_port - the NAT mapping
+		protocol - tcp (default) or udp
+		time - epoch seconds or ISO 8601, local time unless it has an offset
+	The result is the connection with start (logged NEW event) and end (next event on the port,
+	null if there was none yet) as epoch seconds, 404 if the port was not in use at that time."""
+	def __init__(self, shared_resources):
+		BaseHandler.__init__(self, shared_resources)
+		self.history = shared_resources['history']
+		self.query_latency = self.shared_statistics.histogram('natconnd_history_query_seconds', 'Time to answer a history query')
+
+	@staticmethod
+	def parse_time(value):
+		try:
+			return float(value)
+		except ValueError:
+			return datetime.datetime.fromisoformat(value).timestamp()
+
+	def on_get(self, req, resp):
+		log.debug("Got GET request for %s from %s", req.path, req.remote_addr, level=2)
+		if not self.check_acl(req.remote_addr):
+			log.error("GET request to /history from an ip %s outside the permitted ip", req.remote_addr)
+			resp.content_type = "text/html"
+			resp.body = "Forbidden"
+			resp.status = falcon.HTTP_403
+			return
+
+		try:
+			nat_ip = conn_record.parse_field('nat_ip', req.get_param('nat_ip', required=True))
+			nat_port = conn_record.parse_field('nat_port', req.get_param('nat_port', required=True))
+			protocol = conn_record.parse_field('protocol', req.get_param('protocol') or 'tcp')
+			when = self.parse_time(req.get_param('time', required=True))
+		except (ValueError, KeyError) as e:
+			raise falcon.HTTPBadRequest(title="Invalid query", description=str(e))
+
+		with self.query_latency.time():
+			found = self.history.lookup(nat_ip, nat_port, protocol, when)
+		if found is None:
+			log.info("No connection found in the history for %s:%s at %s", req.get_param('nat_ip'), nat_port, when)
+			resp.content_type = "text/html"
+			resp.body = "Not found"
+			resp.status = falcon.HTTP_404
+			return
+
+		record, start, end = found
+		result = record.to_dict()
+		result.update(start=start, end=end)
+		if req.get_param_as_bool('pretty'):
+			resp.body = json.dumps(result, sort_keys=True, indent=4)
+		else:
+			resp.body = json.dumps(result, sort_keys=True, separators=(',', ':'))
+		resp.content_type = "application/json"
+		resp.status = falcon.HTTP_200
+
+
+class ProfileViewer(BaseHandler):  # pylint:disable=too-few-public-methods
+	"""On-demand profiling of the daemon threads, see profiler.
+	POST starts a profile in the background and answers 202, 409 if one is running already:
+		mode - cpu (default, collapsed stacks) or alloc (tracemalloc growth)
+		seconds - duration, default 10
+		interval - cpu: milliseconds between samples, at least 1, default 10
+		idle - cpu: include threads waiting for work, default true
+		frames - alloc: frames per traceback, default 1 (grouped by line)
+		limit - alloc: number of allocation sites, default 50
+	Invalid parameters are answered with 400.
+	GET returns the result of the last profile, 202 while it is running and 404 if there is none."""
+	def __init__(self, shared_resources):
+		BaseHandler.__init__(self, shared_resources)
+		self.profiler = profiler.Profiler()
+
+	def forbidden(self, req, resp):
+		if self.check_acl(req.remote_addr):
+			return False
+		log.error("%s request to /profile from an ip %s outside the permitted ip", req.method, req.remote_addr)
+		resp.content_type = "text/html"
+		resp.body = "Forbidden"
+		resp.status = falcon.HTTP_403
+		return True
+
+	def on_post(self, req, resp):
+		log.debug("Got POST request for %s from %s", req.path, req.remote_addr, level=2)
+		if self.forbidden(req, resp):
+			return
+		mode = req.get_param('mode') or 'cpu'
+		try:
+			seconds = float(req.get_param('seconds') or 10)
+			if mode == 'cpu':
+				options = dict(interval=float(req.get_param('interval') or 10) / 1000, idle=req.get_param_as_bool('idle', default=True))
+			else:
+				options = dict(frames=min(max(int(req.get_param('frames') or 1), 1), 25), limit=int(req.get_param('limit') or 50))
+			started = self.profiler.start(mode, seconds, **options)
+		except falcon.HTTPBadRequest:
+			# idle is not a boolean
+			self.count_request('bad_request')
+			raise
+		except ValueError as e:
+			self.count_request('bad_request')
+			log.error("Invalid profile request from %s: %s", req.remote_addr, e)
+			raise falcon.HTTPBadRequest(title="Invalid profile request", description=str(e))
+		resp.body = json.dumps(self.profiler.current, sort_keys=True, separators=(',', ':'))
+		resp.content_type = "application/json"
+		resp.status = falcon.HTTP_202 if started else falcon.HTTP_409
+
+	def on_get(self, req, resp):
+		log.debug("Got GET request for %s from %s", req.path, req.remote_addr, level=2)
+		if self.forbidden(req, resp):
+			return
+		if self.profiler.running:
+			current = self.profiler.current
+			resp.set_header('Retry-After', str(max(int(current['started'] + current['seconds'] - time.time()) + 1, 1)))
+			resp.body = json.dumps(current, sort_keys=True, separators=(',', ':'))
 			resp.content_type = "application/json"
+			resp.status = falcon.HTTP_202
+		elif self.profiler.result is None:
+			resp.content_type = "text/html"
+			resp.body = "Not found"
+			resp.status = falcon.HTTP_404
+		else:
+			resp.body = self.profiler.result
+			resp.content_type = "text/plain"
 			resp.status = falcon.HTTP_200
 
 
+class MetricsViewer(BaseHandler):  # pylint:disable=too-few-public-methods
+	def on_get(self, req, resp):
+		log.debug("Got GET request for %s from %s", req.path, req.remote_addr, level=2)
+		if not self.check_acl(req.remote_addr):
+			log.error("GET request to /metrics from an ip %s outside the permitted ip", req.remote_addr)
+			resp.content_type = "text/html"
+			resp.body = "Forbidden"
+			resp.status = falcon.HTTP_403
+		else:
+			resp.body = self.shared_statistics.render()
+			resp.content_type = "text/plain; version=0.0.4"
+			resp.status = falcon.HTTP_200
+
+
+def make_server(host, port, wsgi_app, configuration, reuse_port=False):
+	"""Bound server of the configured engine, providing serve_forever() and shutdown()"""
+	if configuration['http_server']['engine'] == 'asyncio':
+		return async_http_server.AsyncWSGIServer(host, port, wsgi_app, keepalive_timeout=configuration['http_server']['keepalive_timeout'], reuse_port=reuse_port,
+			offload=OFFLOAD_PATHS)
+	server_class = ReusePortWSGIServer if reuse_port else ThreadingWSGIServer
+	return wsgiref.simple_server.make_server(host, port, wsgi_app, server_class=server_class, handler_class=NoLoggingWSGIRequestHandler)
+
+
 class HTTPServer(base_thread.BaseThread):
 	def __init__(self, shared_resources, host):
 		assert 'ip' in host and 'port' in host
@@ -143,14 +496,27 @@ class HTTPServer(base_thread.BaseThread):
 		get_conn_details = GetConnDetails(shared_resources)
 		app.add_route('/{key_name}/{key_value}', get_conn_details)
 
+		batch_conn_details = BatchConnDetails(shared_resources)
+		app.add_route('/batch/{key_name}', batch_conn_details)
+
 		debug_natconnd = DebugNatconnd(shared_resources)
 		app.add_route('/debug', debug_natconnd)
 
 		nagios_viewer = NagiosViewer(shared_resources)
 		app.add_route('/nagios', nagios_viewer)
 
-		self.http_serv = wsgiref.simple_server.make_server(host['ip'], host['port'], app, server_class=ThreadingWSGIServer, handler_class=NoLoggingWSGIRequestHandler)
-		log.debug("Initializing http_server thread Complete at %s:%s", host['ip'], host['port'])
+		metrics_viewer = MetricsViewer(shared_resources)
+		app.add_route('/metrics', metrics_viewer)
+
+		profile_viewer = ProfileViewer(shared_resources)
+		app.add_route('/profile', profile_viewer)
+
+		if shared_resources.get('history') is not None:
+			history_viewer = HistoryViewer(shared_resources)
+			app.add_route('/history', history_viewer)
+
+		self.http_serv = make_server(host['ip'], host['port'], app, self.configuration)
+		log.debug("Initializing http_server thread Complete at %s:%s with %s engine", host['ip'], host['port'], self.configuration['http_server']['engine'])
 
 	def run(self):
 		self.running = True
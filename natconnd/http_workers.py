@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""HTTP worker processes answering lookups from the shared memory table.
+
+All workers listen on the same port (SO_REUSEPORT), the kernel spreads connections across
+them. Workers only serve lookups and batch lookups of key_name, everything else (/debug,
+/nagios, /metrics, secondary indexes) is served by the daemon on admin_port.
+
+Request counters and lookup latency of the workers are published in a WorkerStats segment
+every STATS_INTERVAL seconds and added to the metrics of the daemon when they are read."""
+import multiprocessing
+import os
+import signal
+import struct
+import threading
+import time
+import logging
+import logging.handlers
+
+from multiprocessing import shared_memory
+
+import falcon
+
+try:
+	import cygnuslog  # pylint: disable=unused-import
+except ImportError:
+	pass
+
+from . import base_thread
+from . import http_server
+from . import ip_acl
+from . import metrics
+from . import pynatconnd_config
+from . import shm_table
+
+log = logging.getLogger('cygnus.pynatconnd')
+
+# Per worker: requests per result, lookups per latency bucket (last one +Inf), lookups, latency sum
+STATS = struct.Struct('<%iQd' % (len(http_server.REQUEST_RESULTS) + len(metrics.LATENCY_BUCKETS) + 2))
+# Seconds between updates of the published statistics of a worker
+STATS_INTERVAL = 1.0
+
+
+class WorkerStats(object):
+	"""Statistics of the worker processes in shared memory, one slot per worker written only by it.
+	Creates the segment for workers workers if name is None, otherwise attaches to it."""
+	def __init__(self, workers=None, name=None):
+		if name is None:
+			self.workers = workers
+			# New segments are zero filled
+			self.shm = shared_memory.SharedMemory(create=True, size=workers * STATS.size)
+		else:
+			self.shm = shm_table._attach(name)  # pylint: disable=protected-access
+			self.workers = self.shm.size // STATS.size
+		self.name = self.shm.name
+		self.buf = self.shm.buf
+
+	def read(self, number):
+		return STATS.unpack_from(self.buf, number * STATS.size)
+
+	def publish(self, number, statistics, base):
+		"""Write the statistics of worker number, added to base (the values of the worker it replaced)"""
+		values = [statistics.value('natconnd_http_requests_total', result=result) for result in http_server.REQUEST_RESULTS]
+		cumulative, total, count = statistics.histogram('natconnd_lookup_latency_seconds', 'Time to resolve a lookup key').value()
+		values.extend(c - p for c, p in zip(cumulative, [0] + cumulative[:-1]))
+		values.append(count)
+		values.append(total)
+		STATS.pack_into(self.buf, number * STATS.size, *[b + v for b, v in zip(base, values)])
+
+	def totals(self):
+		"""Sums of all workers"""
+		return [sum(values) for values in zip(*(self.read(number) for number in range(self.workers)))]
+
+	def requests(self, result):
+		"""Counter cell of the requests with result"""
+		return [self.totals()[http_server.REQUEST_RESULTS.index(result)]]
+
+	def latency(self):
+		"""Histogram cell of the lookup latency"""
+		totals = self.totals()
+		first = len(http_server.REQUEST_RESULTS)
+		buckets = len(metrics.LATENCY_BUCKETS) + 1
+		return [totals[first:first + buckets], totals[first + buckets + 1], totals[first + buckets]]
+
+	def close(self, unlink=False):
+		if unlink:
+			self.shm.unlink()
+
+
+def publish_stats(stats, number, statistics):
+	# A restarted worker continues the counts of the one it replaces
+	base = stats.read(number)
+	while True:
+		time.sleep(STATS_INTERVAL)
+		stats.publish(number, statistics, base)
+
+
+def worker_main(config_file, shm_name, host, port, stats_name, number):  # pylint: disable=too-many-arguments
+	"""Entry point of worker process number"""
+	from . import daemon  # pylint: disable=import-outside-toplevel,cyclic-import
+	config = pynatconnd_config.PynatconndConfig(config_file).get_configobj()
+	if callable(getattr(log, "set_facility", None)):
+		log.set_facility(int(config["syslog"]["local_facility"]) + logging.handlers.SysLogHandler.LOG_LOCAL0)
+		log.set_debug_level(int(config["syslog"]["debug_level"]))
+	threading.Thread(target=exit_with_parent, args=(os.getppid(), ), daemon=True).start()
+	acl = ip_acl.IPACL(config['http_server']['ip_acl'], cache_size=config['http_server']['acl_cache_size'])
+	signal.signal(signal.SIGHUP, lambda signum, frame: daemon.reload_config(config_file, acl))
+	shared_resources = {
+		'data': shm_table.SharedTable(config['data']['key_name'], name=shm_name),
+		'statistics': metrics.Registry(),
+		'conf': config,
+		'acl': acl,
+	}
+	worker_app = falcon.API()
+	worker_app.add_route('/{key_name}/{key_value}', http_server.GetConnDetails(shared_resources))
+	worker_app.add_route('/batch/{key_name}', http_server.BatchConnDetails(shared_resources))
+	threading.Thread(target=publish_stats, args=(WorkerStats(name=stats_name), number, shared_resources['statistics']), daemon=True).start()
+	server = http_server.make_server(host, port, worker_app, config, reuse_port=True)
+	log.debug("HTTP worker listening on %s:%s", host, port, level=2)
+	server.serve_forever()
+
+
+def exit_with_parent(parent_pid):
+	"""Workers must not serve a stale table after the daemon was killed"""
+	while os.getppid() == parent_pid:
+		time.sleep(1.0)
+	os._exit(0)  # pylint: disable=protected-access
+
+
+class HTTPWorkers(base_thread.BaseThread):
+	"""Starts the worker processes and restarts the ones that died"""
+	def __init__(self, shared_resources, host, config_file, table):
+		base_thread.BaseThread.__init__(self, shared_resources['statistics'])
+		log.debug("Initializing HTTP workers thread", level=2)
+		self.setName('HTTPWorkers')
+		self.host = host
+		self.config_file = config_file
+		self.table = table
+		self.join_timeout = shared_resources['conf']['threading']['join_timeout']
+		# spawn instead of fork, the daemon process has threads holding locks
+		self.context = multiprocessing.get_context('spawn')
+		self.processes = [None] * shared_resources['conf']['http_server']['workers']
+		self.stats = WorkerStats(workers=len(self.processes))
+		for result in http_server.REQUEST_RESULTS:
+			self.shared_statistics.counter('natconnd_http_requests_total', 'Lookup requests by result', {'result': result}).add_source(
+				lambda result=result: self.stats.requests(result))
+		self.shared_statistics.histogram('natconnd_lookup_latency_seconds', 'Time to resolve a lookup key').add_source(self.stats.latency)
+		self.ev = threading.Event()
+		self.restarts = self.shared_statistics.counter('natconnd_http_worker_restarts_total', 'HTTP worker processes restarted after they died')
+		self.shared_statistics.gauge('natconnd_http_workers_alive', 'Running HTTP worker processes', func=lambda: sum(1 for p in self.processes if p is not None and p.is_alive()))
+
+	def start_worker(self, number):
+		process = self.context.Process(target=worker_main, args=(self.config_file, self.table.name, self.host['ip'], self.host['port'], self.stats.name, number), name='natconnd-http-%i' % number, daemon=True)
+		process.start()
+		self.processes[number] = process
+		log.debug("Started HTTP worker %i with pid %i", number, process.pid, level=2)
+
+	def reload(self):
+		"""Pass SIGHUP on to the workers"""
+		for process in self.processes:
+			if process is not None and process.is_alive():
+				os.kill(process.pid, signal.SIGHUP)
+
+	def run(self):
+		log.debug("Starting %i HTTP workers on %s:%s", len(self.processes), self.host['ip'], self.host['port'], level=1)
+		self.running = True
+		for number in range(len(self.processes)):
+			self.start_worker(number)
+		while self.running:
+			self.ev.wait(1.0)
+			if not self.running:
+				break
+			for number, process in enumerate(self.processes):
+				if not process.is_alive():
+					log.error("HTTP worker %i with pid %i died with exit code %s - restarting", number, process.pid, process.exitcode)
+					self.restarts.inc()
+					self.start_worker(number)
+		log.debug("Stopped HTTP workers thread", level=1)
+
+	def stop(self):
+		log.debug("Stopping HTTP workers", level=1)
+		self.running = False
+		self.ev.set()
+		for process in self.processes:
+			if process is not None:
+				process.terminate()
+		for process in self.processes:
+			if process is not None:
+				process.join(self.join_timeout)
+		# The daemon keeps its mappings, only the names are removed
+		self.table.close(unlink=True)
+		self.stats.close(unlink=True)
+
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Conntrack ingestion in a separate process.
+
+The ingest process runs QueueWorker with the netlink socket and filters the events, matching
+events and resyncs are passed to the daemon through a ring_buffer.RingBuffer. In the daemon
+IngestReader moves them from the ring into the event queue of NetFilter, so receiving and
+parsing events does not compete with the HTTP server for the GIL.
+
+The ring segment is unlinked when the daemon stops or exits, if the daemon is killed the
+resource tracker of multiprocessing unlinks it."""
+import atexit
+import multiprocessing
+import os
+import select
+import threading
+import time
+import logging
+import logging.handlers
+
+try:
+	import cygnuslog  # pylint: disable=unused-import
+except ImportError:
+	pass
+
+from . import base_thread
+from . import conn_filter
+from . import http_workers
+from . import metrics
+from . import net_filter
+from . import pynatconnd_config
+from . import queue_worker
+from . import ring_buffer
+
+log = logging.getLogger('cygnus.pynatconnd')
+
+# Records moved from the ring per event queue batch at most
+READ_BATCH = 1024
+# Seconds the reader waits for the wakeup pipe when the ring is empty, counters are updated in between
+WAIT_TIMEOUT = ring_buffer.COUNTERS_INTERVAL
+# Seconds between restarts of an ingest process that keeps dying, doubled up to MAX_RESTART_DELAY.
+# A process that ran for MAX_RESTART_DELAY seconds is restarted right away.
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+
+
+def ingest_main(config_file, ring_name, wakeup):
+	"""Entry point of the ingest process, wakeup is the write end of the wakeup pipe"""
+	config = pynatconnd_config.PynatconndConfig(config_file).get_configobj()
+	if callable(getattr(log, "set_facility", None)):
+		log.set_facility(int(config["syslog"]["local_facility"]) + logging.handlers.SysLogHandler.LOG_LOCAL0)
+		log.set_debug_level(int(config["syslog"]["debug_level"]))
+	threading.Thread(target=http_workers.exit_with_parent, args=(os.getppid(), ), daemon=True).start()
+	ring = ring_buffer.RingBuffer(name=ring_name, wakeup=wakeup.fileno())
+	statistics = metrics.Registry()
+	shared_resource = {'conf': config, 'statistics': statistics, 'warm_start': ring_buffer.WarmStartMarker(ring)}
+	writer = ring_buffer.RingWriter(ring, conn_filter.ConnFilter(config['filter']), statistics)
+	worker = queue_worker.QueueWorker(writer, shared_resource)
+	log.debug("Ingest process started", level=2)
+	# Runs in the main thread, the process is terminated to stop it
+	worker.run()
+
+
+class IngestReader(base_thread.BaseThread):  # pylint: disable=too-many-instance-attributes
+	"""Moves events from the ring to the event queue and starts the ingest process.
+	daemon.main calls supervise() to restart the process when it died."""
+	def __init__(self, event_queue, shared_resource, config_file):
+		base_thread.BaseThread.__init__(self, shared_resource['statistics'])
+		log.debug("Initializing ingest reader thread", level=2)
+		self.setName('IngestReader')
+		self.event_queue = event_queue
+		self.config_file = config_file
+		self.join_timeout = shared_resource['conf']['threading']['join_timeout']
+		self.warm_start_done = shared_resource.get('warm_start')
+		self.ring = ring_buffer.RingBuffer(capacity=shared_resource['conf']['nfct']['ring_size'])
+		atexit.register(self.ring.close, True)
+		# spawn instead of fork, the daemon process has threads holding locks
+		self.context = multiprocessing.get_context('spawn')
+		# Passed on to every ingest process, kept open here so stop() can wake the reader
+		self.wakeup, self.wakeup_writer = self.context.Pipe(duplex=False)
+		os.set_blocking(self.wakeup.fileno(), False)
+		os.set_blocking(self.wakeup_writer.fileno(), False)
+		self.process = None
+		self.started = 0.0
+		self.restart_delay = RESTART_DELAY
+		self.next_restart = 0.0
+		self.counters = [self.shared_statistics.counter(name, help_text) for name, help_text in (
+			('natconnd_events_received_total', 'Conntrack events received from the kernel'),
+			('natconnd_netlink_overflows_total', 'Netlink socket overflows (ENOBUFS) losing events'),
+			('natconnd_resyncs_total', 'Kernel conntrack table dumps queued for reconciliation'),
+			('natconnd_events_invalid_total', 'Conntrack events skipped for missing attributes'))]
+		self.last_counters = [0] * len(self.counters)
+		self.restarts = self.shared_statistics.counter('natconnd_ingest_restarts_total', 'Ingest processes restarted after they died')
+		self.shared_statistics.gauge('natconnd_ingest_ring_records', 'Records waiting in the ring of the ingest process', func=lambda: len(self.ring))
+		self.shared_statistics.gauge('natconnd_ingest_process_alive', 'Ingest process is running', func=lambda: int(self.process is not None and self.process.is_alive()))
+
+	def start_process(self):
+		# Counters of the new process start at 0
+		self.update_counters()
+		self.ring.publish_counters([0] * len(self.counters))
+		self.last_counters = [0] * len(self.counters)
+		self.process = self.context.Process(target=ingest_main, args=(self.config_file, self.ring.name, self.wakeup_writer), name='natconnd-ingest', daemon=True)
+		self.process.start()
+		self.started = time.monotonic()
+		log.info("Started ingest process with pid %i", self.process.pid)
+
+	def supervise(self):
+		"""Restart the ingest process if it died, with increasing delay if it keeps dying"""
+		if not self.running or self.process is None or self.process.is_alive():
+			return
+		now = time.monotonic()
+		if now - self.started >= MAX_RESTART_DELAY:
+			self.restart_delay = RESTART_DELAY
+		elif now < self.next_restart:
+			return
+		log.error("Ingest process with pid %i died with exit code %s - restarting", self.process.pid, self.process.exitcode)
+		self.restarts.inc()
+		# The new process starts with a warm start dump, reconciling events lost in between
+		self.start_process()
+		self.next_restart = now + self.restart_delay
+		self.restart_delay = min(self.restart_delay * 2, MAX_RESTART_DELAY)
+
+	def wait(self, timeout):
+		"""Block until the ingest process published records, stop() was called or timeout passed"""
+		if select.select([self.wakeup], [], [], timeout)[0]:
+			try:
+				os.read(self.wakeup.fileno(), 65536)
+			except BlockingIOError:
+				pass
+
+	def put(self, item):
+		dropped = self.event_queue.put(item)
+		if dropped:
+			# Reported to the ingest process, which resyncs like QueueWorker after dropped events
+			self.ring.add_dropped(dropped)
+
+	def update_counters(self):
+		for i, value in enumerate(self.ring.counters()):
+			self.counters[i].inc(value - self.last_counters[i])
+			self.last_counters[i] = value
+
+	def run(self):
+		log.debug("Starting ingest reader thread", level=1)
+		self.running = True
+		self.start_process()
+		dump = []
+		next_counters = 0.0
+		while self.running:
+			records = self.ring.read(READ_BATCH)
+			now = time.monotonic()
+			if now >= next_counters:
+				self.update_counters()
+				next_counters = now + ring_buffer.COUNTERS_INTERVAL
+			if not records:
+				self.wait(WAIT_TIMEOUT)
+				continue
+			events = []
+			for kind, record in records:
+				if kind == ring_buffer.EVENT:
+					events.append(record)
+					continue
+				if events:
+					self.put(events)
+					events = []
+				if kind == ring_buffer.DUMP:
+					dump.append(record)
+				elif kind == ring_buffer.RESYNC_BEGIN:
+					dump = []
+				elif kind == ring_buffer.RESYNC_END:
+					self.put(net_filter.Resync(dump, self.warm_start_done if record.sig_type else None))
+					dump = []
+				elif kind == ring_buffer.WARM_START and self.warm_start_done is not None:
+					self.warm_start_done.set()
+			if events:
+				self.put(events)
+		log.debug("Stopped ingest reader thread", level=1)
+
+	def stop(self):
+		log.debug("Stopping ingest process", level=1)
+		self.running = False
+		ring_buffer.wake(self.wakeup_writer.fileno())
+		if self.process is not None:
+			self.process.terminate()
+			self.process.join(self.join_timeout)
+		# The reader keeps its mapping, only the name is removed
+		self.ring.close(unlink=True)
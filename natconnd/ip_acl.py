@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import bisect
+import ipaddress
+import threading
+import logging
+
+try:
+	import cygnuslog  # pylint: disable=unused-import
+except ImportError:
+	pass
+
+log = logging.getLogger("cygnus.pynatconnd")
+
+
+class IPACL(object):
+	"""IPv4/IPv6 access list compiled into sorted, merged integer ranges per IP version.
+	Verdicts of recently seen client addresses are kept in a small bounded cache, hits are read
+	without lock, misses are added under cache_lock by the concurrent request threads."""
+	def __init__(self, networks, cache_size=1024):
+		self.cache_size = cache_size
+		self.cache_lock = threading.Lock()
+		self.ranges = None
+		self.cache = dict()
+		self.load(networks)
+
+	@staticmethod
+	def compile(networks):
+		"""Returns {version: (starts, ends)} with sorted, non-overlapping ranges"""
+		ranges = {4: [], 6: []}
+		for x in networks:
+			net = ipaddress.ip_network(x.strip(), strict=False)
+			ranges[net.version].append((int(net.network_address), int(net.broadcast_address)))
+		compiled = dict()
+		for version, items in ranges.items():
+			merged = []
+			for start, end in sorted(items):
+				if merged and start <= merged[-1][1] + 1:
+					merged[-1][1] = max(merged[-1][1], end)
+				else:
+					merged.append([start, end])
+			compiled[version] = ([r[0] for r in merged], [r[1] for r in merged])
+		return compiled
+
+	def load(self, networks):
+		"""(Re)compile the access list, e.g. on config reload. Raises ValueError for invalid networks."""
+		ranges = self.compile(networks)
+		# Swap compiled ranges and cache at once, concurrent checks see either the old or the new list
+		self.ranges, self.cache = ranges, dict()
+		log.debug("Compiled ip_acl %s into %i IPv4 and %i IPv6 ranges", ", ".join(networks), len(ranges[4][0]), len(ranges[6][0]), level=2)
+
+	def match(self, addr):
+		try:
+			ip = ipaddress.ip_address(addr)
+		except ValueError:
+			return False
+		if ip.version == 6 and ip.ipv4_mapped is not None:
+			ip = ip.ipv4_mapped
+		starts, ends = self.ranges[ip.version]
+		value = int(ip)
+		i = bisect.bisect_right(starts, value) - 1
+		return i >= 0 and value <= ends[i]
+
+	def check(self, addr):
+		cache = self.cache
+		verdict = cache.get(addr)
+		if verdict is None:
+			verdict = self.match(addr)
+			if self.cache_size:
+				with self.cache_lock:
+					# Oldest entries first, iterating is safe as all writers hold the lock
+					while len(cache) >= self.cache_size:
+						del cache[next(iter(cache))]
+					cache[addr] = verdict
+		return verdict
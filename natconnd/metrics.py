@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Metrics for the daemon threads, exported in Prometheus text format on /metrics.
+
+Counters and histograms keep one cell per updating thread, so updates never take a lock and
+never lose increments. Cells are summed up when the metrics are read. A new thread takes over
+the cell of a finished one, so short lived threads (one per request with wsgiref) do not add
+cells. Gauges are either set by
+a single thread or computed by a callback on scrape."""
+import bisect
+import contextlib
+import threading
+import time
+
+# Buckets in seconds
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+PAUSE_BUCKETS = (0.00001, 0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+def _format_labels(labels):
+	if not labels:
+		return ''
+	return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+
+def _format_value(value):
+	if isinstance(value, float):
+		if value == float('inf'):
+			return '+Inf'
+		return repr(value)
+	return str(value)
+
+
+class _PerThreadMetric(object):
+	"""Base for metrics with one cell per updating thread"""
+	TYPE = None
+
+	def __init__(self, name, help_text, labels=()):
+		self.name = name
+		self.help_text = help_text
+		self.labels = tuple(labels)
+		self._local = threading.local()
+		self._cells = []
+		self._cells_lock = threading.Lock()
+		self._retired = self._new_cell()
+		self._sources = []
+
+	def _new_cell(self):
+		raise NotImplementedError
+
+	def _fold(self, target, cell):
+		raise NotImplementedError
+
+	def _cell(self):
+		try:
+			return self._local.cell
+		except AttributeError:
+			current = threading.current_thread()
+			with self._cells_lock:
+				for i, (thread, cell) in enumerate(self._cells):
+					if not thread.is_alive():
+						# Cells only hold sums, the one of a finished thread is continued as it is
+						self._cells[i] = (current, cell)
+						break
+				else:
+					cell = self._new_cell()
+					self._cells.append((current, cell))
+			self._local.cell = cell
+			return cell
+
+	def add_source(self, func):
+		"""func returns a cell added to the metric when it is read, e.g. the counts of other processes"""
+		self._sources.append(func)
+
+	def _collect_dead(self):
+		# Called with _cells_lock held
+		alive = []
+		for thread, cell in self._cells:
+			if thread.is_alive():
+				alive.append((thread, cell))
+			else:
+				self._fold(self._retired, cell)
+		self._cells = alive
+
+	def _aggregate(self):
+		total = self._new_cell()
+		with self._cells_lock:
+			self._collect_dead()
+			self._fold(total, self._retired)
+			for _, cell in self._cells:
+				self._fold(total, cell)
+		for func in self._sources:
+			self._fold(total, func())
+		return total
+
+
+class Counter(_PerThreadMetric):
+	TYPE = 'counter'
+
+	def _new_cell(self):
+		return [0]
+
+	def _fold(self, target, cell):
+		target[0] += cell[0]
+
+	def inc(self, amount=1):
+		self._cell()[0] += amount
+
+	def value(self):
+		return self._aggregate()[0]
+
+	def samples(self):
+		yield self.name, self.labels, self.value()
+
+
+class Histogram(_PerThreadMetric):
+	TYPE = 'histogram'
+
+	def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+		self.buckets = tuple(sorted(buckets))
+		_PerThreadMetric.__init__(self, name, help_text, labels)
+
+	def _new_cell(self):
+		# counts per bucket (last one is +Inf), sum, count
+		return [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+	def _fold(self, target, cell):
+		counts = target[0]
+		for i, count in enumerate(cell[0]):
+			counts[i] += count
+		target[1] += cell[1]
+		target[2] += cell[2]
+
+	def observe(self, value):
+		cell = self._cell()
+		cell[0][bisect.bisect_left(self.buckets, value)] += 1
+		cell[1] += value
+		cell[2] += 1
+
+	@contextlib.contextmanager
+	def time(self):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - start)
+
+	def value(self):
+		"""Returns (cumulative bucket counts, sum, count)"""
+		counts, total, count = self._aggregate()
+		cumulative = []
+		running = 0
+		for c in counts:
+			running += c
+			cumulative.append(running)
+		return cumulative, total, count
+
+	def samples(self):
+		cumulative, total, count = self.value()
+		for bound, c in zip(self.buckets + (float('inf'),), cumulative):
+			yield self.name + '_bucket', self.labels + (('le', _format_value(float(bound))),), c
+		yield self.name + '_sum', self.labels, total
+		yield self.name + '_count', self.labels, count
+
+
+class Gauge(object):
+	"""Gauge set by one thread, or computed on scrape by func.
+	func may return a number or a list of (labels, value) pairs for labelled samples."""
+	TYPE = 'gauge'
+
+	def __init__(self, name, help_text, labels=(), func=None):
+		self.name = name
+		self.help_text = help_text
+		self.labels = tuple(labels)
+		self.func = func
+		self._value = 0
+
+	def set(self, value):
+		self._value = value
+
+	def value(self):
+		return self.func() if self.func is not None else self._value
+
+	def samples(self):
+		value = self.value()
+		if isinstance(value, list):
+			for labels, v in value:
+				yield self.name, self.labels + tuple(labels), v
+		else:
+			yield self.name, self.labels, value
+
+
+class Registry(object):
+	"""Named metrics of the daemon. Asking for an existing name and labels returns the same metric."""
+	def __init__(self):
+		self._metrics = dict()
+		self._lock = threading.Lock()
+
+	def _get(self, cls, name, help_text, labels, **kwargs):
+		labels = tuple(sorted(labels.items())) if labels else ()
+		key = (name, labels)
+		with self._lock:
+			metric = self._metrics.get(key)
+			if metric is None:
+				metric = self._metrics[key] = cls(name, help_text, labels, **kwargs)
+			assert isinstance(metric, cls), name
+		return metric
+
+	def counter(self, name, help_text, labels=None):
+		return self._get(Counter, name, help_text, labels)
+
+	def histogram(self, name, help_text, labels=None, buckets=LATENCY_BUCKETS):
+		return self._get(Histogram, name, help_text, labels, buckets=buckets)
+
+	def gauge(self, name, help_text, labels=None, func=None):
+		gauge = self._get(Gauge, name, help_text, labels)
+		if func is not None:
+			gauge.func = func
+		return gauge
+
+	def value(self, name, **labels):
+		"""Value of a metric, 0 if it does not exist (yet)"""
+		metric = self._metrics.get((name, tuple(sorted(labels.items()))))
+		return metric.value() if metric is not None else 0
+
+	def render(self):
+		"""All metrics in Prometheus text exposition format"""
+		with self._lock:
+			metrics = sorted(self._metrics.values(), key=lambda m: (m.name, m.labels))
+		lines = []
+		last_name = None
+		for metric in metrics:
+			if metric.name != last_name:
+				lines.append('# HELP %s %s' % (metric.name, metric.help_text))
+				lines.append('# TYPE %s %s' % (metric.name, metric.TYPE))
+				last_name = metric.name
+			for name, labels, value in metric.samples():
+				lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+		return '\n'.join(lines) + '\n'
+
+
+@contextlib.contextmanager
+def timed_lock(lock, histogram):
+	"""Acquire lock, recording the time waited for it in histogram"""
+	start = time.perf_counter()
+	with lock:
+		histogram.observe(time.perf_counter() - start)
+		yield
@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import threading
 import logging
 
 try:
@@ -9,9 +8,31 @@ except ImportError:
 	pass
 
 from . import base_thread
+from . import conn_filter
+from . import conn_record
+from . import conn_table
+from . import delete_scheduler
+from . import metrics
 
 log = logging.getLogger('cygnus.pynatconnd')
 
+# Number of dumped connections reconciled per lock acquisition
+RESYNC_SLICE_SIZE = 1000
+
+
+class Resync(object):  # pylint: disable=too-few-public-methods
+	"""Queued instead of an event batch with all connections dumped from the kernel.
+	done is an optional threading.Event set once the table is reconciled."""
+	__slots__ = ('records', 'done')
+
+	def __init__(self, records, done=None):
+		self.records = records
+		self.done = done
+
+
+def same_connection(a, b):
+	return (a.family, a.src_ip, a.src_port, a.dst_ip, a.dst_port) == (b.family, b.src_ip, b.src_port, b.dst_ip, b.dst_port)
+
 
 class NetFilter(base_thread.BaseThread):  # pylint: disable= too-many-instance-attributes
 	def __init__(self, event_queue, shared_resource):
@@ -24,83 +45,121 @@ class NetFilter(base_thread.BaseThread):  # pylint: disable= too-many-instance-a
 		assert shared_resource['lock'] is not None
 		self.shared_data_lock = shared_resource['lock']
 
-		self.timer_list = []
-		self.conditions = dict()
-
-		# FIXME: move that to config validation on startup
-		for k, v in self.configuration['filter'].items():
-			if v is not None:
-				self.conditions[k] = v
-		assert len(self.conditions.keys()) > 0
+		self.delete_scheduler = delete_scheduler.DeleteScheduler(shared_resource, self.del_entries)
+		self.created = self.shared_statistics.counter('natconnd_connections_created_total', 'Connections added to the table')
+		self.deleted = self.shared_statistics.counter('natconnd_connections_deleted_total', 'Connections deleted after DESTROY events')
+		self.ingest_lock_wait = self.shared_statistics.histogram('natconnd_lock_wait_seconds', 'Time waited for the table write lock', {'operation': 'ingest'})
+		self.delete_lock_wait = self.shared_statistics.histogram('natconnd_lock_wait_seconds', 'Time waited for the table write lock', {'operation': 'delete'})
+		# Terms are validated with the config already
+		self.conn_filter = conn_filter.ConnFilter(self.configuration['filter'])
+		assert len(self.conn_filter.fields) > 0
+		# NEW and DESTROY events are logged for point in time queries, if configured
+		self.history = shared_resource.get('history')
 		self.key_name = self.configuration['data']['key_name']
 		assert self.key_name in self.configuration['filter'].keys()
-		log.debug("Conditions that will be used for filtering signals are %s", self.conditions, level=2)
+		log.debug("Conditions that will be used for filtering signals are %s", self.conn_filter.fields, level=2)
 
 	def run(self):
 		log.debug("Starting Netfilter thread", level=1)
 		self.running = True
-		log.debug("Filter connections are %s", self.conditions, level=1)
+		log.debug("Filter connections are %s", self.conn_filter.source, level=1)
 
 		while self.running:
-			x = self.event_queue.get()
-			if x is None:
+			batch = self.event_queue.get()
+			if batch is None:
 				break
-
-			process = True
-			for (key, val) in self.conditions.items():
-				if key in ['dst_port', 'src_port', 'nat_port']:
-					res = bool(int(x[key]) == val)
-				else:
-					res = bool(x[key] == val)
-				if res is False:
-					log.debug("Packet %s is not matching filter %s=%s - ignoring", x, key, val, level=10)
-					process = False
-					break
-
-			if process is False:
+			if isinstance(batch, Resync):
+				self.reconcile(batch.records)
+				if batch.done is not None:
+					batch.done.set()
 				continue
-			else:
-				log.debug("Packet %s is matching  filter", x, level=4)
-			if x['sig_type'] == 'new':
-				with self.shared_data_lock:
-					self.shared_data.update({x[self.key_name]: x})
-
-				self.shared_statistics['shared_data_size'] = len(self.shared_data)
-				self.shared_statistics['number_of_created_items'] = self.shared_statistics['number_of_created_items'] + 1
-				log.debug("NEW signal %s:%s -> %s:%s -> %s:%s at %s", x['src_ip'], x['src_port'], x['nat_ip'], x['nat_port'], x['dst_ip'], x['dst_port'], x['time'], level=1)
-				log.debug("After adding new element, length of shared dict is %i", len(self.shared_data), level=4)
-
-			elif x['sig_type'] == 'destroy':
-				log.debug("DESTROY signal %s -> %s:%s -> %s:%s at %s", x['src_ip'], x['nat_ip'], x['nat_port'], x['dst_ip'], x['dst_port'], x['time'], level=1)
-				if x[self.key_name]in self.shared_data:
-					timer = threading.Timer(self.configuration['data']['del_delay'], self.del_entry, (x[self.key_name], ))
-					timer.start()
-					self.timer_list.append(timer)
-
-					log.debug("Starting the timer for %i sec to delete the entry %s -> %s:%s -> %s:%s at %s", self.configuration['data']['del_delay'], x['src_ip'], x['nat_ip'], x['nat_port'], x['dst_ip'], x['dst_port'], x['time'], level=4)
-				else:
-					log.warning("Couldn't find the entry %s in the shared dictionary", x[self.key_name])
 
+			# Filtered before taking the lock, ingestion holds it only for matching events
+			if self.conn_filter.profiling:
+				self.conn_filter.observe(batch)
+			match = self.conn_filter.match
+			batch = [x for x in batch if match(x)]
+			if not batch:
+				continue
+			with metrics.timed_lock(self.shared_data_lock, self.ingest_lock_wait):
+				for x in batch:
+					self.process_event(x)
+
+	def matches(self, x):
+		return self.conn_filter.match(x)
+
+	def process_event(self, x):
+		# Called with shared_data_lock held for events matching the filter
+		log.debug("Packet %s is matching  filter", x, level=4)
+		key_value = conn_table.primary_key(x)
+		if x.sig_type == conn_record.SIG_NEW:
+			if self.delete_scheduler.cancel(key_value):
+				log.debug("Cancelled pending delete of reused key %s", key_value, level=4)
+			self.shared_data.insert(x)
+			if self.history is not None:
+				self.history.append(x)
+
+			self.created.inc()
+			log.debug("NEW signal %s", x, level=1)
+			log.debug("After adding new element, length of shared dict is %i", len(self.shared_data), level=4)
+
+		elif x.sig_type == conn_record.SIG_DESTROY:
+			log.debug("DESTROY signal %s", x, level=1)
+			if self.history is not None:
+				self.history.append(x)
+			if key_value in self.shared_data:
+				self.delete_scheduler.schedule(key_value, self.shared_data[key_value])
+				log.debug("Scheduled delete in %i sec of the entry %s", self.configuration['data']['del_delay'], x, level=4)
 			else:
-				log.debug("Signal is not of type new or destroy for packet %s - ignoring", x, level=10)
+				log.warning("Couldn't find the entry %s in the shared dictionary", key_value)
 
-	def del_entry(self, key_value):
-		x = self.shared_data[key_value]
-		with self.shared_data_lock:
-			del self.shared_data[key_value]
-		log.debug("DELETED the entry %s -> %s:%s -> %s:%s at %s", x['src_ip'], x['nat_ip'], x['nat_port'], x['dst_ip'], x['dst_port'], x['time'], level=1)
-		self.shared_statistics['number_of_deleted_items'] = self.shared_statistics['number_of_deleted_items'] + 1
+		else:
+			log.debug("Signal is not of type new or destroy for packet %s - ignoring", x, level=10)
+
+	def reconcile(self, records):
+		"""Bring the table in line with a dump of the kernel conntrack table after events were lost.
+		Dumped connections missing in the table are added, entries without connection in the dump
+		are deleted after del_delay like on a DESTROY event."""
+		seen = set()
+		added = 0
+		for start in range(0, len(records), RESYNC_SLICE_SIZE):
+			with metrics.timed_lock(self.shared_data_lock, self.ingest_lock_wait):
+				for x in records[start:start + RESYNC_SLICE_SIZE]:
+					if not self.matches(x):
+						continue
+					key_value = conn_table.primary_key(x)
+					seen.add(key_value)
+					current = self.shared_data.get(key_value)
+					if current is None or not same_connection(current, x):
+						self.delete_scheduler.cancel(key_value)
+						self.shared_data.insert(x)
+						if self.history is not None:
+							self.history.append(x)
+						added += 1
+		self.created.inc(added)
+
+		# NetFilter is the only writer, so the snapshot includes all entries added above
+		stale = 0
+		for key_value, x in self.shared_data.snapshot().items():
+			if key_value not in seen and key_value not in self.delete_scheduler.pending:
+				self.delete_scheduler.schedule(key_value, x)
+				stale += 1
+		log.info("Resync added %i missing connections and scheduled %i stale entries for deletion", added, stale)
+
+	def del_entries(self, entries):
+		# Called by the delete scheduler with all (key, value) pairs that are due
+		deleted = []
+		with metrics.timed_lock(self.shared_data_lock, self.delete_lock_wait):
+			for key_value, x in entries:
+				# Skip entries replaced by a newer connection in the meantime
+				if self.shared_data.get(key_value) is x:
+					self.shared_data.remove(key_value)
+					deleted.append(x)
+		for x in deleted:
+			log.debug("DELETED the entry %s", x, level=1)
+		self.deleted.inc(len(deleted))
 
 	def stop(self):
 		log.debug("Stopping Netfilter thread", level=1)
-
-		if len(self.timer_list) > 0:
-			log.debug("Stopping timer %i that is running in QueueWorker thread", len(self.timer_list), level=2)
-			for timer in self.timer_list:
-				timer.cancel()
-
-		else:
-			log.debug("No timer to stop in Netfilter thread", level=1)
-
 		self.running = False
-		self.event_queue.put(None)
+		self.event_queue.close()
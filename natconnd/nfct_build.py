@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""cffi build script for the out-of-line natconnd._nfct extension module.
+Used by setup.py (cffi_modules) at install time, or run directly to build in the checkout."""
+from cffi import FFI
+
+# Try to work around insane "write_table" operations (which assume that
+#  they can just write lextab.py and yacctab.py in current dir), used by default.
+try:
+	from ply.lex import Lexer
+except ImportError:
+	pass
+else:
+	Lexer.writetab = lambda s, *a, **k: None
+try:
+	from ply.yacc import LRGeneratedTable
+except ImportError:
+	pass
+else:
+	LRGeneratedTable.write_table = lambda s, *a, **k: None
+
+
+# There're no defs for conntrack-expectations' handling here
+CDEF = '''
+typedef unsigned char u_int8_t;
+typedef unsigned short int u_int16_t;
+typedef unsigned int u_int32_t;
+
+static const u_int8_t NFNL_SUBSYS_NONE;
+static const u_int8_t NFNL_SUBSYS_CTNETLINK;
+
+#define NF_NETLINK_CONNTRACK_NEW ...
+#define NF_NETLINK_CONNTRACK_UPDATE ...
+#define NF_NETLINK_CONNTRACK_DESTROY ...
+
+enum nf_conntrack_msg_type {
+	NFCT_T_UNKNOWN,
+	NFCT_T_NEW,
+	NFCT_T_UPDATE,
+	NFCT_T_DESTROY,
+	NFCT_T_ALL,
+	...
+};
+
+enum nfct_cb {
+	NFCT_CB_FAILURE,
+	NFCT_CB_STOP,
+	NFCT_CB_CONTINUE,
+	NFCT_CB_STOLEN,
+	...
+};
+
+enum nfct_o {
+	NFCT_O_PLAIN,
+	NFCT_O_DEFAULT,
+	NFCT_O_XML,
+	NFCT_O_MAX,
+	...
+};
+
+enum nfct_of {
+	NFCT_OF_SHOW_LAYER3,
+	NFCT_OF_TIME,
+	NFCT_OF_ID,
+	NFCT_OF_TIMESTAMP,
+	...
+};
+
+struct nfct_handle* nfct_open(u_int8_t subsys_id, unsigned int subscriptions);
+int nfct_close(struct nfct_handle * cth);
+int nfct_fd(struct nfct_handle *cth);
+
+struct nfnl_handle *nfct_nfnlh(struct nfct_handle *cth);
+unsigned int nfnl_rcvbufsiz(const struct nfnl_handle *h, unsigned int size);
+
+enum nf_conntrack_query {
+	NFCT_Q_DUMP,
+	...
+};
+
+int nfct_query(struct nfct_handle *h, const enum nf_conntrack_query query, const void *data);
+
+struct nlmsghdr {
+	u_int32_t nlmsg_len; /* Length of message including header */
+	u_int16_t nlmsg_type; /* Message content */
+	u_int16_t nlmsg_flags; /* Additional flags */
+	u_int32_t nlmsg_seq; /* Sequence number */
+	u_int32_t nlmsg_pid; /* Sending process port ID */
+};
+
+typedef int nfct_callback(
+	const struct nlmsghdr *nlh,
+	enum nf_conntrack_msg_type type,
+	struct nf_conntrack *ct, void *data );
+
+int nfct_callback_register2(
+	struct nfct_handle *h,
+	enum nf_conntrack_msg_type type,
+	nfct_callback *cb, void *data );
+
+void nfct_callback_unregister2(struct nfct_handle *h);
+
+int nfct_catch(struct nfct_handle *h);
+
+enum nf_conntrack_attr {
+	ATTR_ORIG_IPV4_SRC,
+	ATTR_ORIG_IPV4_DST,
+	ATTR_REPL_IPV4_SRC,
+	ATTR_REPL_IPV4_DST,
+	ATTR_ORIG_IPV6_SRC,
+	ATTR_ORIG_IPV6_DST,
+	ATTR_REPL_IPV6_SRC,
+	ATTR_REPL_IPV6_DST,
+	ATTR_ORIG_PORT_SRC,
+	ATTR_ORIG_PORT_DST,
+	ATTR_REPL_PORT_SRC,
+	ATTR_REPL_PORT_DST,
+	ATTR_ORIG_L3PROTO,
+	ATTR_ORIG_L4PROTO,
+	ATTR_ID,
+	ATTR_TIMESTAMP_START,
+	ATTR_TIMESTAMP_STOP,
+	...
+};
+
+int nfct_attr_is_set(const struct nf_conntrack *ct, const enum nf_conntrack_attr type);
+const void *nfct_get_attr(const struct nf_conntrack *ct, const enum nf_conntrack_attr type);
+u_int8_t nfct_get_attr_u8(const struct nf_conntrack *ct, const enum nf_conntrack_attr type);
+u_int16_t nfct_get_attr_u16(const struct nf_conntrack *ct, const enum nf_conntrack_attr type);
+u_int32_t nfct_get_attr_u32(const struct nf_conntrack *ct, const enum nf_conntrack_attr type);
+uint64_t nfct_get_attr_u64(const struct nf_conntrack *ct, const enum nf_conntrack_attr type);
+
+struct nfct_filter;
+
+struct nfct_filter_ipv4 {
+	u_int32_t addr;
+	u_int32_t mask;
+};
+
+struct nfct_filter_ipv6 {
+	u_int32_t addr[4];
+	u_int32_t mask[4];
+};
+
+enum nfct_filter_attr {
+	NFCT_FILTER_L4PROTO,
+	NFCT_FILTER_L4PROTO_STATE,
+	NFCT_FILTER_SRC_IPV4,
+	NFCT_FILTER_DST_IPV4,
+	NFCT_FILTER_SRC_IPV6,
+	NFCT_FILTER_DST_IPV6,
+	...
+};
+
+struct nfct_filter *nfct_filter_create(void);
+void nfct_filter_destroy(struct nfct_filter *filter);
+void nfct_filter_add_attr(struct nfct_filter *filter, const enum nfct_filter_attr attr, const void *value);
+void nfct_filter_add_attr_u32(struct nfct_filter *filter, const enum nfct_filter_attr attr, const u_int32_t value);
+int nfct_filter_attach(int fd, struct nfct_filter *filter);
+
+int nfct_snprintf(
+	char *buf,
+	unsigned int size,
+	const struct nf_conntrack *ct,
+	const unsigned int msg_type,
+	const unsigned int out_type,
+	const unsigned int out_flags );
+'''
+
+INCLUDES = '''
+#include <sys/types.h>
+#include <libnfnetlink/libnfnetlink.h>
+#include <libnetfilter_conntrack/libnetfilter_conntrack.h>
+'''
+LIBRARIES = ['nfnetlink', 'netfilter_conntrack']
+
+ffibuilder = FFI()
+ffibuilder.cdef(CDEF)
+ffibuilder.set_source('natconnd._nfct', INCLUDES, libraries=LIBRARIES)
+
+
+if __name__ == '__main__':
+	ffibuilder.compile(verbose=True)
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
+import errno
+import fcntl
+import select
+import socket
 import logging
-from cffi import FFI
+from collections import namedtuple
 
 try:
 	import cygnuslog  # pylint: disable=unused-import
@@ -11,111 +15,10 @@ except ImportError:
 
 log = logging.getLogger('cygnus.pynatconnd')
 
-# Try to work around insane "write_table" operations (which assume that
-#  they can just write lextab.py and yacctab.py in current dir), used by default.
 try:
-	from ply.lex import Lexer
+	from ._nfct import ffi, lib  # pylint: disable=no-name-in-module,import-error
 except ImportError:
-	pass
-else:
-	Lexer.writetab = lambda s, *a, **k: None
-try:
-	from ply.yacc import LRGeneratedTable
-except ImportError:
-	pass
-else:
-	LRGeneratedTable.write_table = lambda s, *a, **k: None
-
-
-# There're no defs for conntrack-expectations' handling here
-# Also nfct_nfnlh() can be useful here for e.g. nfnl_rcvbufsiz()
-_cdef = '''
-typedef unsigned char u_int8_t;
-typedef unsigned short int u_int16_t;
-typedef unsigned int u_int32_t;
-
-static const u_int8_t NFNL_SUBSYS_NONE;
-static const u_int8_t NFNL_SUBSYS_CTNETLINK;
-
-static const unsigned int NFNLGRP_NONE;
-static const unsigned int NFNLGRP_CONNTRACK_NEW;
-static const unsigned int NFNLGRP_CONNTRACK_UPDATE;
-static const unsigned int NFNLGRP_CONNTRACK_DESTROY;
-
-enum nf_conntrack_msg_type {
-	NFCT_T_UNKNOWN,
-	NFCT_T_NEW,
-	NFCT_T_UPDATE,
-	NFCT_T_DESTROY,
-	NFCT_T_ALL,
-	...
-};
-
-enum nfct_cb {
-	NFCT_CB_FAILURE,
-	NFCT_CB_STOP,
-	NFCT_CB_CONTINUE,
-	NFCT_CB_STOLEN,
-	...
-};
-
-enum nfct_o {
-	NFCT_O_PLAIN,
-	NFCT_O_DEFAULT,
-	NFCT_O_XML,
-	NFCT_O_MAX,
-	...
-};
-
-enum nfct_of {
-	NFCT_OF_SHOW_LAYER3,
-	NFCT_OF_TIME,
-	NFCT_OF_ID,
-	NFCT_OF_TIMESTAMP,
-	...
-};
-
-struct nfct_handle* nfct_open(u_int8_t subsys_id, unsigned int subscriptions);
-int nfct_close(struct nfct_handle * cth);
-int nfct_fd(struct nfct_handle *cth);
-
-struct nlmsghdr {
-	u_int32_t nlmsg_len; /* Length of message including header */
-	u_int16_t nlmsg_type; /* Message content */
-	u_int16_t nlmsg_flags; /* Additional flags */
-	u_int32_t nlmsg_seq; /* Sequence number */
-	u_int32_t nlmsg_pid; /* Sending process port ID */
-};
-
-typedef int nfct_callback(
-	const struct nlmsghdr *nlh,
-	enum nf_conntrack_msg_type type,
-	struct nf_conntrack *ct, void *data );
-
-int nfct_callback_register2(
-	struct nfct_handle *h,
-	enum nf_conntrack_msg_type type,
-	nfct_callback *cb, void *data );
-
-void nfct_callback_unregister2(struct nfct_handle *h);
-
-int nfct_catch(struct nfct_handle *h);
-
-int nfct_snprintf(
-	char *buf,
-	unsigned int size,
-	const struct nf_conntrack *ct,
-	const unsigned int msg_type,
-	const unsigned int out_type,
-	const unsigned int out_flags );
-'''
-
-_clibs_includes = '''
-#include <sys/types.h>
-#include <libnfnetlink/libnfnetlink.h>
-#include <libnetfilter_conntrack/libnetfilter_conntrack.h>
-'''
-_clibs_link = 'nfnetlink', 'netfilter_conntrack'
+	ffi = lib = None
 
 
 class NFCTError(OSError):
@@ -123,6 +26,20 @@ class NFCTError(OSError):
 
 
 NFWouldBlock = type('NFWouldBlock', (object,), dict())
+# Yielded by the generator when the netlink socket overflowed (ENOBUFS) and events were lost
+NFOverflow = type('NFOverflow', (object,), dict())
+
+# Compact conntrack event as pulled from struct nf_conntrack by the binary decoder.
+# Addresses are packed (4 or 16 bytes), ports in host byte order,
+# timestamps in ns since epoch or None if conntrack timestamping is disabled.
+CTRecord = namedtuple('CTRecord', 'msg_type l3proto l4proto orig_src orig_dst orig_sport orig_dport repl_src repl_dst repl_sport repl_dport id ts_start ts_stop')
+
+DECODERS = ('binary', 'xml')
+
+
+def _words(value):
+	# 128 bit integer as four 32 bit words, most significant first
+	return [(value >> shift) & 0xffffffff for shift in (96, 64, 32, 0)]
 
 
 class NFCT(object):  # pylint: disable=too-few-public-methods
@@ -137,12 +54,14 @@ class NFCT(object):  # pylint: disable=too-few-public-methods
 
 	def __init__(self):
 		log.debug("Creating an instance of NFCT", level=4)
-		global _cdef, _clibs_includes, _clibs_link  # pylint: disable=global-statement
-		self.ffi = FFI()
-		self.ffi.cdef(_cdef)
-		self.libnfct = self.ffi.verify(_clibs_includes, libraries=list(_clibs_link))
+		if lib is None:
+			raise ImportError("natconnd._nfct extension is not built - run 'python setup.py build_ext --inplace' or 'python -m natconnd.nfct_build'")
+		self.ffi = ffi
+		self.libnfct = lib
 		self.libnfct_cache = dict()
-		_cdef = _clibs_includes = _clibs_link = None
+		self._ipv4_attrs = (lib.ATTR_ORIG_IPV4_SRC, lib.ATTR_ORIG_IPV4_DST, lib.ATTR_REPL_IPV4_SRC, lib.ATTR_REPL_IPV4_DST)
+		self._ipv6_attrs = (lib.ATTR_ORIG_IPV6_SRC, lib.ATTR_ORIG_IPV6_DST, lib.ATTR_REPL_IPV6_SRC, lib.ATTR_REPL_IPV6_DST)
+		self._port_attrs = (lib.ATTR_ORIG_PORT_SRC, lib.ATTR_ORIG_PORT_DST, lib.ATTR_REPL_PORT_SRC, lib.ATTR_REPL_PORT_DST)
 
 	def _ffi_call(self, func, args, no_check=False, check_gt0=False, check_notnull=False):  # pylint: disable=too-many-arguments
 		# Call lib function through cffi,
@@ -151,11 +70,11 @@ class NFCT(object):  # pylint: disable=too-few-public-methods
 		res = func(*args)
 		if no_check or (check_gt0 and res > 0) or (check_notnull and res) or res >= 0:  # pylint: disable=too-many-boolean-expressions
 			return res
+		self._check_errno()
+
+	def _check_errno(self):
 		errno_ = self.ffi.errno
-		if errno_ == 105:
-			log.debug("skipping [Errno 105] No buffer space available")
-		else:
-			raise NFCTError(errno_, os.strerror(errno_))
+		raise NFCTError(errno_, os.strerror(errno_))
 
 	def __getattr__(self, k):
 		if not (k.startswith('nfct_') or k.startswith('c_')):
@@ -167,22 +86,113 @@ class NFCT(object):  # pylint: disable=too-few-public-methods
 			self.libnfct_cache[k] = lambda *a, **kw: self._ffi_call(func, a, **kw)
 		return self.libnfct_cache[k]
 
-	def generator(self, events=None, output_flags=None):
+	def decode_ct(self, msg_type, ct_struct):
+		# Pull the fields needed for NAT tracking straight from struct nf_conntrack
+		# without rendering and parsing XML. Returns a CTRecord.
+		lib = self.libnfct
+		l3proto = lib.nfct_get_attr_u8(ct_struct, lib.ATTR_ORIG_L3PROTO)
+		if l3proto == socket.AF_INET6:
+			addr_attrs, addr_size = self._ipv6_attrs, 16
+		else:
+			addr_attrs, addr_size = self._ipv4_attrs, 4
+		addrs = list()
+		for attr in addr_attrs:
+			ptr = lib.nfct_get_attr(ct_struct, attr)
+			addrs.append(self.ffi.buffer(ptr, addr_size)[:] if ptr != self.ffi.NULL else None)
+		ports = [socket.ntohs(lib.nfct_get_attr_u16(ct_struct, attr)) for attr in self._port_attrs]
+		ts_start = ts_stop = None
+		if lib.nfct_attr_is_set(ct_struct, lib.ATTR_TIMESTAMP_START) > 0:
+			ts_start = lib.nfct_get_attr_u64(ct_struct, lib.ATTR_TIMESTAMP_START)
+		if lib.nfct_attr_is_set(ct_struct, lib.ATTR_TIMESTAMP_STOP) > 0:
+			ts_stop = lib.nfct_get_attr_u64(ct_struct, lib.ATTR_TIMESTAMP_STOP)
+		return CTRecord(
+			msg_type, l3proto, lib.nfct_get_attr_u8(ct_struct, lib.ATTR_ORIG_L4PROTO),
+			addrs[0], addrs[1], ports[0], ports[1], addrs[2], addrs[3], ports[2], ports[3],
+			lib.nfct_get_attr_u32(ct_struct, lib.ATTR_ID), ts_start, ts_stop)
+
+	def attach_filter(self, fd, l4protos=(), src_nets=(), dst_nets=()):
+		# Attach an in-kernel (BSF) event filter to the netlink socket,
+		# so non-matching events are dropped before they reach userspace.
+		# l4protos are IPPROTO_* numbers, src_nets/dst_nets ipaddress networks
+		# matched against the original direction of the connection.
+		# Address filters only apply to their own family, e.g. with only
+		# IPv4 networks given all IPv6 events still pass.
+		lib = self.libnfct
+		nfct_filter = self.nfct_filter_create(check_notnull=True)
+		try:
+			for l4proto in l4protos:
+				lib.nfct_filter_add_attr_u32(nfct_filter, lib.NFCT_FILTER_L4PROTO, l4proto)
+			for nets, attr_ipv4, attr_ipv6 in ((src_nets, lib.NFCT_FILTER_SRC_IPV4, lib.NFCT_FILTER_SRC_IPV6), (dst_nets, lib.NFCT_FILTER_DST_IPV4, lib.NFCT_FILTER_DST_IPV6)):
+				for net in nets:
+					# Addresses and masks are in host byte order, IPv6 as four 32 bit words
+					if net.version == 4:
+						value = self.ffi.new('struct nfct_filter_ipv4 *', [int(net.network_address), int(net.netmask)])
+						lib.nfct_filter_add_attr(nfct_filter, attr_ipv4, value)
+					else:
+						value = self.ffi.new('struct nfct_filter_ipv6 *', [_words(int(net.network_address)), _words(int(net.netmask))])
+						lib.nfct_filter_add_attr(nfct_filter, attr_ipv6, value)
+			self.nfct_filter_attach(fd, nfct_filter)
+		finally:
+			lib.nfct_filter_destroy(nfct_filter)
+
+	def dump(self, family=socket.AF_UNSPEC):
+		# Returns all connections currently known to the kernel as list of CTRecords.
+		# Uses a separate handle without event subscriptions. Dumped entries
+		# are reported as NFCT_T_NEW, as they are (re)added to the table.
+		lib = self.libnfct
+		handle = self.nfct_open(lib.NFNL_SUBSYS_CTNETLINK, 0, check_notnull=True)
+		results = list()
+		errors = list()
+
+		@self.ffi.callback('nfct_callback')
+		def dump_callback(handler, msg_type, ct_struct, data):  # pylint: disable=unused-argument
+			try:
+				results.append(self.decode_ct(lib.NFCT_T_NEW, ct_struct))
+			except Exception as e:  # pylint: disable=broad-except
+				errors.append(e)  # exceptions can't pass through nfct_query()
+				return lib.NFCT_CB_FAILURE
+			return lib.NFCT_CB_CONTINUE
+
+		try:
+			self.nfct_callback_register2(handle, lib.NFCT_T_ALL, dump_callback, self.ffi.NULL)
+			res = self.nfct_query(handle, lib.NFCT_Q_DUMP, self.ffi.new('u_int32_t *', family), no_check=True)
+			if errors:
+				raise errors[0]
+			if res < 0:
+				self._check_errno()
+		finally:
+			self.nfct_callback_unregister2(handle, no_check=True)
+			self.nfct_close(handle)
+		log.debug("Dumped %i connections from the kernel", len(results), level=4)
+		return results
+
+	def generator(self, events=None, output_flags=None, decoder='binary', batch_size=None, poll_timeout=1.0, kernel_filter=None, rcvbuf_size=None):  # pylint: disable=too-many-arguments,too-many-locals,too-many-statements,too-many-branches
 		# Generator that yields:
 		# 		- on first iteration - netlink fd that can be poll'ed
 		# 			or integrated into some event loop (twisted, gevent, ...).
 		# 			Also, that is the point where uid/gid/caps can be dropped.
 		# 		- on all subsequent iterations it does recv() on that fd,
-		# 			yielding XML representation of the captured conntrack event.
+		# 			yielding a CTRecord (decoder='binary') or the
+		# 			XML representation (decoder='xml') of the captured conntrack event.
+		# 			With batch_size set, yields lists of those instead.
+		# 			NFOverflow is yielded after the socket overflowed and events were lost.
 		# Keywords:
-		# 		events: mask for event types to capture
-		# 			- or'ed NFNLGRP_CONNTRACK_* flags, None = all.
+		# 		events: netlink groups to subscribe
+		# 			- or'ed NF_NETLINK_CONNTRACK_* flags, None = new and destroy.
 		# 		output_flags: which info will be in resulting xml
-		# 			- or'ed NFCT_OF_* flags, None = set all.
-		# 		handle_sigint: add SIGINT handler to process it gracefully.
-		log.debug("Starting the NFCT generator", level=4)
+		# 			- or'ed NFCT_OF_* flags, None = set all. Only used with decoder='xml'.
+		# 		decoder: 'binary' reads attributes via nfct_get_attr_*,
+		# 			'xml' uses nfct_snprintf(NFCT_O_XML) (slow, kept for debugging).
+		# 		batch_size: if set, the netlink socket is switched to non-blocking mode and
+		# 			each nfct_catch() drains up to batch_size events already queued on it.
+		# 			An empty list is yielded when nothing arrived within poll_timeout seconds.
+		# 		kernel_filter: dict of attach_filter() keyword arguments. Attached to the
+		# 			socket before the first event is received.
+		# 		rcvbuf_size: netlink socket receive buffer size in bytes, None keeps the default.
+		log.debug("Starting the NFCT generator with %s decoder", decoder, level=4)
+		assert decoder in DECODERS, decoder
 		if events is None:
-			events = (self.libnfct.NFCT_T_DESTROY | self.libnfct.NFCT_T_NEW | self.libnfct.NFCT_T_UPDATE)
+			events = (self.libnfct.NF_NETLINK_CONNTRACK_NEW | self.libnfct.NF_NETLINK_CONNTRACK_DESTROY)
 
 		if output_flags is None:
 			output_flags = (
@@ -191,24 +201,33 @@ class NFCT(object):  # pylint: disable=too-few-public-methods
 				self.libnfct.NFCT_OF_SHOW_LAYER3 |
 				self.libnfct.NFCT_OF_TIMESTAMP)
 
-		handle = self.nfct_open(self.libnfct.NFNL_SUBSYS_NONE, events, check_notnull=True)
+		handle = self.nfct_open(self.libnfct.NFNL_SUBSYS_CTNETLINK, events, check_notnull=True)
+		if rcvbuf_size:
+			size = self.c_nfnl_rcvbufsiz(self.nfct_nfnlh(handle, no_check=True), rcvbuf_size, no_check=True)
+			log.debug("Netlink receive buffer size is %i bytes", size, level=2)
 
 		cb_results = list()
-		xml_buff_size = self.BUF_SIZE  # ipv6 events are ~1k
-		xml_buff = self.ffi.new('char[]', xml_buff_size)
+		if decoder == 'xml':
+			xml_buff_size = self.BUF_SIZE  # ipv6 events are ~1k
+			xml_buff = self.ffi.new('char[]', xml_buff_size)
 
-		@self.ffi.callback('nfct_callback')
-		def recv_callback(handler, msg_type, ct_struct, data):  # pylint: disable=unused-argument, redefined-outer-name
-			try:
+			def decode(msg_type, ct_struct):
 				size = self.nfct_snprintf(xml_buff, xml_buff_size, ct_struct,
 					msg_type, self.libnfct.NFCT_O_XML, output_flags, check_gt0=True)
 				assert size <= xml_buff_size, size  # make sure xml fits
-				log.debug("Obtained data from the buffer %s", data, level=10)
-				data = self.ffi.buffer(xml_buff, size)[:]
-				cb_results.append(data)
+				return self.ffi.buffer(xml_buff, size)[:]
+		else:
+			decode = self.decode_ct
+
+		@self.ffi.callback('nfct_callback')
+		def recv_callback(handler, msg_type, ct_struct, data):  # pylint: disable=unused-argument, redefined-outer-name
+			try:
+				cb_results.append(decode(msg_type, ct_struct))
 			except:
 				cb_results.append(StopIteration)  # breaks the generator
 				raise
+			if batch_size and len(cb_results) < batch_size:
+				return self.libnfct.NFCT_CB_CONTINUE  # keep draining the socket
 			return self.libnfct.NFCT_CB_STOP  # to yield processed data from generator
 
 		def break_check(val):
@@ -216,20 +235,51 @@ class NFCT(object):  # pylint: disable=too-few-public-methods
 				raise val()
 			return val
 
+		def catch():
+			# Returns True if the socket overflowed
+			if self.nfct_catch(handle, no_check=True) < 0:
+				errno_ = self.ffi.errno
+				if errno_ == errno.ENOBUFS:
+					return True
+				# Returns with EAGAIN once a non-blocking socket is drained
+				if errno_ not in (errno.EAGAIN, errno.EWOULDBLOCK):
+					self._check_errno()
+			return False
+
 		self.nfct_callback_register2(handle, self.libnfct.NFCT_T_ALL, recv_callback, self.ffi.NULL)
+		fd = self.nfct_fd(handle)
+		if kernel_filter:
+			try:
+				self.attach_filter(fd, **kernel_filter)
+			except NFCTError as e:
+				log.warning("Could not attach kernel event filter, all events are filtered in userspace: %s", e)
+		if batch_size:
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+			poller = select.poll()
+			poller.register(fd, select.POLLIN)
 		try:
-			peek = break_check((yield self.nfct_fd(handle)))  # yield fd for poll() on first iteration
+			peek = break_check((yield fd))  # yield fd for poll() on first iteration
 			while True:
 				if peek:
 					peek = break_check((yield NFWouldBlock))  # poll/recv is required
 					continue
-				# No idea how many times callback will be used here
-				self.nfct_catch(handle)
-				# Yield individual events
-				for result in cb_results:
-					break_check(result)
-					peek = break_check((yield result))
-				cb_results = list()
+				if batch_size:
+					overflow = catch() if poller.poll(poll_timeout * 1000) else False
+					batch, cb_results = cb_results, list()
+					for result in batch:
+						break_check(result)
+					peek = break_check((yield batch))
+				else:
+					# No idea how many times callback will be used here
+					overflow = catch()
+					# Yield individual events
+					for result in cb_results:
+						break_check(result)
+						peek = break_check((yield result))
+					cb_results = list()
+				if overflow:
+					log.warning("Netlink socket overflowed, conntrack events were lost")
+					peek = break_check((yield NFOverflow))
 
 		finally:
 			self.nfct_callback_unregister2(handle, no_check=True)
@@ -5,6 +5,7 @@ from __future__ import print_function
 from xml.etree import ElementTree
 from io import BytesIO
 import datetime
+import time
 from collections import namedtuple
 import logging
 
@@ -13,6 +14,8 @@ try:
 except ImportError:
 	pass
 
+from . import conn_record
+
 log = logging.getLogger('cygnus.pynatconnd')
 
 FlowData = namedtuple('FlowData', 'src dst sport dport')
@@ -26,7 +29,7 @@ def parse_event(ev_xml):
 
 	flow = next(etree.iter())
 	ts = flow.find('when')
-	ts = str(datetime.datetime(*(int(ts.find(k).text) for k in ['year', 'month', 'day', 'hour', 'min', 'sec'])))
+	ts = int(time.mktime(datetime.datetime(*(int(ts.find(k).text) for k in ['year', 'month', 'day', 'hour', 'min', 'sec'])).timetuple()))
 	flow_data = dict()
 
 	for meta in flow.findall('meta'):
@@ -40,13 +43,38 @@ def parse_event(ev_xml):
 			flow_data[meta.attrib['direction']] = FlowData(src, dst, sport, dport)
 			flow_data['about'] = about_FlowData(ts, proto, flow.attrib['type'])
 
-	# Name of the keys should remain the same. If it has to be changed make sure the values under 'filter'
+	# Name of the fields should remain the same. If it has to be changed make sure the values under 'filter'
 	# section in configuration file and in workerqueue thread are also changed
-	nat_event = {'src_ip': flow_data['original'].src, 'src_port': flow_data['original'].sport,
-				'dst_ip': flow_data['original'].dst, 'dst_port': flow_data['original'].dport,
-				'nat_ip': flow_data['reply'].dst, 'nat_port': flow_data['reply'].dport,
-				'time': flow_data['about'].ts,
-				'sig_type': flow_data['about'].proto, 'protocol': flow_data['about'].type}
+	l3proto, l4proto = flow_data['about'].type
+	nat_event = conn_record.ConnRecord(
+		conn_record.L3PROTOS[l3proto], conn_record.L4PROTOS[l4proto], conn_record.SIG_TYPES.get(flow_data['about'].proto, 0),
+		conn_record.parse_field('src_ip', flow_data['original'].src), flow_data['original'].sport,
+		conn_record.parse_field('dst_ip', flow_data['original'].dst), flow_data['original'].dport,
+		conn_record.parse_field('nat_ip', flow_data['reply'].dst), flow_data['reply'].dport,
+		flow_data['about'].ts)
+
+	log.debug("Returning a record from parse_event function %s", nat_event, level=10)
+	return nat_event
+
+
+def parse_record(record, invalid=None):
+	"""Convert a CTRecord from the binary decoder into a ConnRecord, like parse_event does for XML.
+	Records missing an address (attribute not set in the kernel message) are skipped and counted in
+	the invalid counter, if given."""
+	if record.l4proto not in conn_record.L4PROTO_NAMES:
+		return
+	if record.orig_src is None or record.orig_dst is None or record.repl_dst is None:
+		log.debug("Skipping conntrack event without address attributes %s", record, level=2)
+		if invalid is not None:
+			invalid.inc()
+		return
+	ts = record.ts_stop if record.ts_stop is not None else record.ts_start
+	nat_event = conn_record.ConnRecord(
+		record.l3proto, record.l4proto, record.msg_type,
+		int.from_bytes(record.orig_src, 'big'), record.orig_sport,
+		int.from_bytes(record.orig_dst, 'big'), record.orig_dport,
+		int.from_bytes(record.repl_dst, 'big'), record.repl_dport,
+		ts // 1000000000 if ts is not None else int(time.time()))
 
-	log.debug("Returning a dictionary from parse_event function %s", nat_event, level=10)
+	log.debug("Returning a record from parse_record function %s", nat_event, level=10)
 	return nat_event
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""On-demand profiling of the running daemon, started through /profile.
+
+cpu   - samples the Python stacks of all threads (sys._current_frames) every interval for the
+        given seconds and returns them in collapsed format ("thread;frame;frame count" per line),
+        as read by flamegraph.pl or speedscope. Samples are wall clock: threads waiting on a
+        lock or socket are included unless idle is off.
+alloc - takes tracemalloc snapshots at the start and the end of the given seconds and returns
+        the allocations that grew in between, largest first.
+
+Nothing is sampled or traced while no profile is running."""
+import collections
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import logging
+
+try:
+	import cygnuslog  # pylint: disable=unused-import
+except ImportError:
+	pass
+
+log = logging.getLogger('cygnus.pynatconnd')
+
+MODES = ('cpu', 'alloc')
+MAX_SECONDS = 300.0
+# Shortest cpu sample interval in seconds, shorter ones keep the GIL from the daemon threads
+MIN_INTERVAL = 0.001
+# Innermost frames (file, function) of threads waiting for work, left out of cpu profiles with idle off
+IDLE_FRAMES = set([
+	('threading.py', 'wait'), ('threading.py', '_wait_for_tstate_lock'), ('selectors.py', 'select'),
+	('queue.py', 'get'), ('base_events.py', '_run_once')])
+# Request threads of the wsgiref engine are numbered, their samples are merged
+_THREAD_NUMBER = re.compile(r'-\d+')
+
+
+def frame_label(code):
+	return '%s:%s' % (os.path.basename(code.co_filename), getattr(code, 'co_qualname', code.co_name))
+
+
+def sample_stacks(seconds, interval=0.01, idle=True):
+	"""Counter of collapsed stacks of all other threads sampled every interval for seconds"""
+	counts = collections.Counter()
+	labels = {}
+	names = {}
+	own = threading.get_ident()
+	deadline = time.monotonic() + seconds
+	while time.monotonic() < deadline:
+		frames = sys._current_frames()  # pylint: disable=protected-access
+		for ident, frame in frames.items():
+			if ident == own:
+				continue
+			if ident not in names:
+				names.update((t.ident, _THREAD_NUMBER.sub('', t.name)) for t in threading.enumerate())
+			if not idle and (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES:
+				continue
+			stack = []
+			while frame is not None:
+				code = frame.f_code
+				label = labels.get(code)
+				if label is None:
+					label = labels[code] = frame_label(code)
+				stack.append(label)
+				frame = frame.f_back
+			stack.append(names.get(ident, 'thread-%i' % ident))
+			counts[';'.join(reversed(stack))] += 1
+		del frames
+		time.sleep(interval)
+	return counts
+
+
+def collapsed(counts):
+	return ''.join('%s %i\n' % (stack, count) for stack, count in sorted(counts.items()))
+
+
+def trace_allocations(seconds, frames=1, limit=50):
+	"""Allocations grown within seconds as text, grouped by line (frames 1) or traceback"""
+	started = not tracemalloc.is_tracing()
+	if started:
+		tracemalloc.start(frames)
+	try:
+		first = tracemalloc.take_snapshot()
+		time.sleep(seconds)
+		second = tracemalloc.take_snapshot()
+	finally:
+		if started:
+			tracemalloc.stop()
+	filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+	stats = second.filter_traces(filters).compare_to(first.filter_traces(filters), 'traceback' if frames > 1 else 'lineno')
+	lines = ["%+i bytes in %+i blocks within %.1fs" % (sum(s.size_diff for s in stats), sum(s.count_diff for s in stats), seconds)]
+	for stat in sorted(stats, key=lambda s: s.size_diff, reverse=True)[:limit]:
+		if stat.size_diff <= 0:
+			break
+		lines.append("%+i bytes %+i blocks (%i bytes in %i blocks) %s" % (
+			stat.size_diff, stat.count_diff, stat.size, stat.count, stat.traceback[-1]))
+		if frames > 1:
+			lines.extend('    %s' % line for line in stat.traceback.format(most_recent_first=True)[2:])
+	return '\n'.join(lines) + '\n'
+
+
+class Profiler(object):
+	"""Runs one profile at a time in a background thread and keeps the result of the last one"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.thread = None
+		self.result = None
+		self.current = None
+
+	@property
+	def running(self):
+		return self.thread is not None and self.thread.is_alive()
+
+	def start(self, mode, seconds, **options):
+		"""Start a profile, returns False if one is running already"""
+		if mode not in MODES:
+			raise ValueError("Unknown profile mode %s" % mode)
+		if not 0 < seconds <= MAX_SECONDS:
+			raise ValueError("Profile duration has to be between 0 and %i seconds" % MAX_SECONDS)
+		if not MIN_INTERVAL <= options.get('interval', MIN_INTERVAL) <= seconds:
+			raise ValueError("Sample interval has to be at least %i millisecond and at most the profile duration" % (MIN_INTERVAL * 1000))
+		if options.get('limit', 1) < 1:
+			raise ValueError("Limit has to be a positive number of allocation sites")
+		with self.lock:
+			if self.running:
+				return False
+			self.current = dict(mode=mode, seconds=seconds, started=time.time(), **options)
+			self.thread = threading.Thread(target=self.run, args=(mode, seconds, options), name='Profiler', daemon=True)
+			self.thread.start()
+		log.info("Started %s profile for %.1fs with %s", mode, seconds, options)
+		return True
+
+	def run(self, mode, seconds, options):
+		try:
+			if mode == 'cpu':
+				result = collapsed(sample_stacks(seconds, **options))
+			else:
+				result = trace_allocations(seconds, **options)
+		except Exception as e:  # pylint: disable=broad-except
+			log.error("Profile failed with msg %s", e, exc_info=True)
+			result = "Profile failed: %s\n" % e
+		self.result = result
+		log.info("Finished %s profile", mode)
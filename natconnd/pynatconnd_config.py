@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """Pynatconnd config spec"""
+import platform
 import configobj
 import validate
 
+from . import conn_filter
+from . import ring_buffer
+
 
 CONFIG_SPEC = r"""
 [syslog]
@@ -11,18 +15,65 @@ local_facility=integer(min=0,max=7,default=0)
 debug_level=integer(min=0,max=10,default=4)
 
 [filter]
-src_ip = ip_addr(default=None)
-src_port = integer(default=None)
-nat_ip = ip_addr(default=None)
-nat_port = integer(default=None)
-dst_ip = ip_addr(default=None)
-dst_port = integer(default=None)
+src_ip = force_list(default=None)
+src_port = force_list(default=None)
+nat_ip = force_list(default=None)
+nat_port = force_list(default=None)
+dst_ip = force_list(default=None)
+dst_port = force_list(default=None)
+protocol = force_list(default=None)
 
 [data]
 key_name = string(min=1)
+indexes = string_list(default=list())
+preserialize = boolean(default=True)
 del_delay = float(default=10.0)
 garbage_cleaner_interval = float(default=3600.0)
 life_span=float(default=3600.0)
+gc_slice_size = integer(min=1, default=1000)
+
+[nfct]
+source = option('nfct', 'fake', default='nfct')
+decoder = option('binary', 'xml', default='binary')
+batch_size = integer(min=0, default=256)
+kernel_filter = boolean(default=True)
+rcvbuf_size = integer(min=0, default=8388608)
+resync = boolean(default=True)
+resync_interval = float(min=0, default=10.0)
+warm_start = boolean(default=True)
+warm_start_timeout = float(min=0, default=30.0)
+reconcile_interval = float(min=0, default=0)
+queue_size = integer(min=0, default=100000)
+queue_policy = option('block', 'drop_oldest', 'drop_update', default='block')
+ingest_process = boolean(default=False)
+ring_size = integer(min=1024, default=262144)
+
+[fake]
+rate = float(min=0, default=0)
+events = integer(min=0, default=0)
+connections = integer(min=1, default=100000)
+update_ratio = float(min=0, max=1, default=0)
+udp_ratio = float(min=0, max=1, default=0)
+src_net = string(default='10.0.0.0/8')
+dst_ip = string(default='198.51.100.1')
+dst_port = integer(min=0, max=65535, default=443)
+nat_ip = string_list(default=list('100.64.2.1'))
+nat_ports = string(default='1024-65535')
+port_distribution = option('uniform', 'sequential', 'zipf', default='uniform')
+replay = string(default=None)
+seed = integer(default=None)
+
+[snapshot]
+file = string(default=None)
+interval = float(min=0, default=300.0)
+
+[history]
+dir = string(default=None)
+segment_size = integer(min=65536, default=67108864)
+segment_age = float(min=1, default=3600.0)
+retention = float(min=0, default=2592000.0)
+max_size = integer(min=0, default=0)
+flush_interval = float(min=0.01, default=1.0)
 
 [threading]
 join_timeout = float(default=5.0)
@@ -31,6 +82,13 @@ join_timeout = float(default=5.0)
 host = string(min=1, default="127.0.0.1")
 port = integer(min=1024, default=8080)
 ip_acl = string_list
+acl_cache_size = integer(min=0, default=1024)
+engine = option('wsgiref', 'asyncio', default='wsgiref')
+keepalive_timeout = float(min=0.1, default=60.0)
+batch_max_keys = integer(min=1, default=10000)
+workers = integer(min=0, default=0)
+admin_port = integer(min=1024, default=8081)
+shm_slots = integer(min=1024, default=2097152)
 """
 
 
@@ -52,6 +110,17 @@ class PynatconndConfig(object):  # pylint: disable=R0903
 		res = self.config.validate(validator, preserve_errors=True)
 		for section_list, key, error in configobj.flatten_errors(self.config, res):  # pylint: disable=W0612
 			raise PynatconndConfigException("Failed to validate section %s key %s in config file %s" % (", ".join(section_list), key, cfg))
+		try:
+			conn_filter.parse(self.config['filter'])
+		except ValueError as e:
+			raise PynatconndConfigException("Failed to validate section filter in config file %s: %s" % (cfg, e))
+		if self.config['nfct']['ingest_process'] and not ring_buffer.supported():
+			raise PynatconndConfigException(
+				"Failed to validate section nfct key ingest_process in config file %s: the ring buffer needs an x86 CPU, not %s" % (cfg, platform.machine()))
+		# The netlink socket is only subscribed to NEW and DESTROY events, there are no UPDATEs to drop
+		if self.config['nfct']['queue_policy'] == 'drop_update' and self.config['nfct']['source'] != 'fake':
+			raise PynatconndConfigException(
+				"Failed to validate section nfct key queue_policy in config file %s: drop_update needs UPDATE events, only the fake source has them" % cfg)
 
 	def get_configobj(self):
 		"""Function returning created ConfigObj
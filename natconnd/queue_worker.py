@@ -1,46 +1,134 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import functools
 import logging
+import time
 try:
 	import cygnuslog  # pylint: disable=unused-import
 except ImportError:
 	pass
 
 from . import base_thread
+from . import conn_filter
+from . import conn_record
+from . import event_source
+from . import net_filter
 from . import nfct_cffi  # pylint: disable=no-name-in-module
 from . import nfct_logger  # pylint: disable=no-name-in-module
 
 log = logging.getLogger('cygnus.pynatconnd')
 
 
+def kernel_filter(filter_conf):
+	"""Part of the [filter] section the kernel can evaluate, as keyword arguments of NFCT.attach_filter.
+	The kernel only sees the original direction of a connection, so nat_ip and ports are left to NetFilter.
+	Networks are only passed on for fields without excluded terms, NetFilter checks the rest.
+	Events of other protocols than tcp and udp are always dropped, they are ignored anyway."""
+	fields = dict((field.name, field) for field in conn_filter.parse(filter_conf))
+	l4protos = set(conn_record.L4PROTO_NAMES)
+	if 'protocol' in fields:
+		if fields['protocol'].include:
+			l4protos &= set(fields['protocol'].include)
+		l4protos -= set(fields['protocol'].exclude)
+	result = {'l4protos': sorted(l4protos)}
+	for key, arg in (('src_ip', 'src_nets'), ('dst_ip', 'dst_nets')):
+		if key in fields and fields[key].include and not fields[key].exclude:
+			result[arg] = fields[key].include
+	return result
+
+
 class QueueWorker(base_thread.BaseThread):
-	def __init__(self, event_queue, shared_statistics):
-		base_thread.BaseThread.__init__(self, shared_statistics)
+	def __init__(self, event_queue, shared_resource, source=None):
+		"""source is an event source (see event_source), by default the one configured in [nfct] source"""
+		base_thread.BaseThread.__init__(self, shared_resource['statistics'])
 		log.debug("Initializing  worker thread", level=4)
 		self.setName('QueueWorker')
 		self.event_queue = event_queue
+		self.conf = shared_resource['conf']
+		self.source = source
+		self.decoder = shared_resource['conf']['nfct']['decoder']
+		self.batch_size = shared_resource['conf']['nfct']['batch_size']
+		self.kernel_filter = kernel_filter(shared_resource['conf']['filter']) if shared_resource['conf']['nfct']['kernel_filter'] else None
+		self.rcvbuf_size = shared_resource['conf']['nfct']['rcvbuf_size']
+		self.resync_enabled = shared_resource['conf']['nfct']['resync']
+		self.resync_interval = shared_resource['conf']['nfct']['resync_interval']
+		self.reconcile_interval = shared_resource['conf']['nfct']['reconcile_interval']
+		self.warm_start = shared_resource['conf']['nfct']['warm_start']
+		self.warm_start_done = shared_resource.get('warm_start')
+		self.overflows = self.shared_statistics.counter('natconnd_netlink_overflows_total', 'Netlink socket overflows (ENOBUFS) losing events')
+		self.resyncs = self.shared_statistics.counter('natconnd_resyncs_total', 'Kernel conntrack table dumps queued for reconciliation')
+		self.invalid = self.shared_statistics.counter('natconnd_events_invalid_total', 'Conntrack events skipped for missing attributes')
+
+	def resync(self, logger, done=None):
+		"""Queue a dump of the kernel conntrack table, NetFilter reconciles the table with it.
+		done is set once that happened or right away if the dump failed. Returns False if the dump failed."""
+		start = time.monotonic()
+		try:
+			records = [r for r in (nfct_logger.parse_record(ct, self.invalid) for ct in logger.dump()) if r]
+		except nfct_cffi.NFCTError as e:
+			log.error("Failed to dump the conntrack table: %s", e)
+			if done is not None:
+				done.set()
+			return False
+		self.event_queue.put(net_filter.Resync(records, done))
+		self.resyncs.inc()
+		log.info("Queued resync with %i connections dumped in %.3fs", len(records), time.monotonic() - start)
+		return True
 
 	def run(self):
 		log.debug("Starting worker thread", level=4)
 		self.running = True
-		log.debug("Creating an instance of NFCT logger", level=4)
-		logger = nfct_cffi.NFCT()
-		src = logger.generator()
-		for x, ev_xml in enumerate(src):
+		log.debug("Creating an instance of the %s event source", self.conf['nfct']['source'], level=4)
+		logger = self.source if self.source is not None else event_source.create(self.conf)
+		log.debug("Kernel event filter is %s", self.kernel_filter, level=2)
+		src = logger.generator(decoder=self.decoder, batch_size=self.batch_size or None, kernel_filter=self.kernel_filter, rcvbuf_size=self.rcvbuf_size or None)
+		if self.decoder == 'xml':
+			parse = nfct_logger.parse_event
+		else:
+			parse = functools.partial(nfct_logger.parse_record, invalid=self.invalid)
+		events_received = self.shared_statistics.counter('natconnd_events_received_total', 'Conntrack events received from the kernel')
+		resync_pending = False
+		next_resync = 0.0
+		next_reconcile = time.monotonic() + self.reconcile_interval
+		for x, ev_data in enumerate(src):
 			if x == 0:
+				# Subscribed to events now, so no connection opened during the dump is missed
+				if self.warm_start:
+					self.resync(logger, self.warm_start_done)
+				elif self.warm_start_done is not None:
+					self.warm_start_done.set()
 				continue
-			try:
-				event = nfct_logger.parse_event(ev_xml)
-			except Exception as e:
-				log.error("Caught an exception %s", e)
-				raise
+			if ev_data is nfct_cffi.NFOverflow:
+				self.overflows.inc()
+				resync_pending = self.resync_enabled
+				ev_data = []
+			elif not self.batch_size:
+				ev_data = [ev_data]
+			# Resync at most every resync_interval seconds when the socket keeps overflowing
+			if resync_pending and time.monotonic() >= next_resync:
+				resync_pending = not self.resync(logger)
+				next_resync = time.monotonic() + self.resync_interval
+			if self.reconcile_interval and time.monotonic() >= next_reconcile:
+				self.resync(logger)
+				next_reconcile = time.monotonic() + self.reconcile_interval
+			events = list()
+			for data in ev_data:
+				try:
+					event = parse(data)
+				except Exception as e:
+					log.error("Caught an exception %s", e)
+					raise
 
-			if not event:  # Commonly occurring error
-				continue
+				if not event:  # Commonly occurring error
+					continue
+				events.append(event)
 
-			log.debug("Adding element %s to the queue", event, level=10)
-			self.event_queue.put(event)
-			self.shared_statistics['queue_size'] = self.event_queue.qsize()
+			events_received.inc(len(ev_data))
+			if events:
+				log.debug("Adding %i elements to the queue", len(events), level=10)
+				# Dropped events are lost like on a socket overflow
+				if self.event_queue.put(events):
+					resync_pending = self.resync_enabled
 			if not self.running:
 				log.debug("Stoping the Receiver thread is running value is %s", self.running, level=1)
 				break
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Single producer, single consumer ring of fixed size records in shared memory.
+
+Carries the events of the ingest process to the daemon. The writer only advances head, the
+reader only advances tail, both counters only grow, so the reader never reads records that are
+not published yet and the writer never overwrites records that are not read yet - as long as
+the other process sees the stores in program order and each 8 byte aligned counter is written
+with one store. Python has no memory barriers to enforce that, the ring relies on x86 (total
+store order). ARM or POWER may make head visible before the records, so the ring is only used
+on the machines in ORDERED_MACHINES (supported()).
+
+The writer writes a byte to the wakeup pipe after publishing head, the reader blocks on the
+pipe while the ring is empty instead of polling it.
+
+The daemon counts the events its event queue dropped in the header, the ingest process resyncs
+when that count grew, like QueueWorker does when its own put() drops events.
+
+Besides events the ring carries control records: a resync is sent as RESYNC_BEGIN, the dumped
+connections as DUMP records and RESYNC_END, WARM_START tells the daemon the warm start is done."""
+import os
+import platform
+import struct
+import time
+import logging
+from multiprocessing import shared_memory
+
+try:
+	import cygnuslog  # pylint: disable=unused-import
+except ImportError:
+	pass
+
+from . import conn_record
+from . import net_filter
+from . import shm_table
+
+log = logging.getLogger('cygnus.pynatconnd')
+
+MAGIC = b'NATCRNG2'
+# magic, capacity, record size, head, tail, counters of the ingest process, events dropped by the daemon
+HEADER = struct.Struct('<8sIIQQ')
+HEADER_SIZE = 128
+HEAD_OFFSET = 16
+TAIL_OFFSET = 24
+COUNTERS_OFFSET = 32
+DROPPED_OFFSET = 64
+COUNTER = struct.Struct('<Q')
+# kind, family, protocol, sig_type, src_port, dst_port, nat_port, time, src_ip, dst_ip, nat_ip
+RECORD = struct.Struct('<BBBBHHHxxq16s16s16s4x')
+
+EVENT = 0
+RESYNC_BEGIN = 1
+DUMP = 2
+RESYNC_END = 3
+WARM_START = 4
+
+# Counters of the ingest process published in the header, at most 4
+COUNTERS = ('natconnd_events_received_total', 'natconnd_netlink_overflows_total', 'natconnd_resyncs_total', 'natconnd_events_invalid_total')
+
+# Seconds the writer waits for the reader to make room
+FULL_WAIT = 0.001
+# Seconds between updates of the published counters
+COUNTERS_INTERVAL = 1.0
+# platform.machine() of CPUs that do not reorder stores, see above
+ORDERED_MACHINES = ('x86_64', 'amd64', 'i386', 'i486', 'i586', 'i686')
+
+
+def supported():
+	return platform.machine().lower() in ORDERED_MACHINES
+
+
+def wake(fd):
+	"""Write to the wakeup pipe fd, a full pipe wakes the reader anyway"""
+	try:
+		os.write(fd, b'\0')
+	except BlockingIOError:
+		pass
+
+
+class RingBufferError(Exception):
+	pass
+
+
+class RingBuffer(object):
+	"""Creates the segment with capacity records if name is None, otherwise attaches to it.
+	The writer signals the write end of a pipe given as wakeup after publishing records."""
+	def __init__(self, capacity=None, name=None, wakeup=None):
+		if name is None:
+			self.capacity = int(capacity)
+			self.shm = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + self.capacity * RECORD.size)
+			HEADER.pack_into(self.shm.buf, 0, MAGIC, self.capacity, RECORD.size, 0, 0)
+		else:
+			self.shm = shm_table._attach(name)  # pylint: disable=protected-access
+			magic, self.capacity, record_size, _, _ = HEADER.unpack_from(self.shm.buf, 0)
+			if magic != MAGIC or record_size != RECORD.size:
+				raise RingBufferError("%s is not a ring buffer segment" % name)
+		self.name = self.shm.name
+		self.buf = self.shm.buf
+		self.unlinked = False
+		self.wakeup = wakeup
+		if wakeup is not None:
+			os.set_blocking(wakeup, False)
+
+	def _get(self, offset):
+		return COUNTER.unpack_from(self.buf, offset)[0]
+
+	def _set(self, offset, value):
+		COUNTER.pack_into(self.buf, offset, value)
+
+	def __len__(self):
+		return max(self._get(HEAD_OFFSET) - self._get(TAIL_OFFSET), 0)
+
+	def close(self, unlink=False):
+		if unlink and not self.unlinked:
+			self.unlinked = True
+			self.shm.unlink()
+
+	def _publish(self, head):
+		self._set(HEAD_OFFSET, head)
+		if self.wakeup is not None:
+			wake(self.wakeup)
+
+	# Writer
+
+	def write(self, records, kind=EVENT):
+		"""Append records, waits while the ring is full"""
+		head = self._get(HEAD_OFFSET)
+		tail = self._get(TAIL_OFFSET)
+		buf = self.buf
+		pack_into = RECORD.pack_into
+		for record in records:
+			while head - tail >= self.capacity:
+				# Publish what is written so far, the reader would wait for it otherwise
+				self._publish(head)
+				time.sleep(FULL_WAIT)
+				tail = self._get(TAIL_OFFSET)
+			pack_into(
+				buf, HEADER_SIZE + (head % self.capacity) * RECORD.size, kind, record.family, record.protocol, record.sig_type,
+				record.src_port, record.dst_port, record.nat_port, record.time,
+				record.src_ip.to_bytes(16, 'big'), record.dst_ip.to_bytes(16, 'big'), record.nat_ip.to_bytes(16, 'big'))
+			head += 1
+		self._publish(head)
+
+	def write_control(self, kind, flag=0):
+		"""Append a control record, flag is passed in sig_type"""
+		self.write([conn_record.ConnRecord(0, 0, flag, 0, 0, 0, 0, 0, 0, 0)], kind)
+
+	def publish_counters(self, values):
+		for i, value in enumerate(values):
+			self._set(COUNTERS_OFFSET + i * COUNTER.size, value)
+
+	# Reader
+
+	def read(self, limit):
+		"""Up to limit records as (kind, ConnRecord) tuples, removed from the ring"""
+		tail = self._get(TAIL_OFFSET)
+		count = min(self._get(HEAD_OFFSET) - tail, limit)
+		if count <= 0:
+			return []
+		start = tail % self.capacity
+		chunks = [(start, min(count, self.capacity - start))]
+		if chunks[0][1] < count:
+			chunks.append((0, count - chunks[0][1]))
+		from_bytes = int.from_bytes
+		records = []
+		for first, length in chunks:
+			offset = HEADER_SIZE + first * RECORD.size
+			for kind, family, protocol, sig_type, src_port, dst_port, nat_port, time_, src_ip, dst_ip, nat_ip in RECORD.iter_unpack(self.buf[offset:offset + length * RECORD.size]):
+				records.append((kind, conn_record.ConnRecord(
+					family, protocol, sig_type, from_bytes(src_ip, 'big'), src_port, from_bytes(dst_ip, 'big'), dst_port,
+					from_bytes(nat_ip, 'big'), nat_port, time_)))
+		self._set(TAIL_OFFSET, tail + count)
+		return records
+
+	def counters(self):
+		return [self._get(COUNTERS_OFFSET + i * COUNTER.size) for i in range(len(COUNTERS))]
+
+	def add_dropped(self, count):
+		"""Count events dropped after they were read, only the reader calls this"""
+		self._set(DROPPED_OFFSET, self._get(DROPPED_OFFSET) + count)
+
+	def dropped(self):
+		return self._get(DROPPED_OFFSET)
+
+
+class RingWriter(object):
+	"""Stands in for the event queue of QueueWorker in the ingest process.
+	Events not matching the filter are dropped before they are written. put() returns the
+	events the daemon dropped since the last call, so QueueWorker resyncs after them."""
+	def __init__(self, ring, conn_filter, statistics):
+		self.ring = ring
+		self.conn_filter = conn_filter
+		self.statistics = statistics
+		self.next_counters = 0.0
+		# Drops before the start are covered by the warm start
+		self.dropped = ring.dropped()
+
+	def put(self, batch):
+		if isinstance(batch, net_filter.Resync):
+			match = self.conn_filter.match
+			self.ring.write_control(RESYNC_BEGIN)
+			self.ring.write([x for x in batch.records if match(x)], DUMP)
+			self.ring.write_control(RESYNC_END, 1 if batch.done is not None else 0)
+		else:
+			if self.conn_filter.profiling:
+				self.conn_filter.observe(batch)
+			match = self.conn_filter.match
+			self.ring.write([x for x in batch if match(x)])
+		now = time.monotonic()
+		if now >= self.next_counters:
+			self.ring.publish_counters([self.statistics.value(name) for name in COUNTERS])
+			self.next_counters = now + COUNTERS_INTERVAL
+		dropped = self.ring.dropped()
+		count = dropped - self.dropped
+		self.dropped = dropped
+		return count
+
+
+class WarmStartMarker(object):  # pylint: disable=too-few-public-methods
+	"""Stands in for the warm start event of QueueWorker in the ingest process"""
+	def __init__(self, ring):
+		self.ring = ring
+
+	def set(self):
+		self.ring.write_control(WARM_START)
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Connection table mirrored into shared memory for the HTTP worker processes.
+
+Fixed size open addressing hash table (linear probing). Entries are hashed by protocol,
+nat_ip and the key_name value, so the mappings of a port on several NAT IPs do not pile up in
+one probe sequence. The (protocol, nat_ip) pairs seen so far are listed in the segment, and a
+directory (a second hash table of the same number of slots, keyed by the hash of the key_name
+value) lists the pairs having entries of a value. A lookup probes the sequences of those pairs
+only, values with more than CANDIDATES pairs are looked up in the sequences of all pairs.
+
+The daemon process is the only writer (all writes happen with the shared data lock held),
+worker processes read without any lock:
+
+- every slot has a sequence counter that is odd while the slot is written, readers retry
+  a slot that was written while they copied it (seqlock)
+- deletes close the gap by moving later entries of the probe sequence back instead of
+  leaving tombstones, entries moved that way are guarded by a table wide move counter,
+  readers retry the whole lookup if a move happened meanwhile.
+
+Readers give up with SharedTableError after RETRY_TIMEOUT seconds of retrying, e.g. when
+the writer died in the middle of a write."""
+import struct
+import time
+import logging
+from multiprocessing import shared_memory
+
+try:
+	import cygnuslog  # pylint: disable=unused-import
+except ImportError:
+	pass
+
+from . import conn_record
+from . import conn_table
+
+log = logging.getLogger('cygnus.pynatconnd')
+
+MAGIC = b'NATCSHM3'
+# magic, number of slots, slot size, move counter, entries, (protocol, nat_ip) pairs
+HEADER = struct.Struct('<8sIIQQQ')
+HEADER_SIZE = 64
+MOVES_OFFSET = 16
+PREFIXES_OFFSET = 32
+# protocol, nat_ip of the (protocol, nat_ip) pairs, following the header
+PREFIX = struct.Struct('<Bxxx16s')
+MAX_PREFIXES = 4096
+DIRECTORY_OFFSET = HEADER_SIZE + MAX_PREFIXES * PREFIX.size
+# Pairs listed per directory slot, values with more pairs are marked OVERFLOW
+CANDIDATES = 8
+OVERFLOW = 0xff
+# seq, used, number of pairs, hash of the key_name value, indexes of the pairs
+DIRECTORY_SLOT = struct.Struct('<IBBxxQ%iH' % CANDIDATES)
+# seq, used, family, protocol, sig_type, src_port, dst_port, nat_port, time, record seq, src_ip, dst_ip, nat_ip
+SLOT = struct.Struct('<IBBBBHHHxxqQ16s16s16s')
+SEQ = struct.Struct('<I')
+COUNTER = struct.Struct('<Q')
+
+# Inserts are refused above this fill ratio to keep probe sequences short
+MAX_LOAD = 0.75
+# Slot reads retried before the lookup starts over, seconds a lookup is retried at most
+READ_SPINS = 100
+RETRY_TIMEOUT = 0.1
+
+_MASK64 = 0xffffffffffffffff
+_FIBONACCI = 0x9e3779b97f4a7c15
+
+
+class SharedTableError(Exception):
+	pass
+
+
+def segment_size(slots):
+	"""Bytes of a segment with slots slots"""
+	return DIRECTORY_OFFSET + slots * (DIRECTORY_SLOT.size + SLOT.size)
+
+
+class SharedTable(object):
+	"""Writer side (name=None) creates the segment with at least slots slots, readers attach by name.
+	Provides lookup() and indexes like ConnTable for the HTTP handlers, only key_name can be looked up."""
+	def __init__(self, key_name, slots=None, name=None):
+		self.key_name = key_name
+		self.indexes = (key_name, )
+		self.get_key_value = conn_table.INDEX_FIELDS[key_name]
+		if name is None:
+			bits = max(int(slots) - 1, 1).bit_length()
+			self.slots = 1 << bits
+			self.shm = shared_memory.SharedMemory(create=True, size=segment_size(self.slots))
+			HEADER.pack_into(self.shm.buf, 0, MAGIC, self.slots, SLOT.size, 0, 0, 0)
+			# Writer side state, primary key -> slot and slot -> (primary key, home slot, value hash, pair)
+			self.positions = dict()
+			self.slot_keys = [None] * self.slots
+			self.prefixes = dict()
+			# value hash -> {pair: entries}, value hash -> directory slot and directory slot -> (value hash, home slot)
+			self.values = dict()
+			self.directory_positions = dict()
+			self.directory_keys = [None] * self.slots
+			self.max_entries = int(self.slots * MAX_LOAD)
+			self.rejected = 0
+		else:
+			self.shm = _attach(name)
+			magic, self.slots, slot_size, _, _, _ = HEADER.unpack_from(self.shm.buf, 0)
+			# Reader side copy of the (protocol, nat_ip) pairs, they are only ever appended
+			self.prefix_list = []
+			if magic != MAGIC or slot_size != SLOT.size:
+				raise SharedTableError("%s is not a connection table segment" % name)
+			bits = self.slots.bit_length() - 1
+		self.name = self.shm.name
+		self.buf = self.shm.buf
+		self.mask = self.slots - 1
+		self.shift = 64 - bits
+		self.slots_offset = DIRECTORY_OFFSET + self.slots * DIRECTORY_SLOT.size
+
+	def home(self, protocol, nat_ip, value):
+		# Fibonacci hashing, hash() of ints and tuples of ints is the same in every process
+		return ((hash((protocol, nat_ip, value)) * _FIBONACCI) & _MASK64) >> self.shift
+
+	def directory_home(self, value_hash):
+		return ((value_hash * _FIBONACCI) & _MASK64) >> self.shift
+
+	def __len__(self):
+		return HEADER.unpack_from(self.buf, 0)[4]
+
+	# Writer
+
+	def insert(self, key, record):
+		"""Add or replace the entry of primary key key. Returns False if the table is full."""
+		value = self.get_key_value(record)
+		home = self.home(record.protocol, record.nat_ip, value)
+		pos = self.positions.get(key)
+		if pos is not None and self.slot_keys[pos][1] != home:
+			# key_name changed for this primary key, entry has to move to another probe sequence
+			self.remove(key)
+			pos = None
+		if pos is None:
+			if len(self.positions) >= self.max_entries:
+				self.rejected += 1
+				if self.rejected == 1:
+					log.error("Shared memory table is full with %i entries, HTTP workers miss new connections - increase shm_slots", len(self.positions))
+				return False
+			pair = self._add_prefix(record.protocol, record.nat_ip)
+			if pair is None:
+				self.rejected += 1
+				return False
+			value_hash = hash(value) & _MASK64
+			pos = self._place(self.positions, self.slot_keys, key, home)
+			self.slot_keys[pos] = (key, home, value_hash, pair)
+			self._set_count()
+			self._write(pos, record)
+			# Listed in the directory once the entry can be found
+			self._add_candidate(value_hash, pair)
+			return True
+		self._write(pos, record)
+		return True
+
+	def remove(self, key):
+		pos = self.positions.get(key)
+		if pos is None:
+			return
+		_, _, value_hash, pair = self.slot_keys[pos]
+		self._remove(self.positions, self.slot_keys, self.slots_offset, SLOT.size, key)
+		self._set_count()
+		self._remove_candidate(value_hash, pair)
+
+	def close(self, unlink=False):
+		if unlink:
+			self.shm.unlink()
+
+	def _offset(self, pos):
+		return self.slots_offset + pos * SLOT.size
+
+	def _place(self, positions, keys, key, home):
+		"""Free slot of the probe sequence starting at home, taken for key"""
+		pos = home
+		while keys[pos] is not None:
+			pos = (pos + 1) & self.mask
+		positions[key] = pos
+		keys[pos] = (key, home)
+		return pos
+
+	def _remove(self, positions, keys, offset, size, key):
+		pos = positions.pop(key)
+		# Backward shift: move later entries of the probe sequence into the gap
+		# as long as that does not move them before their home slot
+		hole = pos
+		moved = False
+		j = pos
+		while True:
+			j = (j + 1) & self.mask
+			entry = keys[j]
+			if entry is None:
+				break
+			if ((j - entry[1]) & self.mask) >= ((j - hole) & self.mask):
+				if not moved:
+					self._bump_moves()
+					moved = True
+				self._copy(offset + j * size, offset + hole * size, size)
+				keys[hole] = entry
+				positions[entry[0]] = hole
+				hole = j
+		self._clear(offset + hole * size)
+		keys[hole] = None
+		if moved:
+			self._bump_moves()
+
+	def _add_prefix(self, protocol, nat_ip):
+		"""Index of the (protocol, nat_ip) pair, published if it is new. None if there are too many."""
+		prefix = (protocol, nat_ip)
+		pair = self.prefixes.get(prefix)
+		if pair is not None:
+			return pair
+		if len(self.prefixes) >= MAX_PREFIXES:
+			log.error("More than %i protocol and NAT IP pairs, HTTP workers miss connections of %s", MAX_PREFIXES, prefix)
+			return None
+		pair = len(self.prefixes)
+		PREFIX.pack_into(self.buf, HEADER_SIZE + pair * PREFIX.size, protocol, nat_ip.to_bytes(16, 'big'))
+		self.prefixes[prefix] = pair
+		# Count is published after the pair is written
+		COUNTER.pack_into(self.buf, PREFIXES_OFFSET, len(self.prefixes))
+		return pair
+
+	def _add_candidate(self, value_hash, pair):
+		pairs = self.values.get(value_hash)
+		if pairs is None:
+			pairs = self.values[value_hash] = dict()
+		count = pairs.get(pair, 0)
+		pairs[pair] = count + 1
+		if not count:
+			self._write_directory(value_hash, pairs)
+
+	def _remove_candidate(self, value_hash, pair):
+		pairs = self.values[value_hash]
+		pairs[pair] -= 1
+		if pairs[pair]:
+			return
+		del pairs[pair]
+		if pairs:
+			self._write_directory(value_hash, pairs)
+		else:
+			del self.values[value_hash]
+			self._remove(self.directory_positions, self.directory_keys, DIRECTORY_OFFSET, DIRECTORY_SLOT.size, value_hash)
+
+	def _write_directory(self, value_hash, pairs):
+		pos = self.directory_positions.get(value_hash)
+		if pos is None:
+			pos = self._place(self.directory_positions, self.directory_keys, value_hash, self.directory_home(value_hash))
+		if len(pairs) > CANDIDATES:
+			count, candidates = OVERFLOW, [0] * CANDIDATES
+		else:
+			count, candidates = len(pairs), sorted(pairs) + [0] * (CANDIDATES - len(pairs))
+		off = DIRECTORY_OFFSET + pos * DIRECTORY_SLOT.size
+		seq = SEQ.unpack_from(self.buf, off)[0] + 1
+		SEQ.pack_into(self.buf, off, seq)
+		DIRECTORY_SLOT.pack_into(self.buf, off, seq, 1, count, value_hash, *candidates)
+		SEQ.pack_into(self.buf, off, seq + 1)
+
+	def _write(self, pos, record):
+		off = self._offset(pos)
+		seq = SEQ.unpack_from(self.buf, off)[0] + 1
+		SEQ.pack_into(self.buf, off, seq)
+		SLOT.pack_into(
+			self.buf, off, seq, 1, record.family, record.protocol, record.sig_type, record.src_port, record.dst_port, record.nat_port,
+			record.time, record.seq, record.src_ip.to_bytes(16, 'big'), record.dst_ip.to_bytes(16, 'big'), record.nat_ip.to_bytes(16, 'big'))
+		SEQ.pack_into(self.buf, off, seq + 1)
+
+	def _copy(self, src_off, dst_off, size):
+		seq = SEQ.unpack_from(self.buf, dst_off)[0] + 1
+		SEQ.pack_into(self.buf, dst_off, seq)
+		self.buf[dst_off + SEQ.size:dst_off + size] = self.buf[src_off + SEQ.size:src_off + size]
+		SEQ.pack_into(self.buf, dst_off, seq + 1)
+
+	def _clear(self, off):
+		seq = SEQ.unpack_from(self.buf, off)[0] + 1
+		SEQ.pack_into(self.buf, off, seq)
+		self.buf[off + SEQ.size] = 0
+		SEQ.pack_into(self.buf, off, seq + 1)
+
+	def _bump_moves(self):
+		COUNTER.pack_into(self.buf, MOVES_OFFSET, COUNTER.unpack_from(self.buf, MOVES_OFFSET)[0] + 1)
+
+	def _set_count(self):
+		COUNTER.pack_into(self.buf, MOVES_OFFSET + COUNTER.size, len(self.positions))
+
+	# Reader
+
+	def _read(self, struct_, off):
+		"""Fields of the slot at off, None if it was written while it was read READ_SPINS times"""
+		for _ in range(READ_SPINS):
+			fields = struct_.unpack_from(self.buf, off)
+			seq = fields[0]
+			if not seq & 1 and SEQ.unpack_from(self.buf, off)[0] == seq:
+				return fields
+		return None
+
+	def _prefixes(self):
+		count = COUNTER.unpack_from(self.buf, PREFIXES_OFFSET)[0]
+		for i in range(len(self.prefix_list), min(count, MAX_PREFIXES)):
+			protocol, nat_ip = PREFIX.unpack_from(self.buf, HEADER_SIZE + i * PREFIX.size)
+			self.prefix_list.append((protocol, int.from_bytes(nat_ip, 'big'), nat_ip))
+		return self.prefix_list
+
+	def _candidates(self, value_hash):
+		"""Pairs having entries of the value with value_hash, None if a slot could not be read"""
+		pos = self.directory_home(value_hash)
+		for _ in range(self.slots):
+			fields = self._read(DIRECTORY_SLOT, DIRECTORY_OFFSET + pos * DIRECTORY_SLOT.size)
+			if fields is None:
+				return None
+			if not fields[1]:
+				break
+			if fields[3] == value_hash:
+				prefixes = self._prefixes()
+				if fields[2] == OVERFLOW:
+					return prefixes
+				return [prefixes[pair] for pair in fields[4:4 + fields[2]]]
+			pos = (pos + 1) & self.mask
+		return []
+
+	def _probe(self, protocol, nat_ip, nat_ip_bytes, value, records):
+		"""Add the records of value in the probe sequence of (protocol, nat_ip), False if a slot could not be read"""
+		from_bytes = int.from_bytes
+		pos = self.home(protocol, nat_ip, value)
+		for _ in range(self.slots):
+			fields = self._read(SLOT, self._offset(pos))
+			if fields is None:
+				return False
+			_, used, family, protocol_, sig_type, src_port, dst_port, nat_port, time_, seq, src_ip, dst_ip, nat_ip_ = fields
+			if not used:
+				break
+			# Entries of other pairs sharing the probe sequence are found through their own pair
+			if protocol_ == protocol and nat_ip_ == nat_ip_bytes:
+				record = conn_record.ConnRecord(
+					family, protocol_, sig_type, from_bytes(src_ip, 'big'), src_port, from_bytes(dst_ip, 'big'), dst_port,
+					nat_ip, nat_port, time_)
+				if self.get_key_value(record) == value:
+					record.seq = seq
+					records.append(record)
+			pos = (pos + 1) & self.mask
+		return True
+
+	def lookup(self, index, value):
+		"""Records with index value, oldest first like ConnTable.lookup.
+		Raises SharedTableError if the table stays inconsistent for RETRY_TIMEOUT seconds."""
+		if index != self.key_name:
+			return []
+		value_hash = hash(value) & _MASK64
+		deadline = None
+		while True:
+			moves = COUNTER.unpack_from(self.buf, MOVES_OFFSET)[0]
+			if not moves & 1:
+				records = []
+				candidates = self._candidates(value_hash)
+				complete = candidates is not None and all(
+					self._probe(protocol, nat_ip, nat_ip_bytes, value, records) for protocol, nat_ip, nat_ip_bytes in candidates)
+				if complete and COUNTER.unpack_from(self.buf, MOVES_OFFSET)[0] == moves:
+					records.sort(key=lambda r: r.seq)
+					return records
+			now = time.monotonic()
+			if deadline is None:
+				deadline = now + RETRY_TIMEOUT
+			elif now >= deadline:
+				raise SharedTableError("Shared memory table %s stays inconsistent, the writer stopped while writing" % self.name)
+			time.sleep(0)
+
+
+def _attach(name):
+	try:
+		# Readers must not unlink the segment when they exit (Python >= 3.13)
+		return shared_memory.SharedMemory(name=name, track=False)  # pylint: disable=unexpected-keyword-arg
+	except TypeError:
+		return shared_memory.SharedMemory(name=name)
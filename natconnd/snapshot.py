@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""On-disk snapshots of the connection table for fast restarts.
+
+A snapshot is a header followed by fixed size little endian records, one per connection.
+IPs are stored as 16 byte big endian integers for both families. The refresh time of
+each entry is stored as epoch, so entries keep their age across a restart. Records are
+written in expiry order (least recently refreshed first)."""
+import gc
+import mmap
+import os
+import struct
+import threading
+import time
+import logging
+
+try:
+	import cygnuslog  # pylint: disable=unused-import
+except ImportError:
+	pass
+
+from . import base_thread
+from . import conn_record
+
+log = logging.getLogger('cygnus.pynatconnd')
+
+MAGIC = b'NATCSNAP'
+VERSION = 1
+# magic, version, record size, number of records, written at (epoch)
+HEADER = struct.Struct('<8sIIQd')
+# family, protocol, sig_type, src_port, dst_port, nat_port, time, refreshed at (epoch), src_ip, dst_ip, nat_ip
+RECORD = struct.Struct('<BBBxHHHxxqd16s16s16s')
+
+# Records packed per write() call
+WRITE_CHUNK = 10000
+
+
+class SnapshotError(Exception):
+	pass
+
+
+def write(path, entries):
+	"""Write (record, refreshed at epoch) pairs to path.
+	The file is replaced atomically, a crash while writing leaves the previous snapshot intact."""
+	tmp_path = '%s.tmp' % path
+	pack = RECORD.pack
+	count = 0
+	with open(tmp_path, 'wb') as f:
+		f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, 0, 0.0))
+		chunk = []
+		for record, refreshed in entries:
+			chunk.append(pack(
+				record.family, record.protocol, record.sig_type, record.src_port, record.dst_port, record.nat_port, record.time, refreshed,
+				record.src_ip.to_bytes(16, 'big'), record.dst_ip.to_bytes(16, 'big'), record.nat_ip.to_bytes(16, 'big')))
+			if len(chunk) >= WRITE_CHUNK:
+				f.write(b''.join(chunk))
+				count += len(chunk)
+				chunk = []
+		f.write(b''.join(chunk))
+		count += len(chunk)
+		# Header is written last, so a truncated file is never mistaken for a complete snapshot
+		f.seek(0)
+		f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, count, time.time()))
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tmp_path, path)
+	return count
+
+
+def read(path, life_span, now=None):
+	"""Yields (record, age in seconds) of the entries in the snapshot at path refreshed less than life_span seconds ago.
+	Raises SnapshotError for files that are not a complete snapshot."""
+	now = time.time() if now is None else now
+	with open(path, 'rb') as f:
+		size = os.fstat(f.fileno()).st_size
+		if size < HEADER.size:
+			raise SnapshotError("%s is too short for a snapshot" % path)
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			magic, version, record_size, count, _ = HEADER.unpack_from(mm)
+			if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+				raise SnapshotError("%s is not a version %i snapshot" % (path, VERSION))
+			if size != HEADER.size + count * RECORD.size:
+				raise SnapshotError("%s is truncated" % path)
+			view = memoryview(mm)[HEADER.size:]
+			try:
+				from_bytes = int.from_bytes
+				for family, protocol, sig_type, src_port, dst_port, nat_port, time_, refreshed, src_ip, dst_ip, nat_ip in RECORD.iter_unpack(view):
+					age = now - refreshed
+					if age > life_span:
+						continue
+					yield conn_record.ConnRecord(
+						family, protocol, sig_type, from_bytes(src_ip, 'big'), src_port, from_bytes(dst_ip, 'big'), dst_port,
+						from_bytes(nat_ip, 'big'), nat_port, time_), age
+			finally:
+				view.release()
+
+
+def save(path, shared_data, shared_data_lock):
+	"""Write a snapshot of the connection table, returns the number of entries written"""
+	with shared_data_lock:
+		records = shared_data.snapshot()
+		refresh_times = dict(shared_data.expiry)
+	# Refresh times are monotonic, the snapshot has to survive a reboot
+	offset = time.time() - time.monotonic()
+	return write(path, ((records[key], refresh_time + offset) for key, refresh_time in refresh_times.items()))
+
+
+def load(path, shared_data, life_span):
+	"""Fill the connection table from the snapshot at path before any thread is started.
+	Entries keep their age, so the garbage collector expires them as if there was no restart.
+	Returns the number of entries loaded."""
+	now = time.monotonic()
+	# The records are long lived and free of cycles, collecting while allocating a million of them only costs time
+	gc_enabled = gc.isenabled()
+	gc.disable()
+	try:
+		return shared_data.load((record, now - age) for record, age in read(path, life_span))
+	finally:
+		if gc_enabled:
+			gc.enable()
+
+
+class SnapshotThread(base_thread.BaseThread):
+	"""Writes a snapshot of the connection table every interval seconds"""
+	def __init__(self, shared_resource):
+		base_thread.BaseThread.__init__(self, shared_resource['statistics'])
+		log.debug("Initializing snapshot thread", level=2)
+		self.setName('Snapshot')
+		self.shared_data = shared_resource['data']
+		self.shared_data_lock = shared_resource['lock']
+		self.path = shared_resource['conf']['snapshot']['file']
+		self.interval = shared_resource['conf']['snapshot']['interval']
+		self.ev = threading.Event()
+		self.entries = self.shared_statistics.gauge('natconnd_snapshot_entries', 'Entries in the last written snapshot')
+		self.duration = self.shared_statistics.gauge('natconnd_snapshot_duration_seconds', 'Time to write the last snapshot')
+
+	def write(self):
+		start = time.monotonic()
+		try:
+			count = save(self.path, self.shared_data, self.shared_data_lock)
+		except (IOError, OSError) as e:
+			log.error("Failed to write snapshot %s: %s", self.path, e)
+			return
+		self.entries.set(count)
+		self.duration.set(time.monotonic() - start)
+		log.debug("Wrote snapshot %s with %i entries in %.3fs", self.path, count, time.monotonic() - start, level=2)
+
+	def run(self):
+		log.debug("Starting snapshot thread", level=1)
+		self.running = True
+		while self.running:
+			# interval 0 only writes the snapshot on shutdown
+			self.ev.wait(self.interval or None)
+			if not self.running:
+				break
+			self.write()
+		log.debug("Stopped snapshot thread", level=1)
+
+	def stop(self):
+		log.debug("Stopping snapshot thread", level=1)
+		self.running = False
+		self.ev.set()
@@ -34,6 +34,7 @@ Requires:       python-setuptools, python-configobj, python-ipaddress, python-cf
 %if 0%{?with_python3}
 BuildRequires:  python3-devel
 BuildRequires:  python3-setuptools
+BuildRequires:  python3-cffi
 %if 0%{?with_check}
 BuildRequires:  python3-pytest
 %endif # with_check
@@ -93,7 +94,6 @@ LANG=en_US.utf8 py.test-%{python3_version} -vv tests
 
 %files
 %dir %{python2_sitearch}/%{srcname}
-%{python2_sitearch}/_cffi_*.so
 %{python2_sitearch}/%{srcname}/*.*
 %{python2_sitearch}/%{pkgname}-%{version}-py2.*.egg-info
 %{_unitdir}/pynatconnd.service
@@ -103,7 +103,6 @@ LANG=en_US.utf8 py.test-%{python3_version} -vv tests
 %files -n python3-%{project}
 %dir %{python3_sitearch}/%{srcname}
 %dir %{python3_sitearch}/%{srcname}/__pycache__
-%{python3_sitearch}/_cffi_*.so
 %{python3_sitearch}/%{srcname}/*.*
 %{python3_sitearch}/%{srcname}/__pycache__/*.py*
 %{python3_sitearch}/%{pkgname}-%{version}-py3.*.egg-info
@@ -3,8 +3,6 @@
 
 from setuptools import setup
 
-from natconnd.nfct_cffi import NFCT  # pylint: disable=no-name-in-module
-
 
 setup(
 	name='pynatconnd',
@@ -29,8 +27,9 @@ setup(
 		'Topic :: System :: Networking :: Monitoring',
 		'Topic :: System :: Operating System Kernels :: Linux'],
 
-	install_requires=['cffi', 'configobj', 'falcon'],
-	ext_modules=[NFCT().ffi.verifier.get_extension()],
+	setup_requires=['cffi>=1.0.0'],
+	install_requires=['cffi>=1.0.0', 'configobj', 'falcon'],
+	cffi_modules=['natconnd/nfct_build.py:ffibuilder'],
 	packages=['natconnd'],
 	entry_points={'console_scripts': ['pynatconnd = natconnd.daemon:main']}
 )
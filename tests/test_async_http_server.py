@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+
+from natconnd import async_http_server
+
+
+def app(environ, start_response):
+	path = environ['PATH_INFO']
+	if path == '/slow':
+		time.sleep(0.5)
+	if path == '/stream':
+		start_response('200 OK', [('Content-Type', 'text/plain')])
+		return (b'line %i\n' % i for i in range(3))
+	body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+	out = b'%s %s %s' % (environ['REQUEST_METHOD'].encode(), path.encode(), body)
+	start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', str(len(out)))])
+	return [out]
+
+
+@pytest.fixture
+def port():
+	server = async_http_server.AsyncWSGIServer('127.0.0.1', 0, app, keepalive_timeout=5.0, offload=('/slow', ))
+	thread = threading.Thread(target=server.serve_forever)
+	thread.start()
+	yield server.server.sockets[0].getsockname()[1]
+	server.shutdown()
+	thread.join()
+
+
+def talk(port, data):
+	"""Everything the server sends until it closes the connection"""
+	with socket.create_connection(('127.0.0.1', port), timeout=5.0) as s:
+		s.sendall(data)
+		out = b''
+		while True:
+			chunk = s.recv(65536)
+			if not chunk:
+				return out
+			out += chunk
+
+
+def responses(data):
+	"""[(status line, headers, body)] of the responses in data, bodies are read by Content-Length"""
+	result = []
+	while data:
+		head, _, data = data.partition(b'\r\n\r\n')
+		lines = head.decode('latin-1').split('\r\n')
+		headers = dict((k.strip().lower(), v.strip()) for k, _, v in (x.partition(':') for x in lines[1:]))
+		length = int(headers.get('content-length', len(data)))
+		result.append((lines[0], headers, data[:length]))
+		data = data[length:]
+	return result
+
+
+def read_chunked(data):
+	async def run():
+		reader = asyncio.StreamReader()
+		reader.feed_data(data)
+		reader.feed_eof()
+		return await async_http_server.AsyncWSGIServer.read_chunked(reader)
+	return asyncio.run(run())
+
+
+def test_read_chunked():
+	assert read_chunked(b'5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\n\r\n') == b'hello world'
+	assert read_chunked(b'a\r\n0123456789\r\n0\r\nX-Trailer: 1\r\n\r\n') == b'0123456789'
+	assert read_chunked(b'0\r\n\r\n') == b''
+
+
+@pytest.mark.parametrize('data', [b'x\r\n', b'5\r\nhelloXX0\r\n\r\n', b'-1\r\n'])
+def test_read_chunked_invalid(data):
+	with pytest.raises(async_http_server.BadRequest):
+		read_chunked(data)
+
+
+def test_read_chunked_too_large(monkeypatch):
+	monkeypatch.setattr(async_http_server, 'MAX_BODY', 8)
+	with pytest.raises(async_http_server.BadRequest):
+		read_chunked(b'5\r\nhello\r\n5\r\nworld\r\n0\r\n\r\n')
+
+
+def test_pipelining(port):  # pylint: disable=redefined-outer-name
+	out = responses(talk(port, (
+		b'GET /a HTTP/1.1\r\n\r\n'
+		b'POST /b HTTP/1.1\r\nContent-Length: 3\r\n\r\nxyz'
+		b'\r\n'
+		b'GET /c HTTP/1.1\r\nConnection: close\r\n\r\n')))
+	assert [(status, body) for status, _, body in out] == [
+		('HTTP/1.1 200 OK', b'GET /a '), ('HTTP/1.1 200 OK', b'POST /b xyz'), ('HTTP/1.1 200 OK', b'GET /c ')]
+
+
+def test_chunked_request(port):  # pylint: disable=redefined-outer-name
+	out = responses(talk(port, (
+		b'POST /a HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n5;x=1\r\nhello\r\n6\r\n world\r\n0\r\nX-T: 1\r\n\r\n'
+		b'GET /b HTTP/1.1\r\nConnection: close\r\n\r\n')))
+	assert [body for _, _, body in out] == [b'POST /a hello world', b'GET /b ']
+
+
+def test_unsupported_transfer_encoding(port):  # pylint: disable=redefined-outer-name
+	out = responses(talk(port, b'POST /a HTTP/1.1\r\nTransfer-Encoding: gzip\r\n\r\nxx'))
+	assert [status for status, _, _ in out] == ['HTTP/1.1 501 Not Implemented']
+
+
+def test_bad_request(port):  # pylint: disable=redefined-outer-name
+	out = responses(talk(port, b'GET /a HTTP/1.1\r\nno header\r\n\r\nGET /b HTTP/1.1\r\n\r\n'))
+	assert [status for status, _, _ in out] == ['HTTP/1.1 400 Bad Request']
+
+
+def test_head(port):  # pylint: disable=redefined-outer-name
+	data = talk(port, b'HEAD /a HTTP/1.1\r\n\r\nGET /a HTTP/1.1\r\nConnection: close\r\n\r\n')
+	head, _, rest = data.partition(b'\r\n\r\n')
+	assert b'Content-Length: 8' in head
+	assert rest.startswith(b'HTTP/1.1 200 OK')
+	assert responses(rest)[0][2] == b'GET /a '
+
+
+def test_offload(port):  # pylint: disable=redefined-outer-name
+	slow = []
+	thread = threading.Thread(target=lambda: slow.append(talk(port, b'GET /slow HTTP/1.1\r\nConnection: close\r\n\r\n')))
+	thread.start()
+	time.sleep(0.1)
+	start = time.monotonic()
+	fast = talk(port, b'GET /fast HTTP/1.1\r\nConnection: close\r\n\r\n')
+	elapsed = time.monotonic() - start
+	thread.join()
+	assert fast.endswith(b'GET /fast ')
+	assert slow[0].endswith(b'GET /slow ')
+	assert elapsed < 0.4
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import socket
+import threading
+import time
+
+from natconnd import batch_queue
+from natconnd import conn_record
+from natconnd import metrics
+
+
+def make_batch(sig_types, start=0):
+	return [conn_record.ConnRecord(socket.AF_INET, socket.IPPROTO_TCP, sig_type, 0x0a000001, 40000, 0xc6336401, 443, 0x64400201, start + i, 0)
+			for i, sig_type in enumerate(sig_types)]
+
+
+def ports(batch):
+	return [x.nat_port for x in batch]
+
+
+def dropped(statistics, sig_type):
+	return statistics.value('natconnd_queue_dropped_events_total', sig_type=sig_type)
+
+
+def test_unbounded():
+	queue = batch_queue.BatchQueue(metrics.Registry())
+	marker = object()
+	for i in range(10):
+		assert queue.put(make_batch([conn_record.SIG_NEW] * 100, i * 100)) == 0
+	queue.put(marker)
+	assert queue.qsize() == 11
+	assert queue.events == queue.high_water == 1000
+	for i in range(10):
+		assert ports(queue.get()) == list(range(i * 100, i * 100 + 100))
+	assert queue.get() is marker
+	assert queue.events == 0
+
+
+def test_drop_oldest():
+	statistics = metrics.Registry()
+	queue = batch_queue.BatchQueue(statistics, 5, batch_queue.DROP_OLDEST)
+	assert queue.put(make_batch([conn_record.SIG_NEW, conn_record.SIG_DESTROY, conn_record.SIG_NEW])) == 0
+	assert queue.put(make_batch([conn_record.SIG_UPDATE] * 4, 10)) == 2
+	assert queue.events == 5
+	assert ports(queue.get()) == [2]
+	assert ports(queue.get()) == [10, 11, 12, 13]
+	assert dropped(statistics, 'new') == 1
+	assert dropped(statistics, 'destroy') == 1
+	# A batch larger than the queue keeps its newest events
+	assert queue.put(make_batch([conn_record.SIG_NEW] * 7, 20)) == 2
+	assert ports(queue.get()) == [22, 23, 24, 25, 26]
+
+
+def test_drop_update():
+	statistics = metrics.Registry()
+	queue = batch_queue.BatchQueue(statistics, 4, batch_queue.DROP_UPDATE)
+	queue.put(make_batch([conn_record.SIG_NEW, conn_record.SIG_UPDATE, conn_record.SIG_UPDATE, conn_record.SIG_DESTROY]))
+	assert queue.put(make_batch([conn_record.SIG_NEW, conn_record.SIG_UPDATE], 10)) == 2
+	assert ports(queue.get()) == [0, 3]
+	assert ports(queue.get()) == [10, 11]
+	assert dropped(statistics, 'update') == 2
+	# Without UPDATE events to drop the oldest events go
+	queue.put(make_batch([conn_record.SIG_NEW] * 4))
+	assert queue.put(make_batch([conn_record.SIG_DESTROY], 10)) == 1
+	assert ports(queue.get()) == [1, 2, 3]
+	assert dropped(statistics, 'new') == 1
+
+
+def test_drop_unknown_sig_type():
+	statistics = metrics.Registry()
+	queue = batch_queue.BatchQueue(statistics, 2, batch_queue.DROP_OLDEST)
+	queue.put(make_batch([0, 0]))
+	assert queue.put(make_batch([conn_record.SIG_NEW], 10)) == 1
+	assert dropped(statistics, 'unknown') == 1
+
+
+def test_resync_never_dropped():
+	queue = batch_queue.BatchQueue(metrics.Registry(), 2, batch_queue.DROP_OLDEST)
+	marker = object()
+	queue.put(make_batch([conn_record.SIG_NEW] * 2))
+	assert queue.put(marker) == 0
+	assert queue.put(make_batch([conn_record.SIG_NEW] * 2, 10)) == 2
+	# The emptied batch stays in place
+	assert queue.get() == []
+	assert queue.get() is marker
+	assert ports(queue.get()) == [10, 11]
+
+
+def test_block():
+	statistics = metrics.Registry()
+	queue = batch_queue.BatchQueue(statistics, 3, batch_queue.BLOCK)
+	queue.put(make_batch([conn_record.SIG_NEW] * 2))
+	put = threading.Thread(target=queue.put, args=(make_batch([conn_record.SIG_NEW] * 2, 10), ))
+	put.start()
+	time.sleep(0.1)
+	assert put.is_alive()
+	assert queue.qsize() == 1
+	assert ports(queue.get()) == [0, 1]
+	put.join(5.0)
+	assert not put.is_alive()
+	assert ports(queue.get()) == [10, 11]
+	assert statistics.value('natconnd_queue_blocked_seconds_total') >= 0.05
+	# A batch larger than the queue is taken once the queue is empty
+	assert queue.put(make_batch([conn_record.SIG_NEW] * 5)) == 0
+	assert queue.events == 5
+
+
+def test_close():
+	queue = batch_queue.BatchQueue(metrics.Registry(), 2, batch_queue.BLOCK)
+	queue.put(make_batch([conn_record.SIG_NEW] * 2))
+	put = threading.Thread(target=queue.put, args=(make_batch([conn_record.SIG_NEW], 10), ))
+	put.start()
+	time.sleep(0.1)
+	queue.close()
+	put.join(5.0)
+	assert not put.is_alive()
+	assert queue.put(make_batch([conn_record.SIG_NEW])) == 0
+	assert ports(queue.get()) == [0, 1]
+	assert queue.get() is None
+
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import ipaddress
+import random
+import socket
+
+import pytest
+
+from natconnd import conn_filter
+from natconnd import conn_record
+
+
+def reference(filter_conf, record):
+	"""Semantics of the [filter] section evaluated term by term"""
+	for name, terms in filter_conf.items():
+		if isinstance(terms, str):
+			terms = [terms]
+		included = []
+		excluded = []
+		for term in terms:
+			term = term.strip()
+			negated = term.startswith('!')
+			term = term[1:].strip() if negated else term
+			value = getattr(record, name)
+			if name in conn_record.IP_FIELDS:
+				net = ipaddress.ip_network(term, strict=False)
+				family = socket.AF_INET if net.version == 4 else socket.AF_INET6
+				matched = record.family == family and int(net.network_address) <= value <= int(net.broadcast_address)
+			elif name in conn_record.PORT_FIELDS:
+				low, _, high = term.partition('-')
+				matched = int(low) <= value <= int(high or low)
+			else:
+				matched = value == conn_record.L4PROTOS[term]
+			(excluded if negated else included).append((term, matched))
+		if included and not any(m for _, m in included):
+			return False
+		if any(m for _, m in excluded):
+			return False
+	return True
+
+
+def random_records(count, seed=1):
+	rand = random.Random(seed)
+	records = []
+	for _ in range(count):
+		if rand.random() < 0.7:
+			family = socket.AF_INET
+			ips = [rand.choice((0x0a000000, 0x0a010000, 0xc0a80000, 0x64400200)) + rand.randrange(512) for _ in range(3)]
+		else:
+			family = socket.AF_INET6
+			ips = [(rand.choice((0x20010db8, 0x20010db9)) << 96) + rand.randrange(1 << 20) for _ in range(3)]
+		records.append(conn_record.ConnRecord(
+			family, rand.choice((socket.IPPROTO_TCP, socket.IPPROTO_UDP)), conn_record.SIG_NEW,
+			ips[0], rand.randrange(65536), ips[1], rand.choice((53, 80, 443, 8080, rand.randrange(65536))), ips[2], rand.randrange(1024, 2048), 0))
+	return records
+
+
+FILTERS = [
+	{},
+	{'protocol': 'tcp'},
+	{'protocol': ['tcp', 'udp']},
+	{'dst_port': ['80', '443']},
+	{'dst_port': ['!53']},
+	{'dst_port': ['1-1023', '!80']},
+	{'nat_port': ['1024-1100', '1090-1200', '1300', '1400-1410', '1500-1510', '1600-1610', '1700']},
+	{'nat_port': ['1024', '1026', '1028', '1030', '1032', '1034', '1036']},
+	{'src_ip': '10.0.0.0/8'},
+	{'src_ip': ['10.0.0.0/16', '!10.0.1.0/24']},
+	{'src_ip': ['2001:db8::/32']},
+	{'src_ip': ['10.0.0.0/8', '2001:db8::/32']},
+	{'src_ip': ['!2001:db8::/32', '!192.168.0.0/16']},
+	{'nat_ip': ['100.64.2.0/24', '10.1.0.5', '10.1.0.7', '10.1.0.9', '10.1.0.11', '10.1.0.13', '10.1.0.100']},
+	{'protocol': 'udp', 'dst_port': ['53', '8080'], 'src_ip': ['!10.0.0.0/24'], 'nat_ip': ['100.64.2.0/23', '2001:db8::/31']},
+]
+
+
+@pytest.mark.parametrize('filter_conf', FILTERS)
+def test_semantics(filter_conf):
+	records = random_records(5000)
+	expected = [reference(filter_conf, x) for x in records]
+	conn = conn_filter.ConnFilter(filter_conf, profile_events=1000)
+	assert [conn.match(x) for x in records] == expected
+	# Reordering the fields after profiling keeps the result
+	conn.observe(records[:600])
+	conn.observe(records[600:])
+	assert not conn.profiling
+	assert [conn.match(x) for x in records] == expected
+
+
+def test_reorder_by_measured_share():
+	"""The field rejecting most events is checked first after profiling"""
+	records = random_records(2000)
+	conn = conn_filter.ConnFilter({'protocol': 'tcp', 'dst_port': ['!53']}, profile_events=2000)
+	assert [f.name for f in conn.fields] == ['protocol', 'dst_port']
+	conn.observe(records)
+	assert [f.name for f in conn.fields] == ['protocol', 'dst_port']
+	assert conn.source.index('x.protocol') < conn.source.index('x.dst_port')
+	conn = conn_filter.ConnFilter({'dst_port': ['0-65000'], 'nat_port': ['1024-1030']}, profile_events=2000)
+	conn.observe(records)
+	assert [f.name for f in conn.fields] == ['nat_port', 'dst_port']
+
+
+def test_merge():
+	assert conn_filter.merge([(5, 7), (1, 2), (3, 4), (10, 12), (11, 11)]) == [(1, 7), (10, 12)]
+	assert conn_filter.merge([]) == []
+
+
+@pytest.mark.parametrize('name, term', [
+	('dst_port', '70000'),
+	('dst_port', '443-80'),
+	('dst_port', 'http'),
+	('src_ip', '10.0.0.0/33'),
+	('protocol', 'icmp'),
+	('sig_type', 'new'),
+])
+def test_invalid_terms(name, term):
+	with pytest.raises(ValueError):
+		conn_filter.parse_term(name, term)
+
+
+def test_unknown_keys_ignored():
+	assert conn_filter.parse({'sig_type': 'new', 'dst_port': None}) == []
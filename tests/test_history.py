@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import collections
+import os
+import random
+import socket
+
+from natconnd import conn_record
+from natconnd import history
+
+FIELDS = ('family', 'protocol', 'sig_type', 'src_ip', 'src_port', 'dst_ip', 'dst_port', 'nat_ip', 'nat_port', 'time')
+NAT_IPS = (0x64400201, 0x64400202)
+START = 1700000000.0
+
+
+def fields(record):
+	return tuple(getattr(record, name) for name in FIELDS)
+
+
+def log_events(log, count, seed=1):
+	"""Log random NEW and DESTROY events on a few ports, one per second.
+	Returns {(nat_ip, nat_port, protocol): [(logged, record)]}."""
+	rand = random.Random(seed)
+	open_connections = dict()
+	events = collections.defaultdict(list)
+	for i in range(count):
+		logged = START + i
+		key = (rand.choice(NAT_IPS), rand.randrange(1024, 1064), rand.choice((socket.IPPROTO_TCP, socket.IPPROTO_UDP)))
+		record = open_connections.pop(key, None)
+		if record is None:
+			record = conn_record.ConnRecord(
+				socket.AF_INET, key[2], conn_record.SIG_NEW, 0x0a000000 + i, 40000 + i % 1000, 0xc6336401, 443, key[0], key[1], int(logged))
+			open_connections[key] = record
+		else:
+			record = conn_record.ConnRecord(
+				record.family, record.protocol, conn_record.SIG_DESTROY, record.src_ip, record.src_port, record.dst_ip,
+				record.dst_port, record.nat_ip, record.nat_port, int(logged))
+		events[key].append((logged, record))
+		log.append(record, logged)
+		if i % 97 == 0:
+			log.flush()
+	log.flush()
+	return events
+
+
+def expected_lookup(events, key, when):
+	"""(fields, logged, ended) of the connection on key at when, or None"""
+	found = None
+	for i, (logged, record) in enumerate(events.get(key, ())):
+		if logged > when:
+			break
+		found = i
+	if found is None or events[key][found][1].sig_type != conn_record.SIG_NEW:
+		return None
+	logged, record = events[key][found]
+	ended = events[key][found + 1][0] if found + 1 < len(events[key]) else None
+	return fields(record), logged, ended
+
+
+def check(log, events, seed=2):
+	rand = random.Random(seed)
+	keys = list(events) + [(NAT_IPS[0], 2000, socket.IPPROTO_TCP)]
+	for _ in range(500):
+		key = rand.choice(keys)
+		when = START + rand.uniform(-10, 2100)
+		found = log.lookup(key[0], key[1], key[2], when)
+		if found is not None:
+			found = (fields(found[0]), found[1], found[2])
+		assert found == expected_lookup(events, key, when), (key, when)
+
+
+def test_pack_unpack():
+	record = conn_record.ConnRecord(
+		socket.AF_INET6, socket.IPPROTO_UDP, conn_record.SIG_DESTROY, (0x20010db8 << 96) + 5, 50000, (0x20010db8 << 96) + 0xffff,
+		53, (0x20010db8 << 96) + 1, 1024, 1700000000)
+	unpacked, logged = history.unpack(b'x' + history.pack(record, START + 0.5), 1)
+	assert fields(unpacked) == fields(record)
+	assert logged == START + 0.5
+
+
+def test_round_trip(tmp_path):
+	log = history.HistoryLog(str(tmp_path), segment_size=16 * 1024, segment_age=float('inf'))
+	events = log_events(log, 2000)
+	assert len(log) == 2000
+	# Lookups span the closed segments and the one being written
+	assert len(log.segments) > 3 and log.active is not None
+	check(log, events)
+	log.close()
+	assert log.active is None
+	check(log, events)
+	# Closed segments are found again by their index
+	reopened = history.HistoryLog(str(tmp_path), segment_size=16 * 1024, segment_age=float('inf'))
+	assert len(reopened) == 2000
+	check(reopened, events)
+
+
+def test_recover_unindexed_segment(tmp_path):
+	log = history.HistoryLog(str(tmp_path), segment_size=16 * 1024, segment_age=float('inf'))
+	events = log_events(log, 500)
+	active = log.active.path
+	# Crash: the segment being written has no index
+	log.file.close()
+	assert not os.path.exists(history.index_path(active))
+	recovered = history.HistoryLog(str(tmp_path), segment_size=16 * 1024, segment_age=float('inf'))
+	assert os.path.exists(history.index_path(active))
+	assert len(recovered) == 500
+	check(recovered, events)
+
+
+def test_skip_damaged_segment(tmp_path):
+	log = history.HistoryLog(str(tmp_path), segment_size=16 * 1024, segment_age=float('inf'))
+	log_events(log, 500)
+	log.close()
+	segments = len(log.segments)
+	with open(os.path.join(str(tmp_path), 'history-0000000000000001.log'), 'wb') as f:
+		f.write(b'garbage')
+	assert len(history.HistoryLog(str(tmp_path)).segments) == segments
+
+
+def test_expire_max_size(tmp_path):
+	log = history.HistoryLog(str(tmp_path), segment_size=16 * 1024, segment_age=float('inf'), max_size=64 * 1024)
+	events = log_events(log, 2000)
+	log.close()
+	assert log.size() <= 64 * 1024
+	assert len(os.listdir(str(tmp_path))) == 2 * len(log.segments)
+	# Events still in the log are found, older ones are gone
+	first = log.segments[0].first
+	kept = dict((key, [(logged, record) for logged, record in items if logged >= first]) for key, items in events.items())
+	for key, items in kept.items():
+		for logged, record in items:
+			found = log.lookup(key[0], key[1], key[2], logged)
+			if record.sig_type == conn_record.SIG_NEW:
+				assert fields(found[0]) == fields(record)
+			else:
+				assert found is None
+	assert log.lookup(NAT_IPS[0], 1024, socket.IPPROTO_TCP, START) is None
+
+
+def test_expire_retention(tmp_path):
+	log = history.HistoryLog(str(tmp_path), segment_size=16 * 1024, segment_age=float('inf'), retention=60.0)
+	log_events(log, 500)
+	log.close()
+	# All events were logged long ago, the segment closed last goes with the next expiry
+	log.expire()
+	assert not log.segments
+	assert not os.listdir(str(tmp_path))
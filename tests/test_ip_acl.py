@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import pytest
+
+from natconnd import ip_acl
+
+
+def test_compile_merges_ranges():
+	ranges = ip_acl.IPACL.compile(['10.0.0.0/25', '10.0.0.128/25', '10.0.0.5', ' 192.168.1.7/24 ', '2001:db8::/32'])
+	assert ranges[4] == ([0x0a000000, 0xc0a80100], [0x0a0000ff, 0xc0a801ff])
+	assert ranges[6] == ([0x20010db8 << 96], [(0x20010db9 << 96) - 1])
+
+
+@pytest.mark.parametrize('addr, verdict', [
+	('127.0.0.1', True),
+	('10.1.2.3', True),
+	('10.255.255.255', True),
+	('11.0.0.0', False),
+	('9.255.255.255', False),
+	('::1', True),
+	('::2', False),
+	('::ffff:10.0.0.1', True),
+	('2001:db8::1', False),
+	('not an address', False),
+	('', False),
+])
+def test_check(addr, verdict):
+	acl = ip_acl.IPACL(['127.0.0.1', '10.0.0.0/8', '::1'])
+	assert acl.check(addr) is verdict
+	# Cached verdict
+	assert acl.check(addr) is verdict
+
+
+def test_invalid_network():
+	with pytest.raises(ValueError):
+		ip_acl.IPACL(['10.0.0.0/33'])
+
+
+def test_reload_clears_cache():
+	acl = ip_acl.IPACL(['10.0.0.0/8'])
+	assert acl.check('10.0.0.1')
+	acl.load(['192.168.0.0/16'])
+	assert not acl.check('10.0.0.1')
+	assert acl.check('192.168.3.4')
+
+
+def test_cache_bounded():
+	acl = ip_acl.IPACL(['10.0.0.0/8'], cache_size=4)
+	for i in range(10):
+		assert acl.check('10.0.0.%i' % i)
+	assert list(acl.cache) == ['10.0.0.%i' % i for i in range(6, 10)]
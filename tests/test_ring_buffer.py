@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import socket
+import threading
+from multiprocessing import shared_memory
+
+import pytest
+
+from natconnd import conn_filter
+from natconnd import conn_record
+from natconnd import metrics
+from natconnd import net_filter
+from natconnd import ring_buffer
+
+FIELDS = ('family', 'protocol', 'sig_type', 'src_ip', 'src_port', 'dst_ip', 'dst_port', 'nat_ip', 'nat_port', 'time')
+
+
+@pytest.fixture
+def rings():
+	"""Writer side and reader side of a ring of 16 records"""
+	writer = ring_buffer.RingBuffer(16)
+	reader = ring_buffer.RingBuffer(name=writer.name)
+	yield writer, reader
+	reader.close()
+	writer.close(unlink=True)
+
+
+def make_records(count, start=0):
+	records = []
+	for i in range(start, start + count):
+		if i % 2:
+			records.append(conn_record.ConnRecord(
+				socket.AF_INET, socket.IPPROTO_TCP, conn_record.SIG_NEW, 0x0a000000 + i, 40000, 0xc6336401, 443, 0x64400201, 1024 + i, 1700000000 + i))
+		else:
+			records.append(conn_record.ConnRecord(
+				socket.AF_INET6, socket.IPPROTO_UDP, conn_record.SIG_DESTROY, (0x20010db8 << 96) + i, 50000, (0x20010db8 << 96) + 0xffff,
+				53, (0x20010db8 << 96) + 1, 1024 + i, 1700000000 + i))
+	return records
+
+
+def fields(record):
+	return tuple(getattr(record, name) for name in FIELDS)
+
+
+def test_round_trip(rings):  # pylint: disable=redefined-outer-name
+	writer, reader = rings
+	assert reader.read(10) == []
+	# Enough rounds to wrap around several times, with reads crossing the end of the ring
+	for start in range(0, 100, 10):
+		records = make_records(10, start)
+		writer.write(records)
+		assert len(reader) == 10
+		read = reader.read(7) + reader.read(7)
+		assert [kind for kind, _ in read] == [ring_buffer.EVENT] * 10
+		assert [fields(x) for _, x in read] == [fields(x) for x in records]
+		assert len(reader) == 0
+
+
+def test_control_records(rings):  # pylint: disable=redefined-outer-name
+	writer, reader = rings
+	writer.write_control(ring_buffer.RESYNC_BEGIN)
+	writer.write(make_records(2), ring_buffer.DUMP)
+	writer.write_control(ring_buffer.RESYNC_END, 1)
+	read = reader.read(10)
+	assert [kind for kind, _ in read] == [ring_buffer.RESYNC_BEGIN, ring_buffer.DUMP, ring_buffer.DUMP, ring_buffer.RESYNC_END]
+	assert read[-1][1].sig_type == 1
+
+
+def test_full_ring_waits(rings):  # pylint: disable=redefined-outer-name
+	writer, reader = rings
+	records = make_records(100)
+	thread = threading.Thread(target=writer.write, args=(records, ))
+	thread.start()
+	read = []
+	while len(read) < len(records):
+		read.extend(x for _, x in reader.read(5))
+		assert len(reader) <= reader.capacity
+	thread.join(5.0)
+	assert [fields(x) for x in read] == [fields(x) for x in records]
+
+
+def test_wakeup():
+	read_fd, write_fd = os.pipe()
+	ring = ring_buffer.RingBuffer(16, wakeup=write_fd)
+	try:
+		ring.write(make_records(3))
+		assert os.read(read_fd, 16) == b'\0'
+	finally:
+		ring.close(unlink=True)
+		os.close(read_fd)
+		os.close(write_fd)
+
+
+def test_counters(rings):  # pylint: disable=redefined-outer-name
+	writer, reader = rings
+	assert reader.counters() == [0] * len(ring_buffer.COUNTERS)
+	writer.publish_counters([1, 2, 3, 4])
+	assert reader.counters() == [1, 2, 3, 4]
+
+
+def test_ring_writer(rings):  # pylint: disable=redefined-outer-name
+	"""Filtered events and resyncs are written, drops of the reader are passed back once"""
+	writer, reader = rings
+	reader.add_dropped(5)
+	statistics = metrics.Registry()
+	statistics.counter('natconnd_events_received_total', 'Events').inc(7)
+	ring_writer = ring_buffer.RingWriter(writer, conn_filter.ConnFilter({'protocol': 'tcp'}), statistics)
+	assert ring_writer.put(make_records(4)) == 0
+	assert [x.nat_port for _, x in reader.read(10)] == [1025, 1027]
+	assert reader.counters()[0] == 7
+	reader.add_dropped(3)
+	reader.add_dropped(2)
+	assert writer.dropped() == 10
+	assert ring_writer.put(net_filter.Resync(make_records(2), threading.Event())) == 5
+	assert [kind for kind, _ in reader.read(10)] == [ring_buffer.RESYNC_BEGIN, ring_buffer.DUMP, ring_buffer.RESYNC_END]
+	assert ring_writer.put([]) == 0
+
+
+def test_attach_foreign_segment():
+	shm = shared_memory.SharedMemory(create=True, size=ring_buffer.HEADER_SIZE)
+	try:
+		with pytest.raises(ring_buffer.RingBufferError):
+			ring_buffer.RingBuffer(name=shm.name)
+	finally:
+		shm.close()
+		shm.unlink()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import random
+import socket
+from multiprocessing import shared_memory
+
+import pytest
+
+from natconnd import conn_record
+from natconnd import conn_table
+from natconnd import shm_table
+
+
+@pytest.fixture
+def tables(request):
+	"""Writer and reader of a table keyed by the parametrized key_name"""
+	writer = shm_table.SharedTable(request.param, slots=4096)
+	reader = shm_table.SharedTable(request.param, name=writer.name)
+	yield writer, reader
+	reader.close()
+	writer.close(unlink=True)
+
+
+def make_record(protocol, nat_ip, nat_port, src_ip, seq=0):
+	record = conn_record.ConnRecord(socket.AF_INET, protocol, conn_record.SIG_NEW, src_ip, 40000, 0xc6336401, 443, nat_ip, nat_port, 1700000000)
+	record.seq = seq
+	return record
+
+
+def summary(records):
+	return [(r.protocol, r.nat_ip, r.nat_port, r.src_ip, r.seq) for r in records]
+
+
+def check(writer, reader, expected):
+	"""Lookups of every value in expected (plus a missing one) give the same records as the dict"""
+	get_value = writer.get_key_value
+	assert len(reader) == len(expected)
+	values = set(get_value(r) for r in expected.values()) | {12345678}
+	for value in values:
+		records = sorted((r for r in expected.values() if get_value(r) == value), key=lambda r: r.seq)
+		assert summary(reader.lookup(writer.key_name, value)) == summary(records), value
+
+
+@pytest.mark.parametrize('tables, nat_ips, ports', [
+	('nat_port', 2, 2000),
+	('nat_port', 40, 100),
+	('nat_port', 3, 50),
+	('src_ip', 20, 3000),
+], indirect=['tables'])
+def test_against_dict(tables, nat_ips, ports):  # pylint: disable=redefined-outer-name
+	writer, reader = tables
+	rand = random.Random(nat_ips * ports)
+	expected = dict()
+	for seq in range(1, 20001):
+		key = (rand.choice((socket.IPPROTO_TCP, socket.IPPROTO_UDP)), 0x64400200 + rand.randrange(nat_ips), 1024 + rand.randrange(ports))
+		if key in expected and rand.random() < 0.5:
+			writer.remove(key)
+			del expected[key]
+			continue
+		if key not in expected and len(expected) >= writer.max_entries:
+			continue
+		record = make_record(key[0], key[1], key[2], 0x0a000000 + rand.randrange(50), seq)
+		assert writer.insert(key, record)
+		expected[key] = record
+		if seq % 5000 == 0:
+			check(writer, reader, expected)
+	check(writer, reader, expected)
+	for key in list(expected):
+		writer.remove(key)
+	check(writer, reader, dict())
+	assert not writer.values
+	assert not any(writer.directory_keys)
+
+
+@pytest.mark.parametrize('tables', ['nat_port'], indirect=True)
+def test_overflow(tables):  # pylint: disable=redefined-outer-name
+	"""A port in use on more NAT IPs than a directory slot lists"""
+	writer, reader = tables
+	expected = dict()
+	for i in range(shm_table.CANDIDATES * 2):
+		key = (socket.IPPROTO_TCP, 0x64400200 + i, 2000)
+		expected[key] = make_record(key[0], key[1], key[2], 0x0a000000 + i, i + 1)
+		writer.insert(key, expected[key])
+	check(writer, reader, expected)
+	for i in range(shm_table.CANDIDATES * 2 - 1):
+		key = (socket.IPPROTO_TCP, 0x64400200 + i, 2000)
+		writer.remove(key)
+		del expected[key]
+		check(writer, reader, expected)
+
+
+@pytest.mark.parametrize('tables', ['src_ip'], indirect=True)
+def test_replace_moves_entry(tables):  # pylint: disable=redefined-outer-name
+	"""Replacing an entry with another key_name value moves it to another probe sequence"""
+	writer, reader = tables
+	key = (socket.IPPROTO_UDP, 0x64400201, 3000)
+	writer.insert(key, make_record(key[0], key[1], key[2], 0x0a000001, 1))
+	writer.insert(key, make_record(key[0], key[1], key[2], 0x0a000002, 2))
+	assert not reader.lookup('src_ip', 0x0a000001)
+	assert summary(reader.lookup('src_ip', 0x0a000002)) == [(key[0], key[1], key[2], 0x0a000002, 2)]
+	assert reader.lookup('nat_port', 3000) == []
+
+
+@pytest.mark.parametrize('tables', ['nat_port'], indirect=True)
+def test_full(tables):  # pylint: disable=redefined-outer-name
+	writer, reader = tables
+	for i in range(writer.max_entries):
+		assert writer.insert((socket.IPPROTO_TCP, 0x64400201, i), make_record(socket.IPPROTO_TCP, 0x64400201, i, 0x0a000001, i))
+	assert not writer.insert((socket.IPPROTO_TCP, 0x64400201, 65000), make_record(socket.IPPROTO_TCP, 0x64400201, 65000, 0x0a000001))
+	assert len(reader) == writer.max_entries
+
+
+def test_mirror():
+	"""ConnTable passes its changes on to the mirror"""
+	writer = shm_table.SharedTable('nat_port', slots=1024)
+	reader = shm_table.SharedTable('nat_port', name=writer.name)
+	try:
+		table = conn_table.ConnTable(indexes=('nat_port', ), mirror=writer)
+		for i in range(300):
+			table.insert(make_record(socket.IPPROTO_TCP, 0x64400200 + i % 3, 1024 + i % 100, 0x0a000000 + i))
+		for key in list(table.expiry)[:50]:
+			table.remove(key)
+		for port in range(1024, 1124):
+			assert summary(reader.lookup('nat_port', port)) == summary(table.lookup('nat_port', port))
+	finally:
+		reader.close()
+		writer.close(unlink=True)
+
+
+def test_attach_foreign_segment():
+	shm = shared_memory.SharedMemory(create=True, size=shm_table.segment_size(16))
+	try:
+		with pytest.raises(shm_table.SharedTableError):
+			shm_table.SharedTable('nat_port', name=shm.name)
+	finally:
+		shm.close()
+		shm.unlink()
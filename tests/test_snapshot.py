@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import socket
+import threading
+import time
+
+import pytest
+
+from natconnd import conn_record
+from natconnd import conn_table
+from natconnd import snapshot
+
+FIELDS = ('family', 'protocol', 'sig_type', 'src_ip', 'src_port', 'dst_ip', 'dst_port', 'nat_ip', 'nat_port', 'time')
+
+
+def make_records(count):
+	records = []
+	for i in range(count):
+		if i % 3:
+			records.append(conn_record.ConnRecord(
+				socket.AF_INET, socket.IPPROTO_TCP if i % 2 else socket.IPPROTO_UDP, conn_record.SIG_NEW,
+				0x0a000000 + i, 40000 + i, 0xc6336401, 443, 0x64400201, 1024 + i, 1700000000 + i))
+		else:
+			records.append(conn_record.ConnRecord(
+				socket.AF_INET6, socket.IPPROTO_TCP, conn_record.SIG_UPDATE,
+				(0x20010db8 << 96) + i, 50000, (0x20010db8 << 96) + 0xffffffff, 80, (0x20010db8 << 96) + 1, 1024 + i, 1700000000 + i))
+	return records
+
+
+def fields(record):
+	return tuple(getattr(record, name) for name in FIELDS)
+
+
+def test_round_trip(tmp_path, monkeypatch):
+	monkeypatch.setattr(snapshot, 'WRITE_CHUNK', 7)
+	path = str(tmp_path / 'snapshot')
+	now = time.time()
+	records = make_records(50)
+	assert snapshot.write(path, [(r, now - 100 + i) for i, r in enumerate(records)]) == 50
+	read = list(snapshot.read(path, 1000, now))
+	assert [fields(r) for r, _ in read] == [fields(r) for r in records]
+	assert [age for _, age in read] == pytest.approx([100 - i for i in range(50)])
+	# Entries older than the life span are skipped
+	assert [fields(r) for r, _ in snapshot.read(path, 60.5, now)] == [fields(r) for r in records[40:]]
+
+
+def test_empty(tmp_path):
+	path = str(tmp_path / 'snapshot')
+	assert snapshot.write(path, []) == 0
+	assert not list(snapshot.read(path, 1000))
+
+
+def test_rewrite_replaces(tmp_path):
+	path = str(tmp_path / 'snapshot')
+	now = time.time()
+	snapshot.write(path, [(r, now) for r in make_records(10)])
+	snapshot.write(path, [(r, now) for r in make_records(3)])
+	assert len(list(snapshot.read(path, 1000))) == 3
+	assert not (tmp_path / 'snapshot.tmp').exists()
+
+
+def test_truncated(tmp_path):
+	path = tmp_path / 'snapshot'
+	snapshot.write(str(path), [(r, time.time()) for r in make_records(5)])
+	path.write_bytes(path.read_bytes()[:-1])
+	with pytest.raises(snapshot.SnapshotError):
+		list(snapshot.read(str(path), 1000))
+	path.write_bytes(b'short')
+	with pytest.raises(snapshot.SnapshotError):
+		list(snapshot.read(str(path), 1000))
+
+
+def test_wrong_magic(tmp_path):
+	path = tmp_path / 'snapshot'
+	snapshot.write(str(path), [(r, time.time()) for r in make_records(5)])
+	path.write_bytes(b'NATCXXXX' + path.read_bytes()[8:])
+	with pytest.raises(snapshot.SnapshotError):
+		list(snapshot.read(str(path), 1000))
+
+
+def test_save_load(tmp_path):
+	path = str(tmp_path / 'snapshot')
+	table = conn_table.ConnTable(indexes=('src_ip', ))
+	refreshed = time.monotonic() - 10
+	for i, record in enumerate(make_records(20)):
+		table.insert(record, refreshed + i * 0.1)
+	assert snapshot.save(path, table, threading.Lock()) == 20
+	restored = conn_table.ConnTable(indexes=('src_ip', ))
+	assert snapshot.load(path, restored, 300) == 20
+	assert list(restored.expiry) == list(table.expiry)
+	assert list(restored.expiry.values()) == pytest.approx(list(table.expiry.values()), abs=0.1)
+	assert dict((k, fields(v)) for k, v in restored.items()) == dict((k, fields(v)) for k, v in table.items())
+	assert [fields(r) for r in restored.lookup('src_ip', 0x0a000001)] == [fields(r) for r in table.lookup('src_ip', 0x0a000001)]